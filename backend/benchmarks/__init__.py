@@ -0,0 +1,14 @@
+"""
+Stand-alone performance benchmarks.
+
+Run from the ``backend`` directory, e.g. ``python -m benchmarks.fanout``. Each
+benchmark prints one JSON object per measurement so results can be diffed.
+"""
+import os
+
+import django
+
+
+def setup():
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "chat_project.settings")
+    django.setup()
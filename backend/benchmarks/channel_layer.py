@@ -0,0 +1,137 @@
+"""
+Redis load of room broadcasts for the core and local fan-out channel layers.
+
+Simulates ``--processes`` server processes, each with its own layer instance,
+holding ``--members`` consumers in each of ``--rooms`` rooms. It then sends
+``--messages`` group messages and waits until every member has received them.
+Redis work is read from ``INFO commandstats`` before and after, which includes
+commands run inside Lua scripts. Servers without INFO fall back to counting the
+commands the clients sent.
+
+    REDIS_HOST=localhost python -m benchmarks.channel_layer --members 500
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+
+import redis.asyncio as aioredis
+from redis.asyncio.connection import Connection
+from redis.exceptions import ResponseError
+
+from . import setup
+
+BACKENDS = {
+    "core": "channels_redis.core.RedisChannelLayer",
+    "local_fanout": "chat.layers.LocalFanoutChannelLayer",
+}
+
+
+class ClientCommandCounter:
+    def __init__(self):
+        self.count = 0
+        self._original = Connection.send_packed_command
+
+    def __enter__(self):
+        counter = self
+
+        async def send_packed_command(connection, command, check_health=True):
+            counter.count += 1 if isinstance(command, (bytes, str)) else len(command)
+            return await counter._original(connection, command, check_health)
+
+        Connection.send_packed_command = send_packed_command
+        return self
+
+    def __exit__(self, *exc):
+        Connection.send_packed_command = self._original
+
+
+async def server_command_count(client):
+    try:
+        stats = await client.info("commandstats")
+    except ResponseError:
+        return None
+    return sum(entry["calls"] for name, entry in stats.items() if name != "cmdstat_info")
+
+
+async def run(backend, host, port, processes, rooms, members, messages):
+    from django.utils.module_loading import import_string
+
+    layer_class = import_string(BACKENDS[backend])
+    layers = [layer_class(hosts=[(host, port)], prefix="bench") for _ in range(processes)]
+    received = 0
+    expected = messages * members
+    done = asyncio.Event()
+
+    async def consume(layer, channel):
+        nonlocal received
+        while True:
+            await layer.receive(channel)
+            received += 1
+            if received >= expected:
+                done.set()
+
+    tasks = []
+    for room in range(rooms):
+        for member in range(members):
+            layer = layers[member % processes]
+            channel = await layer.new_channel()
+            await layer.group_add(f"bench_{room}", channel)
+            tasks.append(asyncio.ensure_future(consume(layer, channel)))
+    await asyncio.sleep(0.5)  # let subscriptions settle
+
+    admin = aioredis.Redis(host=host, port=port)
+    before = await server_command_count(admin)
+    with ClientCommandCounter() as client_counter:
+        started = time.perf_counter()
+        for i in range(messages):
+            await layers[0].group_send(f"bench_{i % rooms}", {"type": "chat_message", "text": "x" * 120})
+        await asyncio.wait_for(done.wait(), timeout=120)
+        elapsed = time.perf_counter() - started
+    after = await server_command_count(admin)
+
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    for layer in layers:
+        await layer.flush()
+    await admin.aclose()
+
+    ops = after - before if before is not None else client_counter.count
+    return {
+        "backend": backend,
+        "processes": processes,
+        "rooms": rooms,
+        "members_per_room": members,
+        "messages": messages,
+        "deliveries": received,
+        "seconds": elapsed,
+        "redis_ops": ops,
+        "redis_ops_source": "server" if before is not None else "client",
+        "redis_ops_per_message": ops / messages,
+        "redis_ops_per_sec": ops / elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--host", default=os.environ.get("REDIS_HOST", "localhost"))
+    parser.add_argument("--port", type=int, default=6379)
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--rooms", type=int, default=10)
+    parser.add_argument("--members", type=int, default=100, help="members per room")
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--backends", nargs="+", choices=sorted(BACKENDS), default=sorted(BACKENDS))
+    args = parser.parse_args()
+
+    setup()
+    for backend in args.backends:
+        result = asyncio.run(
+            run(backend, args.host, args.port, args.processes, args.rooms, args.members, args.messages)
+        )
+        print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+Per-message CPU cost of delivering one room broadcast to every member socket.
+
+Compares the old path, where every consumer rebuilds and ``json.dumps`` the
+payload, with the serialize-once path where consumers forward the text encoded
+at the ``group_send`` site. No channel layer or database is involved: events are
+handed straight to ``ChatConsumer.chat_message`` and ``send`` is a no-op.
+
+    python -m benchmarks.fanout --sizes 10 100 1000 5000 --messages 200
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from . import setup
+
+
+async def _discard(message):
+    pass
+
+
+def _make_consumers(count):
+    from chat.consumers import ChatConsumer
+    from chat.outbound import Outbox
+
+    consumers = []
+    for _ in range(count):
+        consumer = ChatConsumer()
+        consumer.base_send = _discard
+        consumer.outbox = Outbox(consumer.send_frame)
+        consumers.append(consumer)
+    return consumers
+
+
+async def _run(consumers, messages, encode_once, dumps):
+    payload = {"message": "x" * 120, "user_id": 42, "username": "benchmark-user"}
+    started = time.process_time()
+    for _ in range(messages):
+        if encode_once:
+            event = {"type": "chat_message", "text": dumps(payload)}
+        else:
+            event = {"type": "chat_message", **payload}
+        for consumer in consumers:
+            if encode_once:
+                await consumer.chat_message(event)
+                await consumer.outbox.flush()
+            else:
+                text = json.dumps({"message": event["message"], "user_id": event["user_id"], "username": event["username"]})
+                await consumer.send(text_data=text)
+    return (time.process_time() - started) / messages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 5000])
+    parser.add_argument("--messages", type=int, default=200)
+    args = parser.parse_args()
+
+    setup()
+    from chat import encoding
+
+    encoders = {"json": json.dumps}
+    if encoding.orjson is not None:
+        encoders["orjson"] = encoding.dumps
+
+    for size in args.sizes:
+        consumers = _make_consumers(size)
+        baseline = asyncio.run(_run(consumers, args.messages, False, json.dumps))
+        print(json.dumps({"room_size": size, "path": "per_socket_json", "cpu_ms_per_message": baseline * 1000}))
+        for name, dumps in encoders.items():
+            seconds = asyncio.run(_run(consumers, args.messages, True, dumps))
+            print(
+                json.dumps(
+                    {
+                        "room_size": size,
+                        "path": f"encode_once_{name}",
+                        "cpu_ms_per_message": seconds * 1000,
+                        "speedup": baseline / seconds if seconds else None,
+                    }
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+"""
+Concurrent HTTP load on the hot read endpoints: DRF viewsets versus their async views.
+
+Drives ``chat_project.asgi.application`` in-process with raw ASGI requests,
+through the full middleware stack, against a throwaway test database.
+``--sqlite`` swaps the configured database for an in-memory SQLite one; the
+history buffer still needs the configured Redis. The URLconf is swapped for
+:mod:`benchmarks.http_urls`, which mounts both implementations side by side.
+
+For every endpoint, implementation and ``--concurrency`` level it keeps that
+many requests in flight until ``--requests`` have completed, and prints one
+JSON object with latency percentiles, throughput and non-200 responses.
+Endpoints are ``rooms`` (first page of the room list), ``history`` (newest
+page, from the Redis buffer once warm), ``history_db`` (an older page, always
+from the database) and ``me``.
+
+    python -m benchmarks.http --sqlite --concurrency 1 20 100 --requests 2000
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from . import setup
+from .websocket import summarize
+
+ENDPOINTS = ("rooms", "history", "history_db", "me")
+IMPLEMENTATIONS = ("drf", "async")
+
+
+def create_fixtures(rooms, messages):
+    """A user with an access token and ``rooms`` rooms of ``messages`` messages; returns ``(token, room_id, before)``."""
+    from django.contrib.auth.models import User
+    from django.test import Client
+
+    from chat.models import Message, Room
+    from chat.serializers import CustomTokenObtainPairSerializer
+
+    user = User.objects.create(username=f"bench-http-{time.monotonic_ns()}")
+    room_ids = []
+    for index in range(rooms):
+        room = Room.objects.create(name=f"HTTP bench {index}", created_by=user)
+        Message.objects.bulk_create(
+            Message(room=room, user=user, content=f"message {seq}", seq=seq) for seq in range(1, messages + 1)
+        )
+        room_ids.append(room.id)
+    token = str(CustomTokenObtainPairSerializer.get_token(user).access_token)
+    newest = Client().get(f"/api/rooms/{room_ids[0]}/messages/", HTTP_AUTHORIZATION=f"Bearer {token}").json()
+    return token, room_ids[0], newest["before"]
+
+
+def target(endpoint, room_id, before):
+    if endpoint == "rooms":
+        return "rooms/", ""
+    if endpoint == "history":
+        return f"rooms/{room_id}/messages/", ""
+    if endpoint == "history_db":
+        return f"rooms/{room_id}/messages/", f"before={before}"
+    return "users/me/", ""
+
+
+async def get(application, path, query, token):
+    """One GET through the ASGI application; returns the response status."""
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": query.encode(),
+        "headers": [(b"host", b"testserver"), (b"authorization", f"Bearer {token}".encode())],
+        "client": ("127.0.0.1", 0),
+        "server": ("testserver", 80),
+    }
+    done = asyncio.Event()
+    sent_body = False
+    status = None
+
+    async def receive():
+        nonlocal sent_body
+        if not sent_body:
+            sent_body = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await done.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+        elif message["type"] == "http.response.body" and not message.get("more_body"):
+            done.set()
+
+    await application(scope, receive, send)
+    return status
+
+
+async def load(application, path, query, token, concurrency, requests):
+    latencies = []
+    failures = 0
+    remaining = requests
+
+    async def worker():
+        nonlocal remaining, failures
+        while remaining > 0:
+            remaining -= 1
+            started = time.perf_counter()
+            status = await get(application, path, query, token)
+            latencies.append(time.perf_counter() - started)
+            failures += status != 200
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return {
+        "latency_ms": summarize(latencies),
+        "requests_per_sec": len(latencies) / elapsed,
+        "failures": failures,
+    }
+
+
+async def run(token, room_id, before, endpoints, levels, requests):
+    from chat import redis_client
+    from chat_project.asgi import application
+
+    results = []
+    for endpoint in endpoints:
+        route, query = target(endpoint, room_id, before)
+        for implementation in IMPLEMENTATIONS:
+            path = f"/{implementation}/{route}"
+            # Warm up: connections, the history buffer, the token's user record
+            await load(application, path, query, token, 1, 10)
+            for concurrency in levels:
+                result = await load(application, path, query, token, concurrency, requests)
+                results.append(
+                    {"endpoint": endpoint, "implementation": implementation, "concurrency": concurrency, **result}
+                )
+    await redis_client.shutdown()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--endpoints", nargs="+", choices=ENDPOINTS, default=list(ENDPOINTS))
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 20, 100])
+    parser.add_argument("--requests", type=int, default=1000, help="requests per endpoint and concurrency level")
+    parser.add_argument("--rooms", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=200, help="messages per room")
+    parser.add_argument("--sqlite", action="store_true", help="use an in-memory SQLite database")
+    args = parser.parse_args()
+
+    from django.conf import settings
+
+    if args.sqlite:
+        settings.DATABASES["default"] = {"ENGINE": "django.db.backends.sqlite3", "NAME": ":memory:"}
+    setup()
+
+    from django.test.utils import override_settings, setup_databases, teardown_databases
+
+    old_config = setup_databases(verbosity=0, interactive=False)
+    try:
+        token, room_id, before = create_fixtures(args.rooms, args.messages)
+        with override_settings(ROOT_URLCONF="benchmarks.http_urls", ALLOWED_HOSTS=["testserver"]):
+            results = asyncio.run(run(token, room_id, before, args.endpoints, args.concurrency, args.requests))
+        for result in results:
+            print(json.dumps(result))
+    finally:
+        teardown_databases(old_config, verbosity=0)
+
+
+if __name__ == "__main__":
+    main()
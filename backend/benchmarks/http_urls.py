@@ -0,0 +1,14 @@
+"""URLconf of :mod:`benchmarks.http`: every endpoint under ``/drf/`` as its viewset and under ``/async/``."""
+from django.urls import path
+
+from chat import async_views
+from chat.views import RoomViewSet, UserViewSet
+
+urlpatterns = [
+    path("drf/rooms/", RoomViewSet.as_view({"get": "list"}, basename="room", detail=False)),
+    path("drf/rooms/<int:pk>/messages/", RoomViewSet.as_view({"get": "messages"}, basename="room", detail=True)),
+    path("drf/users/me/", UserViewSet.as_view({"get": "me"}, basename="user", detail=False)),
+    path("async/rooms/", async_views.rooms),
+    path("async/rooms/<int:pk>/messages/", async_views.room_history),
+    path("async/users/me/", async_views.users_me),
+]
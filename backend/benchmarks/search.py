@@ -0,0 +1,115 @@
+"""
+Message search: full-text index versus the ILIKE scan it replaces.
+
+Fills a throwaway PostgreSQL test database with ``--messages`` generated
+messages spread over ``--rooms`` rooms, then times every ``--queries`` term
+both ways: ``content ILIKE '%term%'`` (what the admin search used to run) and
+``Message.objects.search`` through the GIN index, each fetching one ranked
+page. It prints one JSON object per term with median and worst times over
+``--repeat`` runs, match counts and whether the plan used the index.
+
+    python -m benchmarks.search --messages 1000000 --queries deploy "release notes" lunch
+"""
+import argparse
+import json
+import random
+import time
+
+from . import setup
+
+WORDS = (
+    "deploy release build review merge branch ticket standup lunch coffee meeting notes "
+    "database cache latency incident alert rollback staging production customer invoice "
+    "design sprint planning demo weekend holiday budget hiring onboarding docs question"
+).split()
+
+
+def create_fixtures(messages, rooms, batch_size=5000):
+    from django.contrib.auth.models import User
+    from django.db import connection
+
+    from chat.models import Message, Room
+
+    rng = random.Random(42)
+    user = User.objects.create(username=f"bench-search-{time.monotonic_ns()}")
+    room_ids = [Room.objects.create(name=f"Search bench {i}", created_by=user).id for i in range(rooms)]
+    next_seq = dict.fromkeys(room_ids, 0)
+    for start in range(0, messages, batch_size):
+        batch = []
+        for _ in range(min(batch_size, messages - start)):
+            room_id = rng.choice(room_ids)
+            next_seq[room_id] += 1
+            content = " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 25)))
+            batch.append(Message(room_id=room_id, user=user, content=content, seq=next_seq[room_id]))
+        # The search_vector trigger fills in every row as it is inserted
+        Message.objects.bulk_create(batch)
+    with connection.cursor() as cursor:
+        cursor.execute("ANALYZE chat_message")
+
+
+def timed(queryset, repeat):
+    from django.db import connection
+
+    times = []
+    rows = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        rows = list(queryset)
+        times.append(time.perf_counter() - started)
+    with connection.cursor() as cursor:
+        sql, params = queryset.query.sql_with_params()
+        cursor.execute("EXPLAIN " + sql, params)
+        plan = "\n".join(row[0] for row in cursor.fetchall())
+    times.sort()
+    return {
+        "median_ms": times[len(times) // 2] * 1000,
+        "max_ms": times[-1] * 1000,
+        "rows": len(rows),
+        "uses_search_index": "chat_message_search_gin" in plan,
+    }
+
+
+def run(terms, repeat, page_size):
+    from chat.models import Message
+
+    for term in terms:
+        naive = Message.objects.filter(content__icontains=term).order_by("-id")
+        indexed = Message.objects.search(term).order_by("-rank", "-id")
+        yield {
+            "query": term,
+            "matches": indexed.count(),
+            "ilike_scan": timed(naive[:page_size], repeat),
+            "full_text": timed(indexed[:page_size], repeat),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--messages", type=int, default=200000)
+    parser.add_argument("--rooms", type=int, default=50)
+    parser.add_argument("--queries", nargs="+", default=["deploy", "rollback incident", "holiday"])
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per query")
+    parser.add_argument("--page-size", type=int, default=20)
+    args = parser.parse_args()
+
+    setup()
+
+    from django.db import connection
+    from django.test.utils import setup_databases, teardown_databases
+
+    if connection.vendor != "postgresql":
+        parser.error("full-text search needs the configured PostgreSQL database")
+
+    old_config = setup_databases(verbosity=0, interactive=False)
+    try:
+        started = time.perf_counter()
+        create_fixtures(args.messages, args.rooms)
+        print(json.dumps({"messages": args.messages, "rooms": args.rooms, "load_seconds": time.perf_counter() - started}))
+        for result in run(args.queries, args.repeat, args.page_size):
+            print(json.dumps(result))
+    finally:
+        teardown_databases(old_config, verbosity=0)
+
+
+if __name__ == "__main__":
+    main()
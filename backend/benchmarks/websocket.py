@@ -0,0 +1,192 @@
+"""
+End-to-end load test of the WebSocket chat path.
+
+Drives ``chat_project.asgi.application`` with many ``WebsocketCommunicator``
+clients authenticated by access tokens, over an in-memory channel layer and a
+throwaway test database. ``--sqlite`` swaps the configured database for an
+in-memory SQLite one; presence and history still need the configured Redis.
+
+For every room size it connects ``--rooms`` full rooms, sends ``--messages``
+messages per room at ``--rate`` messages per second, and waits for every member
+to receive every message. It prints one JSON object per room size with connect
+times, send-to-deliver latency percentiles, throughput and database queries per
+message.
+
+    python -m benchmarks.websocket --sqlite --room-sizes 10 50 200 --rate 50
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from . import setup
+
+IN_MEMORY_LAYER = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer", "CONFIG": {"capacity": 10000}}}
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, round(pct / 100 * (len(values) - 1)))]
+
+
+def summarize(values, scale=1000):
+    """p50/p99/max of ``values`` in milliseconds."""
+    return {
+        "p50": percentile(values, 50) * scale if values else None,
+        "p99": percentile(values, 99) * scale if values else None,
+        "max": max(values) * scale if values else None,
+    }
+
+
+class QueryCounter:
+    """``execute_wrapper`` counting every query run on a connection."""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def create_fixtures(rooms, size):
+    """Create ``rooms`` rooms of ``size`` members; returns ``[(room_id, [token, ...]), ...]``."""
+    from django.contrib.auth.models import User
+
+    from chat.models import Room
+    from chat.serializers import CustomTokenObtainPairSerializer
+
+    stamp = time.monotonic_ns()
+    fixtures = []
+    for room_index in range(rooms):
+        users = [User(username=f"bench-{stamp}-{room_index}-{i}") for i in range(size)]
+        for user in users:
+            user.set_unusable_password()
+        users = User.objects.bulk_create(users)
+        room = Room.objects.create(name=f"Bench {stamp} {room_index}", created_by=users[0])
+        tokens = [str(CustomTokenObtainPairSerializer.get_token(user).access_token) for user in users]
+        fixtures.append((room.id, tokens))
+    return fixtures
+
+
+async def run(fixtures, messages, rate, timeout):
+    from channels.db import database_sync_to_async
+    from channels.testing import WebsocketCommunicator
+    from django.db import connection
+
+    from chat import persistence, presence, redis_client
+    from chat_project.asgi import application
+
+    connect_times = []
+
+    async def connect(room_id, token):
+        communicator = WebsocketCommunicator(application, f"/ws/chat/{room_id}/?token={token}")
+        started = time.perf_counter()
+        connected, _ = await communicator.connect(timeout=timeout)
+        connect_times.append(time.perf_counter() - started)
+        if not connected:
+            raise RuntimeError(f"Connection to room {room_id} was rejected")
+        return communicator
+
+    rooms = []
+    for room_id, tokens in fixtures:
+        clients = await asyncio.gather(*(connect(room_id, token) for token in tokens))
+        rooms.append((room_id, clients))
+
+    # Database work runs on the thread shared by database_sync_to_async
+    counter = QueryCounter()
+    await database_sync_to_async(lambda: connection.execute_wrappers.append(counter))()
+
+    sent_at = {}
+    latencies = []
+    lost = 0
+
+    async def listen(client):
+        nonlocal lost
+        received = 0
+        while received < messages:
+            try:
+                frame = json.loads(await client.receive_from(timeout=timeout))
+            except asyncio.TimeoutError:
+                lost += messages - received
+                return
+            # Clients that fall behind get several messages in one batch frame
+            for item in frame["messages"] if frame.get("type") == "batch" else [frame]:
+                if "message" in item and item["message"] in sent_at:
+                    latencies.append(time.perf_counter() - sent_at[item["message"]])
+                    received += 1
+
+    async def talk(room_id, clients):
+        for seq in range(messages):
+            body = f"bench:{room_id}:{seq}"
+            sent_at[body] = time.perf_counter()
+            await clients[seq % len(clients)].send_json_to({"message": body})
+            await asyncio.sleep(1 / rate)
+
+    started = time.perf_counter()
+    listeners = [asyncio.ensure_future(listen(client)) for _, clients in rooms for client in clients]
+    await asyncio.gather(*(talk(room_id, clients) for room_id, clients in rooms))
+    await asyncio.gather(*listeners)
+    await persistence.shutdown()
+    elapsed = time.perf_counter() - started
+    await database_sync_to_async(lambda: connection.execute_wrappers.remove(counter))()
+
+    await asyncio.gather(*(client.disconnect() for _, clients in rooms for client in clients))
+    await presence.shutdown()
+    await redis_client.shutdown()
+
+    sent = messages * len(rooms)
+    return {
+        "connect_ms": summarize(connect_times),
+        "latency_ms": summarize(latencies),
+        "messages_per_sec": sent / elapsed,
+        "deliveries_per_sec": len(latencies) / elapsed,
+        "lost_deliveries": lost,
+        "queries_per_message": counter.count / sent,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--room-sizes", type=int, nargs="+", default=[10, 50])
+    parser.add_argument("--rooms", type=int, default=2)
+    parser.add_argument("--messages", type=int, default=20, help="messages per room")
+    parser.add_argument("--rate", type=float, default=20, help="messages per second per room")
+    parser.add_argument("--timeout", type=float, default=30, help="seconds to wait for a frame")
+    parser.add_argument("--sqlite", action="store_true", help="use an in-memory SQLite database")
+    args = parser.parse_args()
+
+    from django.conf import settings
+
+    if args.sqlite:
+        settings.DATABASES["default"] = {"ENGINE": "django.db.backends.sqlite3", "NAME": ":memory:"}
+    setup()
+
+    from django.test.utils import override_settings, setup_databases, teardown_databases
+
+    old_config = setup_databases(verbosity=0, interactive=False)
+    try:
+        with override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYER):
+            for size in args.room_sizes:
+                fixtures = create_fixtures(args.rooms, size)
+                result = asyncio.run(run(fixtures, args.messages, args.rate, args.timeout))
+                print(
+                    json.dumps(
+                        {
+                            "room_size": size,
+                            "rooms": args.rooms,
+                            "messages_per_room": args.messages,
+                            "rate": args.rate,
+                            "writer_mode": settings.CHAT_MESSAGE_WRITER["MODE"],
+                            **result,
+                        }
+                    )
+                )
+    finally:
+        teardown_databases(old_config, verbosity=0)
+
+
+if __name__ == "__main__":
+    main()
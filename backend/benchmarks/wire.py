@@ -0,0 +1,72 @@
+"""
+Bytes on the wire per delivered chat message, JSON text frames vs MessagePack.
+
+Replays ``--messages`` messages from ``--users`` distinct senders arriving in
+bursts of ``--burst`` (messages that land within one batching window) and
+encodes them for one member socket. JSON sends a text frame per message;
+MessagePack batches each burst into one frame and names every sender once.
+Frame sizes include the server-to-client WebSocket frame header.
+
+    python -m benchmarks.wire --users 20 --burst 1 5 20
+"""
+import argparse
+import json
+
+from . import setup
+
+
+def ws_header_size(length):
+    return 2 if length < 126 else 4 if length < 0x10000 else 10
+
+
+def _json(messages):
+    from chat import encoding
+
+    frames = [encoding.dumps({"message": m, "user_id": u, "username": n}) for u, n, m in messages]
+    return [frame.encode() for frame in frames]
+
+
+def _msgpack(messages, burst):
+    from chat import encoding
+
+    known = set()
+    frames = []
+    for start in range(0, len(messages), burst):
+        events = []
+        for user_id, username, message in messages[start : start + burst]:
+            if user_id not in known:
+                known.add(user_id)
+                events.append(encoding.pack([encoding.EVENT_USER, user_id, username]))
+            events.append(encoding.pack([encoding.EVENT_MESSAGE, user_id, message]))
+        frames.append(events[0] if len(events) == 1 else encoding.pack_batch(events))
+    return frames
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--messages", type=int, default=10000)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--length", type=int, default=40, help="characters per message")
+    parser.add_argument("--burst", type=int, nargs="+", default=[1, 5, 20])
+    args = parser.parse_args()
+
+    setup()
+    messages = [(1000 + i % args.users, f"user-{i % args.users}", "x" * args.length) for i in range(args.messages)]
+    for burst in args.burst:
+        for name, encode in (("json", _json), ("msgpack", lambda m: _msgpack(m, burst))):
+            frames = encode(messages)
+            size = sum(len(frame) + ws_header_size(len(frame)) for frame in frames)
+            print(
+                json.dumps(
+                    {
+                        "protocol": name,
+                        "burst": burst,
+                        "frames": len(frames),
+                        "bytes_per_message": size / args.messages,
+                    }
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,12 @@
 from django.contrib import admin
-from .models import Room, Message, UserProfile
+from django.contrib.postgres.search import SearchQuery
+from django.db.models import Q
+from .models import SEARCH_CONFIG, Room, Message, UserProfile
 
 
 @admin.register(Room)
 class RoomAdmin(admin.ModelAdmin):
-    list_display = ("name", "created_by", "created_at")
+    list_display = ("name", "created_by", "created_at", "message_count", "last_activity_at")
     search_fields = ("name", "created_by__username")
 
 
@@ -14,6 +16,14 @@ class MessageAdmin(admin.ModelAdmin):
     list_filter = ("room", "user")
     search_fields = ("content", "user__username")
 
+    def get_search_results(self, request, queryset, search_term):
+        # Content is matched through the full-text index instead of an ILIKE scan
+        # of every message; a username still finds all of that user's messages
+        if not search_term:
+            return queryset, False
+        query = SearchQuery(search_term, config=SEARCH_CONFIG, search_type="websearch")
+        return queryset.filter(Q(search_vector=query) | Q(user__username__iexact=search_term.strip())), False
+
 
 @admin.register(UserProfile)
 class UserProfileAdmin(admin.ModelAdmin):
@@ -4,3 +4,10 @@ from django.apps import AppConfig
 class ChatConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "chat"
+
+    def ready(self):
+        # Keeps the WebSocket user record cache in step with user updates
+        from . import auth  # noqa: F401
+
+        # Bumps room versions when rooms are saved or deleted
+        from . import history  # noqa: F401
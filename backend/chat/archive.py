@@ -0,0 +1,210 @@
+import gzip
+import logging
+import os
+import shutil
+from datetime import datetime, timedelta
+from functools import lru_cache
+from itertools import groupby
+from pathlib import Path
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import F
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
+
+from . import encoding, history
+from .models import ArchiveSegment, Message, Room
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - zstandard is optional
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+CODEC_ZSTD = "zstd"
+CODEC_GZIP = "gzip"
+EXTENSIONS = {CODEC_ZSTD: ".ndjson.zst", CODEC_GZIP: ".ndjson.gz"}
+
+
+def default_codec():
+    """Segments are written with zstd when zstandard is installed, gzip otherwise."""
+    return CODEC_ZSTD if zstandard is not None else CODEC_GZIP
+
+
+def compress(data, codec):
+    if codec == CODEC_ZSTD:
+        return zstandard.ZstdCompressor(level=10).compress(data)
+    return gzip.compress(data)
+
+
+def decompress(data, codec):
+    if codec == CODEC_ZSTD:
+        if zstandard is None:
+            raise RuntimeError("zstandard must be installed to read zstd archive segments")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return gzip.decompress(data)
+
+
+def root():
+    return Path(settings.CHAT_ARCHIVE["ROOT"])
+
+
+def month_of(timestamp):
+    return timestamp.date().replace(day=1)
+
+
+def segment_path(room_id, month, first_seq, last_seq, codec):
+    return f"{room_id}/{month:%Y-%m}/{first_seq}-{last_seq}{EXTENSIONS[codec]}"
+
+
+def write_segment(room_id, month, messages, codec=None):
+    """
+    Write ``messages`` of one room and month, oldest first, to a new segment file.
+
+    The file is complete and synced before it is renamed into place; returns the
+    unsaved :class:`ArchiveSegment` describing it.
+    """
+    codec = codec or default_codec()
+    seqs = [message.seq for message in messages]
+    path = segment_path(room_id, month, min(seqs), max(seqs), codec)
+    lines = "".join(encoding.dumps(history.to_entry(message, message.user.username)) + "\n" for message in messages)
+
+    target = root() / path
+    target.parent.mkdir(parents=True, exist_ok=True)
+    partial = target.with_name(target.name + ".partial")
+    with open(partial, "wb") as f:
+        f.write(compress(lines.encode(), codec))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(partial, target)
+
+    return ArchiveSegment(
+        room_id=room_id,
+        month=month,
+        path=path,
+        codec=codec,
+        message_count=len(messages),
+        first_seq=min(seqs),
+        last_seq=max(seqs),
+        first_timestamp=messages[0].timestamp,
+        last_timestamp=messages[-1].timestamp,
+    )
+
+
+def load_entries(path, codec):
+    """History entries of a segment, oldest first."""
+    data = decompress((root() / path).read_bytes(), codec)
+    return tuple(encoding.loads(line) for line in data.splitlines() if line)
+
+
+# Segments never change once written, so history reads keep recently decoded ones
+read_entries = lru_cache(maxsize=16)(load_entries)
+
+
+def to_message(entry):
+    """Unsaved :class:`Message` for an archived entry, enough to paginate and serialize it."""
+    return Message(
+        id=entry["id"],
+        room_id=entry["room"],
+        user=User(id=entry["user"]["id"], username=entry["user"]["username"]),
+        content=entry["content"],
+        timestamp=datetime.fromisoformat(entry["timestamp"]),
+        seq=entry["seq"],
+    )
+
+
+def read_segment(segment):
+    return [to_message(entry) for entry in read_entries(segment.path, segment.codec)]
+
+
+def _key(message):
+    return message.timestamp, message.pk
+
+
+class RoomArchive:
+    """
+    A room's archived history, read as unsaved messages ordered like the live table.
+
+    Every archived message is older than every live one, so a history page that
+    runs out of live rows carries on here.
+    """
+
+    def __init__(self, room):
+        self.room = room
+
+    def before(self, boundary, limit):
+        """Up to ``limit`` messages older than ``(timestamp, id)``, or the newest ones if ``None``; newest first."""
+        if self.room.archived_through is None:
+            return []
+        segments = ArchiveSegment.objects.filter(room=self.room).order_by("-last_timestamp", "-id")
+        if boundary is not None:
+            segments = segments.filter(first_timestamp__lte=boundary[0])
+        rows = []
+        for segment in segments.iterator():
+            rows.extend(m for m in read_segment(segment) if boundary is None or _key(m) < boundary)
+            if len(rows) >= limit:
+                break
+        rows.sort(key=_key, reverse=True)
+        return rows[:limit]
+
+    def after(self, boundary, limit):
+        """Up to ``limit`` messages newer than ``(timestamp, id)``; oldest first."""
+        if self.room.archived_through is None or self.room.archived_through < boundary[0]:
+            return []
+        segments = ArchiveSegment.objects.filter(room=self.room, last_timestamp__gte=boundary[0]).order_by(
+            "last_timestamp", "id"
+        )
+        rows = []
+        for segment in segments.iterator():
+            rows.extend(m for m in read_segment(segment) if _key(m) > boundary)
+            if len(rows) >= limit:
+                break
+        rows.sort(key=_key)
+        return rows[:limit]
+
+
+def archive_room(room_id, cutoff, batch_size):
+    """Move a room's messages older than ``cutoff`` into new segments; returns how many moved."""
+    archived = 0
+    while True:
+        batch = list(
+            Message.objects.filter(room_id=room_id, timestamp__lt=cutoff)
+            .select_related("user")
+            .only("id", "room_id", "content", "timestamp", "seq", "user__id", "user__username")
+            .order_by("timestamp", "id")[:batch_size]
+        )
+        for month, messages in groupby(batch, key=lambda message: month_of(message.timestamp)):
+            messages = list(messages)
+            segment = write_segment(room_id, month, messages)
+            # A crash before this commits leaves an unregistered file that the next run overwrites
+            with transaction.atomic():
+                segment.save()
+                Message.objects.filter(pk__in=[message.pk for message in messages]).delete()
+                newest = segment.last_timestamp
+                Room.objects.filter(pk=room_id).update(
+                    archived_through=Greatest(Coalesce(F("archived_through"), newest), newest)
+                )
+            archived += len(messages)
+        if len(batch) < batch_size:
+            break
+    if archived:
+        history.invalidate(room_id)
+        logger.info("Archived %d messages of room %s", archived, room_id)
+    return archived
+
+
+def archive_messages(older_than_days=None, batch_size=None):
+    """Archive every room's messages older than the configured age; returns ``{room_id: count}``."""
+    config = settings.CHAT_ARCHIVE
+    cutoff = timezone.now() - timedelta(days=config["AFTER_DAYS"] if older_than_days is None else older_than_days)
+    batch_size = batch_size or config["BATCH_SIZE"]
+    room_ids = Message.objects.filter(timestamp__lt=cutoff).order_by().values_list("room_id", flat=True).distinct()
+    return {room_id: archive_room(room_id, cutoff, batch_size) for room_id in list(room_ids)}
+
+
+def remove_room(room_id):
+    """Delete a room's segment files; their rows go with the room."""
+    shutil.rmtree(root() / str(room_id), ignore_errors=True)
@@ -0,0 +1,165 @@
+"""
+Async implementations of the hottest read endpoints.
+
+``GET /api/rooms/``, ``GET /api/rooms/<id>/messages/`` and ``GET /api/users/me/``
+run on the event loop with the URLs and response bodies of their DRF
+viewsets, which keep serving every other method. DRF views are synchronous,
+so under ASGI each of their requests holds a worker thread for its whole
+duration; here a history page served from Redis never leaves the loop, and a
+database page costs one thread hop per query instead. Rows are read with
+``values()`` or ``only()`` and turned into dicts directly, without serializers.
+Rooms and history answer conditional requests as described in
+:mod:`chat.conditional`.
+"""
+import functools
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.http import HttpResponse
+from rest_framework import exceptions, serializers
+from rest_framework.request import Request
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+
+from . import archive, auth, conditional, encoding, history, metrics, routers
+from .models import Message, Room
+from .pagination import MessageCursorPagination, RoomPagination
+from .views import RoomViewSet, UserViewSet
+
+ROOM_FIELDS = (
+    "id",
+    "name",
+    "created_at",
+    "created_by_id",
+    "created_by__username",
+    "message_count",
+    "last_message_preview",
+    "last_activity_at",
+)
+
+_datetime = serializers.DateTimeField()
+
+
+def json_response(data, status=200, headers=None):
+    return HttpResponse(encoding.dumps(data), content_type="application/json", status=status, headers=headers)
+
+
+def api_view(func):
+    """Wrap the request for DRF's query parsing and turn API exceptions into DRF-shaped error responses."""
+
+    @functools.wraps(func)
+    async def wrapper(request, *args, **kwargs):
+        try:
+            return await func(Request(request), *args, **kwargs)
+        except exceptions.APIException as exc:
+            headers = None
+            if isinstance(exc, (exceptions.NotAuthenticated, exceptions.AuthenticationFailed)):
+                headers = {"WWW-Authenticate": f'{jwt_settings.AUTH_HEADER_TYPES[0]} realm="api"'}
+            data = exc.detail if isinstance(exc.detail, (list, dict)) else {"detail": exc.detail}
+            return json_response(data, exc.status_code, headers)
+
+    return wrapper
+
+
+async def authenticate(request):
+    """
+    The request's user, from its bearer token.
+
+    Tokens are checked the way WebSocket handshakes check them (see
+    :func:`chat.auth.authenticate`), so most requests need no user query.
+    """
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    if scheme not in jwt_settings.AUTH_HEADER_TYPES or not token.strip():
+        raise exceptions.NotAuthenticated()
+    user = await auth.authenticate(token.strip())
+    if not user.is_authenticated:
+        raise exceptions.AuthenticationFailed("Given token not valid for any token type")
+    await routers.astick_if_recent_writer(user.id)
+    return user
+
+
+def room_summary(row):
+    """:class:`~chat.serializers.RoomSummarySerializer` output for a ``values(*ROOM_FIELDS)`` row."""
+    return {
+        "id": row["id"],
+        "name": row["name"],
+        "created_at": _datetime.to_representation(row["created_at"]),
+        "created_by": {"id": row["created_by_id"], "username": row["created_by__username"]},
+        "message_count": row["message_count"],
+        "last_message_preview": row["last_message_preview"],
+        "last_activity_at": _datetime.to_representation(row["last_activity_at"]),
+    }
+
+
+@metrics.timed_async_view("RoomViewSet", "list")
+@api_view
+async def room_list(request):
+    await authenticate(request)
+    validators = await conditional.avalidators()
+    response = conditional.not_modified(request, validators)
+    if response is not None:
+        return conditional.finish(response, validators)
+    rooms = Room.objects.filter(deleted_at__isnull=True).order_by("-last_activity_at", "-id").values(*ROOM_FIELDS)
+    data = await RoomPagination().apaginate(rooms, request)
+    data["results"] = [room_summary(row) for row in data["results"]]
+    return conditional.finish(json_response(data), validators)
+
+
+@metrics.timed_async_view("RoomViewSet", "messages")
+@api_view
+async def room_messages(request, pk):
+    await authenticate(request)
+    validators = await conditional.avalidators(pk)
+    response = await conditional.anot_modified(request, validators, pk)
+    if response is not None:
+        return conditional.finish(response, validators)
+    room = await Room.objects.filter(pk=pk, deleted_at__isnull=True).only("id", "archived_through").afirst()
+    if room is None:
+        raise exceptions.NotFound()
+    paginator = MessageCursorPagination()
+
+    buffer = history.HistoryBuffer(room.id) if paginator.is_newest_page(request) else None
+    if buffer is not None:
+        cached = await buffer.arecent(paginator.get_page_size(request))
+        if cached is not None:
+            return conditional.finish(json_response(paginator.get_buffered_data(*cached)), validators)
+
+    messages = (
+        Message.objects.filter(room=room)
+        .select_related("user")
+        .only("id", "room_id", "content", "timestamp", "seq", "user__id", "user__username")
+    )
+    page = await paginator.apaginate_queryset(messages, request, archive=archive.RoomArchive(room))
+    entries = [history.to_entry(message, message.user.username) for message in page]
+    # A lagging replica can miss messages already pushed to Redis; only the primary primes
+    if buffer is not None and not routers.reading_from_replica():
+        await sync_to_async(buffer.prime)(entries, complete=not paginator.has_older)
+    return conditional.finish(json_response(paginator.get_paginated_data(entries)), validators)
+
+
+@metrics.timed_async_view("UserViewSet", "me")
+@api_view
+async def me(request):
+    user = await authenticate(request)
+    row = await User.objects.filter(pk=user.id).values("id", "username", "email").afirst()
+    if row is None:
+        raise exceptions.AuthenticationFailed("User not found")
+    return json_response(row)
+
+
+def get_or_drf(get_view, drf_view):
+    """Serve GET with ``get_view`` and every other method with the DRF view that owns the URL."""
+
+    async def view(request, *args, **kwargs):
+        if request.method == "GET":
+            return await get_view(request, *args, **kwargs)
+        return await sync_to_async(drf_view)(request, *args, **kwargs)
+
+    # DRF views enforce CSRF themselves, for session authentication only; csrf_exempt
+    # would wrap this coroutine function in a synchronous one
+    view.csrf_exempt = True
+    return view
+
+
+rooms = get_or_drf(room_list, RoomViewSet.as_view({"get": "list", "post": "create"}, basename="room", detail=False))
+room_history = get_or_drf(room_messages, RoomViewSet.as_view({"get": "messages"}, basename="room", detail=True))
+users_me = get_or_drf(me, UserViewSet.as_view({"get": "me"}, basename="user", detail=False))
@@ -0,0 +1,201 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from redis.exceptions import RedisError
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+from . import routers
+from .redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+MODE_CLAIMS = "claims"
+MODE_DB = "db"
+
+USERNAME_CLAIM = "username"
+
+
+def disabled_key(user_id):
+    # Set while tokens issued before a deactivation or deletion may still be valid
+    return f"auth:disabled:{int(user_id)}"
+
+
+class ChatUser:
+    """Lightweight authenticated user for WebSocket scopes, built without a model instance."""
+
+    __slots__ = ("id", "username")
+
+    is_authenticated = True
+    is_anonymous = False
+    is_active = True
+
+    def __init__(self, id, username):
+        self.id = id
+        self.username = username
+
+    @property
+    def pk(self):
+        return self.id
+
+    def __eq__(self, other):
+        return getattr(other, "pk", None) == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __str__(self):
+        return self.username
+
+
+class UserRecordCache:
+    """Bounded LRU of ``user_id -> (username, is_active)`` whose entries expire after ``ttl`` seconds."""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._records = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._records.get(user_id)
+            if entry is None:
+                return None
+            expires_at, record = entry
+            if expires_at < time.monotonic():
+                del self._records[user_id]
+                return None
+            self._records.move_to_end(user_id)
+            return record
+
+    def set(self, user_id, record):
+        with self._lock:
+            self._records[user_id] = (time.monotonic() + self.ttl, record)
+            self._records.move_to_end(user_id)
+            while len(self._records) > self.max_size:
+                self._records.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._records.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._records.clear()
+
+
+user_records = UserRecordCache(
+    max_size=settings.CHAT_WS_AUTH["CACHE_SIZE"],
+    ttl=settings.CHAT_WS_AUTH["CACHE_TTL"],
+)
+
+
+def load_user_record(user_id):
+    User = get_user_model()
+    user = User.objects.only("id", "username", "is_active").get(pk=user_id)
+    return user.username, user.is_active
+
+
+async def get_user_record(user_id):
+    record = user_records.get(user_id)
+    if record is None:
+        record = await database_sync_to_async(load_user_record)(user_id)
+        user_records.set(user_id, record)
+    return record
+
+
+async def is_disabled(user_id):
+    """Whether any process deactivated or deleted the user within an access token's lifetime."""
+    try:
+        return bool(await get_redis().exists(disabled_key(user_id)))
+    except RedisError as exc:
+        logger.warning("Disabled users unavailable: %s", exc)
+        return False
+
+
+async def authenticate(raw_token):
+    """
+    Resolve the user of a WebSocket handshake or async API request from a raw access token.
+
+    Only the token's signature and expiry are checked in-process. In ``claims``
+    mode the user comes from the record cache when it holds one, otherwise from
+    the token's claims, and only tokens issued without a username claim fall
+    back to the database; users deactivated or deleted by any process are
+    refused through a short-lived Redis marker. In ``db`` mode every handshake
+    loads the user.
+    """
+    if not raw_token:
+        return AnonymousUser()
+    try:
+        token = AccessToken(raw_token)
+        user_id = token[jwt_settings.USER_ID_CLAIM]
+    except (TokenError, KeyError) as exc:
+        logger.warning("Rejected access token: %s", exc)
+        return AnonymousUser()
+
+    if settings.CHAT_WS_AUTH["MODE"] == MODE_DB:
+        User = get_user_model()
+        try:
+            user = await database_sync_to_async(User.objects.get)(pk=user_id)
+        except User.DoesNotExist:
+            return AnonymousUser()
+        return user if user.is_active else AnonymousUser()
+
+    if await is_disabled(user_id):
+        return AnonymousUser()
+    # A cached record reflects renames and deactivations seen by this process
+    record = user_records.get(user_id)
+    if record is None:
+        if USERNAME_CLAIM in token:
+            return ChatUser(user_id, token[USERNAME_CLAIM])
+        try:
+            record = await get_user_record(user_id)
+        except get_user_model().DoesNotExist:
+            return AnonymousUser()
+    username, is_active = record
+    return ChatUser(user_id, username) if is_active else AnonymousUser()
+
+
+class ReplicaAwareJWTAuthentication(JWTAuthentication):
+    """DRF JWT authentication that moves a user who wrote moments ago onto the primary before loading them."""
+
+    def get_user(self, validated_token):
+        routers.stick_if_recent_writer(validated_token.get(jwt_settings.USER_ID_CLAIM))
+        return super().get_user(validated_token)
+
+
+def _mark_disabled(user_id, disabled):
+    # Other processes never see this one's record cache; they check the marker instead
+    try:
+        client = cache.client.get_client()
+        if disabled:
+            client.set(disabled_key(user_id), 1, ex=int(jwt_settings.ACCESS_TOKEN_LIFETIME.total_seconds()))
+        else:
+            client.delete(disabled_key(user_id))
+    except RedisError as exc:
+        logger.warning("Could not record whether user %s is disabled: %s", user_id, exc)
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def refresh_user_record(sender, instance, **kwargs):
+    user_records.set(instance.pk, (instance.username, instance.is_active))
+    _mark_disabled(instance.pk, not instance.is_active)
+
+
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def forget_user_record(sender, instance, **kwargs):
+    # Keep a tombstone so tokens of the deleted user stop authenticating here
+    user_records.set(instance.pk, (instance.username, False))
+    _mark_disabled(instance.pk, True)
@@ -0,0 +1,151 @@
+"""
+HTTP validators for the room list, room details and room history.
+
+ETags are built from the per-room generation counters that
+:mod:`chat.history` bumps whenever a room's messages or the room itself
+change, plus one counter for the room list, so checking a client's
+``If-None-Match`` costs one Redis round trip. A room's 304 adds one primary
+key lookup, so a deleted room whose version was never bumped (Redis was down
+at the time) is not confirmed as current. An epoch stored next to the counters changes if Redis loses them,
+so validators handed out before can never match again.
+
+Responses are ``private, no-cache``: browsers keep them and revalidate every
+time, and nginx caches them with the ``Authorization`` header in its cache
+key (see ``nginx/nginx.conf``).
+"""
+import logging
+import secrets
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date
+from redis.exceptions import RedisError
+
+from . import history, routers
+from .models import Room
+from .redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+EPOCH_KEY = "history:epoch"
+
+VARY = ("Accept", "Authorization")
+
+
+class Validators:
+    """The ETag and Last-Modified time of one version of a resource."""
+
+    __slots__ = ("etag", "last_modified")
+
+    def __init__(self, etag, last_modified):
+        self.etag = etag
+        self.last_modified = last_modified
+
+    def apply(self, response):
+        response["ETag"] = self.etag
+        if self.last_modified is not None:
+            response["Last-Modified"] = http_date(self.last_modified)
+
+
+def _keys(room_id):
+    if room_id is None:
+        return history.ROOMS_GENERATION_KEY, history.ROOMS_FIELD
+    return history.generation_key(room_id), room_id
+
+
+def _validators(room_id, epoch, generation, modified):
+    modified = int(modified) if modified is not None else None
+    if (
+        modified is not None
+        and routers.reading_from_replica()
+        and time.time() - modified < settings.CHAT_DB["STICKY_SECONDS"]
+    ):
+        # The replica may not have the change yet; what it returns must not be stored as the new version
+        return None
+    scope = "rooms" if room_id is None else f"room-{room_id}"
+    return Validators(f'W/"{scope}.{epoch.decode()}.{int(generation or 0)}"', modified)
+
+
+def validators(room_id=None):
+    """
+    Validators of the room list, or of a room's details and history when ``room_id`` is given.
+
+    Read them before the data they describe: a change landing in between then
+    only makes the response newer than its validators, never older. None when
+    Redis is unavailable or a replica may be behind.
+    """
+    client = cache.client.get_client()
+    generation_key, field = _keys(room_id)
+    try:
+        pipe = client.pipeline(transaction=False)
+        pipe.get(EPOCH_KEY)
+        pipe.get(generation_key)
+        pipe.hget(history.MODIFIED_KEY, field)
+        epoch, generation, modified = pipe.execute()
+        if epoch is None:
+            client.set(EPOCH_KEY, secrets.token_hex(4), nx=True)
+            epoch = client.get(EPOCH_KEY)
+    except RedisError as exc:
+        logger.warning("Room versions unavailable: %s", exc)
+        return None
+    return _validators(room_id, epoch, generation, modified)
+
+
+async def avalidators(room_id=None):
+    """:func:`validators` on the event loop's asyncio Redis client."""
+    client = get_redis()
+    generation_key, field = _keys(room_id)
+    try:
+        async with client.pipeline(transaction=False) as pipe:
+            pipe.get(EPOCH_KEY)
+            pipe.get(generation_key)
+            pipe.hget(history.MODIFIED_KEY, field)
+            epoch, generation, modified = await pipe.execute()
+        if epoch is None:
+            await client.set(EPOCH_KEY, secrets.token_hex(4), nx=True)
+            epoch = await client.get(EPOCH_KEY)
+    except RedisError as exc:
+        logger.warning("Room versions unavailable: %s", exc)
+        return None
+    return _validators(room_id, epoch, generation, modified)
+
+
+def _live_room(room_id):
+    # Ids come straight from the URL; one that is not a number names no room
+    return Room.objects.filter(pk=room_id if str(room_id).isdigit() else None, deleted_at__isnull=True)
+
+
+def not_modified(request, validators, room_id=None):
+    """
+    A 304 (or 412) response if the request's preconditions say so, else None.
+
+    With ``room_id``, only while the room exists and is not being deleted;
+    otherwise the view runs and answers 404.
+    """
+    if validators is None:
+        return None
+    response = get_conditional_response(request, etag=validators.etag, last_modified=validators.last_modified)
+    if response is not None and room_id is not None and not _live_room(room_id).exists():
+        return None
+    return response
+
+
+async def anot_modified(request, validators, room_id=None):
+    """:func:`not_modified` with the room lookup made from the event loop."""
+    if validators is None:
+        return None
+    response = get_conditional_response(request, etag=validators.etag, last_modified=validators.last_modified)
+    if response is not None and room_id is not None and not await _live_room(room_id).aexists():
+        return None
+    return response
+
+
+def finish(response, validators):
+    """Add the validators and the caching headers shared by every conditional response."""
+    if validators is not None and response.status_code in (200, 304):
+        validators.apply(response)
+    patch_cache_control(response, private=True, no_cache=True)
+    patch_vary_headers(response, VARY)
+    return response
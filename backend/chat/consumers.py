@@ -1,101 +1,348 @@
+import asyncio
 import json
 import logging
-from channels.generic.websocket import AsyncWebsocketConsumer
+import time
+from contextlib import suppress
+from urllib.parse import parse_qs
 from channels.db import database_sync_to_async
-from .models import Room, Message
-from django.contrib.auth.models import User
-from django.core.cache import cache
+from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
+from . import encoding, history, metrics, persistence, unread
+from .models import Room
+from .outbound import Outbox, batch_frame
+from .presence import get_presence
+from .ratelimit import get_bucket
 
 logger = logging.getLogger(__name__)
 
+# WebSocket close code for a connection that failed on the server side
+INTERNAL_ERROR = 1011
+
+# Longest room id accepted from clients; larger ones cannot be a bigint primary key
+MAX_ROOM_ID_DIGITS = 18
+
+
+def parse_room_id(value):
+    """A room id from a URL or frame as a positive int, or None if it cannot be one."""
+    if isinstance(value, int) and not isinstance(value, bool):
+        room_id = value
+    elif isinstance(value, str) and value.isdigit() and len(value) <= MAX_ROOM_ID_DIGITS:
+        room_id = int(value)
+    else:
+        return None
+    return room_id if 0 < room_id < 10**MAX_ROOM_ID_DIGITS else None
+
 
 class ChatConsumer(AsyncWebsocketConsumer):
+    """
+    One socket per room, at ``ws/chat/<room_id>/``.
+
+    ``rooms`` maps every room the socket receives to the highest seq already
+    sent by a ``?since=`` replay; broadcasts up to it are skipped.
+    """
+
+    binary = False
+
     async def connect(self):
-        self.room_id = self.scope["url_route"]["kwargs"]["room_id"]
-        self.room_group_name = f"chat_{self.room_id}"
+        self.room_id = parse_room_id(self.scope["url_route"]["kwargs"]["room_id"])
         self.user_id = self.scope["user"].id
+        self.rooms = {}
+        if self.room_id is None:
+            await self.close()
+            return
 
-        logger.info(f"User {self.user_id} connected to room {self.room_id}")
+        logger.debug("User %s connected to room %s", self.user_id, self.room_id)
 
-        # Join room group
-        await self.channel_layer.group_add(self.room_group_name, self.channel_name)
-        await self.accept()
+        self.open_outbox()
+        await self.accept(subprotocol=encoding.SUBPROTOCOL_MSGPACK if self.binary else None)
+        self.outbox_task = asyncio.ensure_future(self.outbox.run())
 
-        # Add user to Redis set and broadcast
-        await self.add_online_user(self.room_id, self.user_id)
-        await self.broadcast_online_users_count()
+        # A reconnecting client gets only the messages it missed
+        since = parse_qs(self.scope["query_string"].decode()).get("since", [""])[0]
+        await self.join(self.room_id, int(since) if since.isdigit() else None)
 
     async def disconnect(self, close_code):
-        logger.info(f"User {self.user_id} disconnecting from room {self.room_id} with code {close_code}")
+        logger.debug("User %s disconnecting from room %s with code %s", self.user_id, self.room_id, close_code)
+        if hasattr(self, "outbox_task"):
+            self.outbox_task.cancel()
+        for room_id in list(getattr(self, "rooms", ())):
+            await self.leave(room_id)
+
+    def open_outbox(self):
+        # Clients that ask for it get MessagePack frames with interned usernames,
+        # batched over a short window; everyone else keeps JSON text frames
+        self.binary = encoding.SUBPROTOCOL_MSGPACK in self.scope.get("subprotocols", ())
+        self.known_users = set()
+
+        # Frames reach the socket through a bounded queue drained by its own task,
+        # so a slow client cannot stall this consumer's channel layer handlers
+        config = settings.CHAT_OUTBOUND
+        options = {
+            "max_size": config["MAX_QUEUE"],
+            "max_batch": config["MAX_BATCH"],
+            "policy": config["POLICY"],
+            "on_error": self.outbox_failed,
+        }
+        if self.binary:
+            options.update(batch=encoding.pack_batch, window=config["BATCH_WINDOW"])
+        self.outbox = Outbox(self.send_frame, **options)
 
-        # Leave room group
-        await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+    async def outbox_failed(self):
+        with suppress(Exception):
+            await self.close(code=INTERNAL_ERROR)
 
-        # Remove user from Redis set and broadcast
-        await self.remove_online_user(self.room_id, self.user_id)
-        await self.broadcast_online_users_count()
+    async def join(self, room_id, since=None):
+        """Start receiving a room's broadcasts, replaying what came after ``since`` first."""
+        await self.channel_layer.group_add(f"chat_{room_id}", self.channel_name)
+        self.rooms[room_id] = 0
+        metrics.active_connections.inc(room_id, metrics.PID)
 
-    async def receive(self, text_data):
-        text_data_json = json.loads(text_data)
-        message = text_data_json["message"]
-        user_id = text_data_json["user_id"]
+        # Register the connection; the room hears about it through a debounced broadcast,
+        # this socket gets the current count straight away
+        if self.scope["user"].is_authenticated:
+            count = await get_presence().join(room_id, self.channel_name, self.user_id)
+            self.outbox.put_presence(self.tag(room_id, self.presence_frame(count)), room_id)
 
-        # Get user information
-        user = await self.get_user(user_id)
+            # Live broadcasts are not dispatched until the current handler returns,
+            # so the replay always goes out first
+            if since is not None:
+                await self.replay(room_id, since)
+
+    async def leave(self, room_id):
+        del self.rooms[room_id]
+        metrics.active_connections.dec(room_id, metrics.PID)
+        await self.channel_layer.group_discard(f"chat_{room_id}", self.channel_name)
+
+        # Drop the connection; the user stays online while they have other sockets here
+        if self.scope["user"].is_authenticated:
+            await get_presence().leave(room_id, self.channel_name)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        started = time.perf_counter()
+        payload = json.loads(text_data) if text_data is not None else encoding.unpack(bytes_data)
+        if payload.get("action") == "read":
+            await self.mark_read(self.room_id, payload.get("seq"))
+        elif await self.post(self.room_id, payload.get("message")):
+            metrics.receive_seconds.observe(time.perf_counter() - started)
+
+    async def mark_read(self, room_id, seq):
+        """Acknowledge that the client has shown the room's messages up to ``seq``."""
+        if self.scope["user"].is_authenticated and isinstance(seq, int) and seq > 0:
+            await unread.aadvance(self.user_id, room_id, seq)
+
+    async def post(self, room_id, message):
+        """
+        Save and broadcast a message from this socket's user; returns whether it went out.
+
+        A frame whose ``message`` is missing or not non-blank text gets an
+        ``invalid_message`` error instead.
+        """
+        # The sender is whoever authenticated the socket, not what the frame claims
+        user = self.scope["user"]
+        if not user.is_authenticated:
+            return False
+        if not isinstance(message, str) or not message.strip():
+            await self.send_frame(self.tag(room_id, self.error_frame("invalid_message")))
+            return False
+
+        allowed, retry_after = await get_bucket("MESSAGES").aconsume(user.id, room_id)
+        if not allowed:
+            await self.send_frame(self.tag(room_id, self.error_frame("rate_limited", round(retry_after, 3))))
+            return False
 
         # Save message to database
-        await self.save_message(user_id, message)
+        saved = await self.save_message(room_id, user, message)
 
-        # Send message to room group
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {"type": "chat_message", "message": message, "user_id": user_id, "username": user.username},
-        )
+        # Encode once here, in both wire formats; every member socket forwards one of them
+        event = self.message_event(room_id, user.id, user.username, message, saved.seq)
+        started = time.perf_counter()
+        await self.channel_layer.group_send(f"chat_{room_id}", event)
+        metrics.group_send_seconds.observe(time.perf_counter() - started, "chat_message")
+        return True
 
     async def chat_message(self, event):
-        message = event["message"]
-        user_id = event["user_id"]
-        username = event["username"]
-
-        # Send message to WebSocket
-        await self.send(text_data=json.dumps({"message": message, "user_id": user_id, "username": username}))
+        room_id = event.get("room", self.room_id)
+        if room_id not in self.rooms:
+            return
+        if event.get("seq", 0) and event["seq"] <= self.rooms[room_id]:
+            return
 
-    async def broadcast_online_users_count(self):
-        count = await self.get_online_users_count(self.room_id)
-        logger.info(f"Broadcasting online users count for room {self.room_id}: {count}")
-        await self.channel_layer.group_send(self.room_group_name, {"type": "online_users_count", "count": count})
+        # Queue the message for the WebSocket
+        frames = self.message_frames(event)
+        for index, frame in enumerate(frames):
+            # A user introduction must survive overflow: later queued frames only carry the id
+            if not self.outbox.put_message(self.tag(room_id, frame), pinned=index < len(frames) - 1):
+                await self.close(code=settings.CHAT_OUTBOUND["CLOSE_CODE"])
+                return
 
     async def online_users_count(self, event):
-        count = event["count"]
-        await self.send(text_data=json.dumps({"type": "online_users_count", "count": count}))
+        room_id = event.get("room", self.room_id)
+        if room_id not in self.rooms:
+            return
+        if self.binary:
+            count = event["count"] if "count" in event else json.loads(event["text"])["count"]
+            self.outbox.put_presence(self.tag(room_id, self.presence_frame(count)), room_id)
+            return
+        text = event.get("text")
+        if text is None:
+            text = self.presence_frame(event["count"])
+        self.outbox.put_presence(self.tag(room_id, text), room_id)
 
-    @database_sync_to_async
-    def save_message(self, user_id, message):
-        user = User.objects.get(id=user_id)
-        room = Room.objects.get(id=self.room_id)
-        Message.objects.create(user=user, room=room, content=message)
+    async def replay(self, room_id, since):
+        entries, truncated, source = await history.areplay(room_id, since, settings.CHAT_REPLAY["MAX_MESSAGES"])
+        metrics.replays.inc("resync" if truncated else source)
+        if truncated:
+            await self.send_frame(self.tag(room_id, self.resync_frame()))
+            return
+        if not entries:
+            return
+        frames = []
+        for entry in entries:
+            event = self.message_event(
+                room_id, entry["user"]["id"], entry["user"]["username"], entry["content"], entry["seq"]
+            )
+            frames.extend(self.tag(room_id, frame) for frame in self.message_frames(event))
+        await self.send_frame(encoding.pack_batch(frames) if self.binary else batch_frame(frames))
+        self.rooms[room_id] = entries[-1]["seq"]
 
-    @database_sync_to_async
-    def get_user(self, user_id):
-        return User.objects.get(id=user_id)
+    def tag(self, room_id, frame):
+        """Frames of a single-room socket need no room marker."""
+        return frame
 
-    @database_sync_to_async
-    def add_online_user(self, room_id, user_id):
-        key = f"online_users:{room_id}"
-        client = cache.client.get_client()
-        # Add user to the room (python set stored using key)
-        client.sadd(key, user_id)
+    @staticmethod
+    def message_event(room_id, user_id, username, message, seq):
+        return {
+            "type": "chat_message",
+            "room": room_id,
+            "text": encoding.dumps({"message": message, "user_id": user_id, "username": username, "seq": seq}),
+            "packed": encoding.pack([encoding.EVENT_MESSAGE, user_id, message, seq]),
+            "user_id": user_id,
+            "username": username,
+            "seq": seq,
+        }
 
-    @database_sync_to_async
-    def remove_online_user(self, room_id, user_id):
-        key = f"online_users:{room_id}"
-        client = cache.client.get_client()
-        # Remove user from the room
-        client.srem(key, user_id)
+    def message_frames(self, event):
+        if self.binary:
+            return self.packed_message(event)
+        text = event.get("text")
+        if text is None:
+            # Event from a process that predates pre-encoded broadcasts
+            text = encoding.dumps(
+                {"message": event["message"], "user_id": event["user_id"], "username": event["username"]}
+            )
+        return [text]
+
+    def packed_message(self, event):
+        packed = event.get("packed")
+        if packed is None:
+            # Event from a process that predates the MessagePack protocol
+            fields = json.loads(event["text"]) if "text" in event else event
+            packed = encoding.pack([encoding.EVENT_MESSAGE, fields["user_id"], fields["message"]])
+        else:
+            fields = event
+        frames = [packed]
+        if fields["user_id"] not in self.known_users:
+            # Usernames go out once per connection; later messages only carry the id
+            self.known_users.add(fields["user_id"])
+            frames.insert(0, encoding.pack([encoding.EVENT_USER, fields["user_id"], fields["username"]]))
+        return frames
+
+    def presence_frame(self, count):
+        if self.binary:
+            return encoding.pack([encoding.EVENT_PRESENCE, count])
+        return encoding.dumps({"type": "online_users_count", "count": count})
+
+    def resync_frame(self):
+        if self.binary:
+            return encoding.pack([encoding.EVENT_RESYNC])
+        return encoding.dumps({"type": "resync"})
+
+    def error_frame(self, code, retry_after=None):
+        if self.binary:
+            return encoding.pack([encoding.EVENT_ERROR, code, retry_after])
+        return encoding.dumps({"type": "error", "code": code, "retry_after": retry_after})
+
+    async def send_frame(self, frame):
+        if isinstance(frame, bytes):
+            await self.send(bytes_data=frame)
+        else:
+            await self.send(text_data=frame)
+
+    async def save_message(self, room_id, user, message):
+        started = time.perf_counter()
+        saved = await persistence.save_message(room_id, user, message)
+        metrics.save_message_seconds.observe(time.perf_counter() - started)
+        return saved
+
+
+class MultiplexChatConsumer(ChatConsumer):
+    """
+    One socket for many rooms, at ``ws/chat/``.
+
+    Authenticated clients manage their rooms with in-band commands::
+
+        {"action": "subscribe", "room": 5, "since": 120}
+        {"action": "unsubscribe", "room": 5}
+        {"action": "read", "room": 5, "seq": 130}
+        {"room": 5, "message": "hello"}
+
+    ``since`` is optional and works like the single-room ``?since=``. Every
+    frame sent back is tagged with its room by :func:`encoding.tag_room`;
+    room ids are ints, and frames naming something else, or a room that does
+    not exist, get an ``invalid_room`` error. A socket follows at most
+    ``MAX_ROOMS`` rooms.
+    """
+
+    async def connect(self):
+        self.room_id = None
+        self.user_id = self.scope["user"].id
+        self.rooms = {}
+        if not self.scope["user"].is_authenticated:
+            await self.close()
+            return
+
+        logger.debug("User %s connected to the multiplexed endpoint", self.user_id)
+
+        self.open_outbox()
+        await self.accept(subprotocol=encoding.SUBPROTOCOL_MSGPACK if self.binary else None)
+        self.outbox_task = asyncio.ensure_future(self.outbox.run())
+
+    async def receive(self, text_data=None, bytes_data=None):
+        started = time.perf_counter()
+        payload = json.loads(text_data) if text_data is not None else encoding.unpack(bytes_data)
+        room = payload.get("room")
+        room_id = parse_room_id(room)
+        action = payload.get("action")
+        if room in (None, ""):
+            await self.send_frame(self.error_frame("room_required"))
+        elif room_id is None:
+            await self.send_frame(self.error_frame("invalid_room"))
+        elif action == "subscribe":
+            await self.subscribe(room_id, payload.get("since"))
+        elif action == "unsubscribe":
+            if room_id in self.rooms:
+                await self.leave(room_id)
+        elif room_id not in self.rooms:
+            await self.send_frame(self.tag(room_id, self.error_frame("not_subscribed")))
+        elif action == "read":
+            await self.mark_read(room_id, payload.get("seq"))
+        elif await self.post(room_id, payload.get("message")):
+            metrics.receive_seconds.observe(time.perf_counter() - started)
+
+    async def subscribe(self, room_id, since=None):
+        if room_id in self.rooms:
+            return
+        if len(self.rooms) >= settings.CHAT_MULTIPLEX["MAX_ROOMS"]:
+            await self.send_frame(self.tag(room_id, self.error_frame("too_many_rooms")))
+            return
+        if not await self.room_exists(room_id):
+            await self.send_frame(self.tag(room_id, self.error_frame("invalid_room")))
+            return
+        await self.join(room_id, since if isinstance(since, int) and since >= 0 else None)
 
     @database_sync_to_async
-    def get_online_users_count(self, room_id):
-        key = f"online_users:{room_id}"
-        client = cache.client.get_client()
-        # Returns number of users in a room (cardinality)
-        return client.scard(key)
+    def room_exists(self, room_id):
+        return Room.objects.filter(pk=room_id, deleted_at__isnull=True).exists()
+
+    def tag(self, room_id, frame):
+        return encoding.tag_room(room_id, frame)
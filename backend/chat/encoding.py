@@ -0,0 +1,76 @@
+import json
+
+import msgpack
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is optional
+    orjson = None
+
+
+def dumps(payload):
+    """Encode a WebSocket payload to JSON text, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(payload).decode()
+    return json.dumps(payload)
+
+
+def loads(data):
+    """Decode JSON text or bytes, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+# MessagePack protocol, negotiated with the "chat.msgpack.v1" subprotocol.
+#
+# Server frames hold either one event or an array of events, each event being
+# an array whose first element is its kind:
+#   [EVENT_USER, user_id, username]     introduces a user once per connection
+#   [EVENT_MESSAGE, user_id, message, seq]  chat message; the username comes from the intro
+#   [EVENT_PRESENCE, count]             online user count of the room
+#   [EVENT_ERROR, code, retry_after]    the client's last frame was rejected
+#   [EVENT_RESYNC]                      the ?since= gap is too long to replay; refetch history
+# Clients send {"message": ...} maps, in MessagePack or as JSON text.
+#
+# On the multiplexed endpoint every event is wrapped as [room_id, event]; see
+# tag_room for the JSON form.
+SUBPROTOCOL_MSGPACK = "chat.msgpack.v1"
+
+EVENT_USER = 0
+EVENT_MESSAGE = 1
+EVENT_PRESENCE = 2
+EVENT_ERROR = 3
+EVENT_RESYNC = 4
+
+
+def pack(event):
+    return msgpack.packb(event)
+
+
+def unpack(data):
+    return msgpack.unpackb(data)
+
+
+def pack_batch(frames):
+    """Wrap already-packed events in one MessagePack array without re-encoding them."""
+    count = len(frames)
+    if count < 16:
+        header = bytes((0x90 | count,))
+    elif count < 0x10000:
+        header = b"\xdc" + count.to_bytes(2, "big")
+    else:
+        header = b"\xdd" + count.to_bytes(4, "big")
+    return header + b"".join(frames)
+
+
+def tag_room(room_id, frame):
+    """
+    Mark a frame as belonging to a room, for connections subscribed to several.
+
+    JSON objects gain a leading "room" key and MessagePack events become
+    ``[room_id, event]``; either way the frame itself is not re-encoded.
+    """
+    if isinstance(frame, bytes):
+        return b"\x92" + pack(room_id) + frame
+    return '{"room":' + dumps(room_id) + "," + frame[1:]
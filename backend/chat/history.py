@@ -0,0 +1,301 @@
+import json
+import logging
+import time
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from redis.exceptions import RedisError, WatchError
+from rest_framework import serializers
+
+from .models import Message, Room
+from .redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+HITS_KEY = "history:hits"
+MISSES_KEY = "history:misses"
+
+# Bumped with every room's generation and whenever a room is created or changed
+ROOMS_GENERATION_KEY = "history:rooms:gen"
+
+# Unix time of each room's last change, and of the room list's under ROOMS_FIELD
+MODIFIED_KEY = "history:modified"
+ROOMS_FIELD = "rooms"
+
+# Marks the oldest end of a buffer that holds the room's complete history
+COMPLETE = "__complete__"
+
+_timestamp_field = serializers.DateTimeField()
+
+
+def buffer_key(room_id):
+    # Entries gained "seq"; buffers under the old key are left to expire
+    return f"history:{room_id}:entries"
+
+
+def generation_key(room_id):
+    return f"history:{room_id}:gen"
+
+
+def to_entry(message, username):
+    """Build the history representation of ``message`` without loading its user."""
+    return {
+        "id": message.pk,
+        "room": int(message.room_id),
+        "user": {"id": message.user_id, "username": username},
+        "content": message.content,
+        "timestamp": _timestamp_field.to_representation(message.timestamp),
+        "seq": message.seq,
+    }
+
+
+def _queue_touch(pipe, room_id):
+    # The generations double as the versions HTTP validators are built from (see chat.conditional)
+    now = int(time.time())
+    pipe.incr(generation_key(room_id))
+    pipe.incr(ROOMS_GENERATION_KEY)
+    pipe.hset(MODIFIED_KEY, mapping={room_id: now, ROOMS_FIELD: now})
+
+
+def _queue_push(pipe, room_id, entries):
+    config = settings.CHAT_HISTORY_BUFFER
+    key = buffer_key(room_id)
+    _queue_touch(pipe, room_id)
+    pipe.lpushx(key, *(json.dumps(entry) for entry in entries))
+    pipe.ltrim(key, 0, config["SIZE"])
+    pipe.expire(key, config["TTL"])
+
+
+def _queue_invalidate(pipe, room_id):
+    _queue_touch(pipe, room_id)
+    pipe.delete(buffer_key(room_id))
+
+
+def group_entries(messages, usernames):
+    """Entries of saved messages per room; ``usernames`` maps user id to username."""
+    by_room = {}
+    for message in messages:
+        by_room.setdefault(message.room_id, []).append(to_entry(message, usernames[message.user_id]))
+    return by_room
+
+
+def push(room_id, entries):
+    """
+    Add freshly persisted entries (oldest first) to the head of a room's buffer.
+
+    Only buffers that already exist are extended, so a room is never served a
+    partial page; the next history read primes it from Postgres instead.
+    """
+    if not entries:
+        return
+    try:
+        pipe = cache.client.get_client().pipeline(transaction=False)
+        _queue_push(pipe, room_id, entries)
+        pipe.execute()
+    except RedisError as exc:
+        logger.warning("Could not push to history buffer of room %s: %s", room_id, exc)
+        invalidate(room_id)
+
+
+async def apush(room_id, entries):
+    """:func:`push` on the event loop's asyncio Redis client."""
+    if not entries:
+        return
+    try:
+        async with get_redis().pipeline(transaction=False) as pipe:
+            _queue_push(pipe, room_id, entries)
+            await pipe.execute()
+    except RedisError as exc:
+        logger.warning("Could not push to history buffer of room %s: %s", room_id, exc)
+        try:
+            async with get_redis().pipeline(transaction=False) as pipe:
+                _queue_invalidate(pipe, room_id)
+                await pipe.execute()
+        except RedisError:
+            pass
+
+
+def push_messages(messages, usernames):
+    for room_id, entries in group_entries(messages, usernames).items():
+        push(room_id, entries)
+
+
+async def apush_messages(messages, usernames):
+    for room_id, entries in group_entries(messages, usernames).items():
+        await apush(room_id, entries)
+
+
+def invalidate(room_id):
+    try:
+        pipe = cache.client.get_client().pipeline(transaction=False)
+        _queue_invalidate(pipe, room_id)
+        pipe.execute()
+    except RedisError as exc:
+        logger.warning("Could not invalidate history buffer of room %s: %s", room_id, exc)
+
+
+def touch(room_id):
+    """Record a change to a room that leaves its messages alone, such as a rename."""
+    try:
+        pipe = cache.client.get_client().pipeline(transaction=False)
+        _queue_touch(pipe, room_id)
+        pipe.execute()
+    except RedisError as exc:
+        logger.warning("Could not bump the version of room %s: %s", room_id, exc)
+
+
+@receiver(post_save, sender=Room)
+@receiver(post_delete, sender=Room)
+def touch_saved_room(sender, instance, **kwargs):
+    # Summary updates from saved messages go through update() and are touched with the buffer
+    touch(instance.pk)
+
+
+def load_since(room_id, seq, limit):
+    """Up to ``limit`` entries after ``seq`` from the database, and whether more remain."""
+    messages = list(
+        Message.objects.filter(room_id=room_id, seq__gt=seq)
+        .select_related("user")
+        .only("id", "room_id", "content", "timestamp", "seq", "user__id", "user__username")
+        .order_by("seq")[: limit + 1]
+    )
+    return [to_entry(message, message.user.username) for message in messages[:limit]], len(messages) > limit
+
+
+async def areplay(room_id, seq, limit):
+    """
+    Entries of a room after ``seq`` for a reconnecting client, oldest first.
+
+    Served from the history buffer when it reaches back to ``seq``, otherwise
+    from the database. Returns ``(entries, truncated, source)``; ``truncated``
+    means the gap is longer than ``limit`` and the client should refetch.
+    """
+    entries = await HistoryBuffer(room_id).asince(seq)
+    if entries is not None and len(entries) <= limit:
+        return entries, False, "buffer"
+    entries, truncated = await database_sync_to_async(load_since)(room_id, seq, limit)
+    return entries, truncated, "db"
+
+
+def stats():
+    try:
+        hits, misses = cache.client.get_client().mget(HITS_KEY, MISSES_KEY)
+    except RedisError:
+        hits = misses = None
+    hits, misses = int(hits or 0), int(misses or 0)
+    return {
+        "hits": hits,
+        "misses": misses,
+        "hit_ratio": hits / (hits + misses) if hits + misses else 0.0,
+        "size": settings.CHAT_HISTORY_BUFFER["SIZE"],
+    }
+
+
+class HistoryBuffer:
+    """
+    Capped Redis list holding a room's newest history entries, newest first.
+
+    Reads that miss remember the buffer's generation so :meth:`prime` can refuse
+    to install a page that a concurrent :func:`push` or :func:`invalidate` has
+    already made stale.
+    """
+
+    def __init__(self, room_id):
+        self.room_id = room_id
+        self.key = buffer_key(room_id)
+        self.generation = None
+
+    def recent(self, limit):
+        """Return ``(entries, has_older)`` for the newest page, or ``None`` on a miss."""
+        if limit > settings.CHAT_HISTORY_BUFFER["SIZE"]:
+            return None
+        try:
+            client = cache.client.get_client()
+            pipe = client.pipeline(transaction=False)
+            pipe.get(generation_key(self.room_id))
+            pipe.lrange(self.key, 0, limit)
+            self.generation, raw = pipe.execute()
+        except RedisError as exc:
+            logger.warning("History buffer of room %s unavailable: %s", self.room_id, exc)
+            return None
+        result = self._page(raw, limit)
+        client.incr(MISSES_KEY if result is None else HITS_KEY)
+        return result
+
+    async def arecent(self, limit):
+        """:meth:`recent` on the event loop's asyncio Redis client."""
+        if limit > settings.CHAT_HISTORY_BUFFER["SIZE"]:
+            return None
+        try:
+            client = get_redis()
+            async with client.pipeline(transaction=False) as pipe:
+                pipe.get(generation_key(self.room_id))
+                pipe.lrange(self.key, 0, limit)
+                self.generation, raw = await pipe.execute()
+        except RedisError as exc:
+            logger.warning("History buffer of room %s unavailable: %s", self.room_id, exc)
+            return None
+        result = self._page(raw, limit)
+        await client.incr(MISSES_KEY if result is None else HITS_KEY)
+        return result
+
+    @staticmethod
+    def _page(raw, limit):
+        complete = bool(raw) and raw[-1].decode() == COMPLETE
+        entries = raw[:-1] if complete else raw
+        if len(entries) > limit:
+            page, has_older = entries[:limit], True
+        elif complete:
+            page, has_older = entries, False
+        else:
+            return None
+        return [json.loads(entry) for entry in reversed(page)], has_older
+
+    async def asince(self, seq):
+        """Buffered entries after ``seq`` (oldest first), or ``None`` if the buffer does not reach back to it."""
+        try:
+            raw = await get_redis().lrange(self.key, 0, -1)
+        except RedisError as exc:
+            logger.warning("History buffer of room %s unavailable: %s", self.room_id, exc)
+            return None
+        # Flushes from several processes may land slightly out of order, so scan all of it
+        covered = False
+        entries = []
+        for item in raw:
+            if item.decode() == COMPLETE:
+                covered = True
+                continue
+            entry = json.loads(item)
+            if entry["seq"] <= seq:
+                covered = True
+            else:
+                entries.append(entry)
+        if not covered:
+            return None
+        return sorted(entries, key=lambda entry: entry["seq"])
+
+    def prime(self, entries, complete):
+        """Replace the buffer with ``entries`` (oldest first) read from the database."""
+        config = settings.CHAT_HISTORY_BUFFER
+        values = [json.dumps(entry) for entry in reversed(entries)][: config["SIZE"] + 1]
+        if complete and len(values) == len(entries):
+            values.append(COMPLETE)
+        if not values:
+            return
+        try:
+            with cache.client.get_client().pipeline() as pipe:
+                pipe.watch(generation_key(self.room_id))
+                if pipe.get(generation_key(self.room_id)) != self.generation:
+                    return
+                pipe.multi()
+                pipe.delete(self.key)
+                pipe.rpush(self.key, *values)
+                pipe.expire(self.key, config["TTL"])
+                pipe.execute()
+        except WatchError:
+            pass
+        except RedisError as exc:
+            logger.warning("Could not prime history buffer of room %s: %s", self.room_id, exc)
@@ -0,0 +1,73 @@
+import asyncio
+
+import msgpack
+from channels_redis.pubsub import RedisPubSubChannelLayer, RedisPubSubLoopLayer, RedisSingleShardConnection
+from channels_redis.utils import _wrap_close
+
+from . import metrics
+
+
+class LocalFanoutChannelLayer(RedisPubSubChannelLayer):
+    """
+    Pub/sub channel layer that decodes each group message once per process.
+
+    The stock ``RedisPubSubChannelLayer`` already subscribes once per group and
+    publishes a ``group_send`` once, but queues the raw payload for every local
+    member, each of which decodes it again. Here the receiving process decodes
+    a group message once and hands the same dict to all its local consumers, so
+    a busy room costs one MessagePack decode per process instead of one per
+    socket. Consumers must treat received messages as read-only.
+
+    Publishes and local deliveries are counted in :mod:`chat.metrics`.
+    """
+
+    def deserialize(self, message):
+        # Group messages are decoded once per process before being fanned out
+        if isinstance(message, dict):
+            return message
+        return msgpack.unpackb(message)
+
+    def _get_layer(self):
+        loop = asyncio.get_running_loop()
+        try:
+            layer = self._layers[loop]
+        except KeyError:
+            layer = self._layers[loop] = LocalFanoutLoopLayer(*self._args, **self._kwargs, channel_layer=self)
+            _wrap_close(self, loop)
+        return layer
+
+
+class LocalFanoutLoopLayer(RedisPubSubLoopLayer):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._shards = [LocalFanoutShardConnection(shard.host, self) for shard in self._shards]
+
+    async def send(self, channel, message):
+        metrics.layer_publishes.inc("channel")
+        await super().send(channel, message)
+
+    async def group_send(self, group, message):
+        metrics.layer_publishes.inc("group")
+        await super().group_send(group, message)
+
+
+class LocalFanoutShardConnection(RedisSingleShardConnection):
+    def _receive_message(self, message):
+        if message is None:
+            return
+        name = message["channel"]
+        if isinstance(name, bytes):
+            name = name.decode()
+        layer = self.channel_layer
+        if name in layer.channels:
+            layer.channels[name].put_nowait(message["data"])
+            metrics.layer_deliveries.inc("channel")
+        elif name in layer.groups:
+            decoded = layer.channel_layer.deserialize(message["data"])
+            delivered = 0
+            for channel_name in layer.groups[name]:
+                queue = layer.channels.get(channel_name)
+                if queue is not None:
+                    queue.put_nowait(decoded)
+                    delivered += 1
+            metrics.layer_deliveries.inc("group", amount=delivered)
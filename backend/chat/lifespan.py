@@ -0,0 +1,21 @@
+from . import persistence, presence, redis_client, unread
+
+
+async def lifespan(scope, receive, send):
+    """
+    ASGI lifespan handler flushing buffered state on shutdown.
+
+    Servers that do not speak the lifespan protocol (e.g. Daphne) never call this;
+    the write-behind writer falls back to draining itself at interpreter exit.
+    """
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await presence.shutdown()
+            await persistence.shutdown()
+            await unread.shutdown()
+            await redis_client.shutdown()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
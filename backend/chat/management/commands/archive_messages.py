@@ -0,0 +1,18 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from chat.archive import archive_messages
+
+
+class Command(BaseCommand):
+    help = "Move messages older than CHAT_ARCHIVE['AFTER_DAYS'] into compressed per-room archive segments."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--older-than-days", type=int, default=settings.CHAT_ARCHIVE["AFTER_DAYS"])
+        parser.add_argument("--batch-size", type=int, default=settings.CHAT_ARCHIVE["BATCH_SIZE"])
+
+    def handle(self, *args, **options):
+        archived = archive_messages(options["older_than_days"], options["batch_size"])
+        for room_id, count in archived.items():
+            self.stdout.write(f"room {room_id}: {count} messages")
+        self.stdout.write(self.style.SUCCESS(f"Archived {sum(archived.values())} messages from {len(archived)} rooms"))
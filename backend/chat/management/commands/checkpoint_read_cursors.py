@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from chat.unread import checkpoint
+
+
+class Command(BaseCommand):
+    help = "Copy read cursors changed in Redis to the ReadCursor table."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int)
+
+    def handle(self, *args, **options):
+        total = 0
+        while True:
+            copied = checkpoint(options["batch_size"])
+            total += copied
+            if not copied:
+                break
+        self.stdout.write(self.style.SUCCESS(f"Checkpointed {total} read cursors"))
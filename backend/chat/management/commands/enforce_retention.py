@@ -0,0 +1,36 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from chat.retention import enforce_retention
+
+
+class Command(BaseCommand):
+    help = "Delete messages older than the retention window in throttled primary-key batches."
+
+    def add_arguments(self, parser):
+        config = settings.CHAT_RETENTION
+        parser.add_argument("--days", type=int, default=config["DAYS"], help="defaults to CHAT_RETENTION['DAYS']")
+        parser.add_argument("--batch-size", type=int, default=config["BATCH_SIZE"])
+        parser.add_argument("--pause", type=float, default=config["PAUSE"], help="seconds to sleep between batches")
+        parser.add_argument("--vacuum", action="store_true", help="VACUUM ANALYZE chat_message afterwards")
+
+    def handle(self, *args, **options):
+        if options["days"] <= 0:
+            raise CommandError("Retention is disabled; pass --days or set CHAT_RETENTION_DAYS")
+
+        def progress(deleted):
+            self.stderr.write(f"{deleted} messages deleted")
+
+        messages, segments = enforce_retention(options["days"], options["batch_size"], options["pause"], progress)
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Deleted {messages} messages older than {options['days']} days, {segments} of them archive segments"
+            )
+        )
+
+        if options["vacuum"] and connection.vendor == "postgresql":
+            # Returns the dead rows' space to the table and refreshes planner statistics
+            with connection.cursor() as cursor:
+                cursor.execute("VACUUM (ANALYZE) chat_message")
+            self.stdout.write("Vacuumed chat_message")
@@ -0,0 +1,32 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.models import Room
+from chat.transfer import TransferStats, export_lines
+
+
+class Command(BaseCommand):
+    help = "Write a room's whole history, archive included, as NDJSON."
+
+    def add_arguments(self, parser):
+        parser.add_argument("room_id", type=int)
+        parser.add_argument("--output", "-o", default="-", help="file to write, or - for stdout")
+        parser.add_argument("--chunk-size", type=int, default=2000, help="rows fetched per cursor round trip")
+
+    def handle(self, *args, **options):
+        try:
+            room = Room.objects.get(pk=options["room_id"])
+        except Room.DoesNotExist:
+            raise CommandError(f"Room {options['room_id']} does not exist")
+
+        stats = TransferStats()
+        output = sys.stdout if options["output"] == "-" else open(options["output"], "w", encoding="utf-8")
+        try:
+            for line in export_lines(room, options["chunk_size"]):
+                output.write(line)
+                stats.rows += 1
+        finally:
+            if output is not sys.stdout:
+                output.close()
+        self.stderr.write(f"Exported {stats.rows} messages in {stats.seconds:.1f}s ({stats.rows_per_second:.0f} rows/s)")
@@ -0,0 +1,53 @@
+import sys
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.models import Room
+from chat.transfer import import_lines
+
+
+class Command(BaseCommand):
+    help = "Load an NDJSON history dump, as written by export_room, into an empty room."
+
+    def add_arguments(self, parser):
+        parser.add_argument("input", help="file to read, or - for stdin")
+        target = parser.add_mutually_exclusive_group(required=True)
+        target.add_argument("--room", type=int, help="id of an existing, empty room to load into")
+        target.add_argument("--new-room", metavar="NAME", help="create a room with this name")
+        parser.add_argument("--owner", help="username owning a --new-room")
+        parser.add_argument("--batch-size", type=int, default=2000)
+
+    def handle(self, *args, **options):
+        if options["room"] is not None:
+            try:
+                room = Room.objects.get(pk=options["room"])
+            except Room.DoesNotExist:
+                raise CommandError(f"Room {options['room']} does not exist")
+        else:
+            if not options["owner"]:
+                raise CommandError("--new-room needs --owner")
+            try:
+                owner = User.objects.get(username=options["owner"])
+            except User.DoesNotExist:
+                raise CommandError(f"User {options['owner']} does not exist")
+            room = Room.objects.create(name=options["new_room"], created_by=owner)
+
+        def progress(stats):
+            self.stderr.write(f"{stats.rows} rows, {stats.rows_per_second:.0f} rows/s")
+
+        source = sys.stdin if options["input"] == "-" else open(options["input"], encoding="utf-8")
+        try:
+            stats = import_lines(room, source, options["batch_size"], progress)
+        except ValueError as exc:
+            raise CommandError(str(exc))
+        finally:
+            if source is not sys.stdin:
+                source.close()
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Imported {stats.rows} messages into room {room.id} in {stats.seconds:.1f}s "
+                f"({stats.rows_per_second:.0f} rows/s, {stats.users_created} users created, "
+                f"{stats.skipped} bad lines skipped)"
+            )
+        )
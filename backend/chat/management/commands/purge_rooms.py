@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from chat.models import Room
+from chat.retention import purge_room
+
+
+class Command(BaseCommand):
+    help = "Finish deleting rooms marked for deletion, e.g. after a purge was interrupted."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int)
+        parser.add_argument("--pause", type=float)
+
+    def handle(self, *args, **options):
+        room_ids = list(Room.objects.filter(deleted_at__isnull=False).order_by("deleted_at").values_list("id", flat=True))
+        for room_id in room_ids:
+            deleted = purge_room(room_id, options["batch_size"], options["pause"])
+            self.stdout.write(f"room {room_id}: {deleted} messages")
+        self.stdout.write(self.style.SUCCESS(f"Purged {len(room_ids)} rooms"))
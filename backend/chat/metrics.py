@@ -0,0 +1,224 @@
+import bisect
+import functools
+import os
+import threading
+import time
+
+from asgiref.sync import SyncToAsync
+
+# Seconds; covers sub-millisecond event handling up to slow database writes
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+PID = str(os.getpid())
+
+_registry = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    """
+    Base of the in-process metrics exported by :func:`render`.
+
+    Label values are passed positionally to each update, in the order of
+    ``labelnames``. Updates take a per-metric lock so views running on worker
+    threads and consumers on the event loop can share a metric.
+    """
+
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        for labels, value in items:
+            yield self.name, _format_labels(self.labelnames, labels), value
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    """Gauge whose series disappears once it drops back to zero, so churned labels do not pile up."""
+
+    type = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            value = self._values.get(labels, 0) + amount
+            if value:
+                self._values[labels] = value
+            else:
+                self._values.pop(labels, None)
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def samples(self):
+        if self.function is not None:
+            yield self.name, "", self.function()
+            return
+        yield from super().samples()
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                # Per-bucket counts plus +Inf, then the running sum
+                state = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            state[bisect.bisect_left(self.buckets, value)] += 1
+            state[-1] += value
+
+    def samples(self):
+        with self._lock:
+            items = [(labels, list(state)) for labels, state in self._values.items()]
+        for labels, state in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), state):
+                cumulative += count
+                yield f"{self.name}_bucket", _format_labels(self.labelnames, labels, f'le="{bound}"'), cumulative
+            yield f"{self.name}_count", _format_labels(self.labelnames, labels), cumulative
+            yield f"{self.name}_sum", _format_labels(self.labelnames, labels), state[-1]
+
+
+def render():
+    """All registered metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in _registry:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        for name, labels, value in metric.samples():
+            lines.append(f"{name}{labels} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def _db_executor_queue_depth():
+    # Consumers' database_sync_to_async calls share this single worker thread
+    queue = getattr(SyncToAsync.single_thread_executor, "_work_queue", None)
+    return queue.qsize() if queue is not None else 0
+
+
+def _writer_queue_depth():
+    from . import persistence
+
+    return persistence.queue_depth()
+
+
+active_connections = Gauge(
+    "chat_active_connections", "Open WebSocket connections per room in this process.", ("room", "pid")
+)
+receive_seconds = Histogram("chat_receive_seconds", "Time spent handling one inbound WebSocket frame.")
+save_message_seconds = Histogram("chat_save_message_seconds", "Time spent persisting one chat message.")
+group_send_seconds = Histogram("chat_group_send_seconds", "Latency of channel layer group_send calls.", ("type",))
+db_executor_queue_depth = Gauge(
+    "chat_db_executor_queue_depth",
+    "Calls waiting for the database_sync_to_async worker thread.",
+    function=_db_executor_queue_depth,
+)
+outbound_dropped = Counter(
+    "chat_outbound_dropped_total", "Frames dropped from full outbound queues.", ("policy",)
+)
+outbound_disconnects = Counter(
+    "chat_outbound_disconnects_total", "Connections closed because their outbound queue overflowed.", ("policy",)
+)
+outbound_coalesced = Counter(
+    "chat_outbound_coalesced_total", "Queued presence updates replaced by a newer one before being sent."
+)
+outbound_batches = Counter("chat_outbound_batches_total", "Batch frames sent to clients that fell behind.")
+replays = Counter(
+    "chat_replays_total", "Reconnect replays by where the missed messages came from.", ("source",)
+)
+writer_flush_seconds = Histogram("chat_writer_flush_seconds", "Time spent writing one write-behind batch.")
+writer_batch_size = Histogram(
+    "chat_writer_batch_size", "Messages per write-behind batch.", buckets=(1, 5, 10, 25, 50, 100, 200, 500, 1000)
+)
+writer_failed = Counter("chat_writer_failed_total", "Write-behind messages dropped because their row was rejected.")
+writer_dropped = Counter(
+    "chat_writer_dropped_total", "Write-behind messages dropped because their batch kept failing to write."
+)
+writer_queue_depth = Gauge(
+    "chat_writer_queue_depth", "Messages waiting in this process's write-behind buffers.", function=_writer_queue_depth
+)
+layer_publishes = Counter(
+    "chat_layer_publishes_total", "Messages this process published through the channel layer.", ("kind",)
+)
+layer_deliveries = Counter(
+    "chat_layer_deliveries_total", "Channel layer messages handed to consumers in this process.", ("kind",)
+)
+rate_limited = Counter("chat_rate_limited_total", "Actions rejected by a rate limiter.", ("bucket",))
+http_request_seconds = Histogram(
+    "chat_http_request_seconds", "DRF view latency.", ("view", "action", "method", "status")
+)
+
+
+class TimedViewMixin:
+    """Records the latency of every request a DRF view handles in ``chat_http_request_seconds``."""
+
+    def dispatch(self, request, *args, **kwargs):
+        started = time.perf_counter()
+        response = super().dispatch(request, *args, **kwargs)
+        http_request_seconds.observe(
+            time.perf_counter() - started,
+            type(self).__name__,
+            getattr(self, "action", None) or "",
+            request.method,
+            response.status_code,
+        )
+        return response
+
+
+def timed_async_view(view, action):
+    """Records an async function view's latency under the same labels as :class:`TimedViewMixin`."""
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(request, *args, **kwargs):
+            started = time.perf_counter()
+            response = await func(request, *args, **kwargs)
+            http_request_seconds.observe(
+                time.perf_counter() - started, view, action, request.method, response.status_code
+            )
+            return response
+
+        return wrapper
+
+    return decorator
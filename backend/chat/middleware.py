@@ -1,39 +1,68 @@
 # backend/chat/middleware.py
 # No imports at the module level that touch Django
+from urllib.parse import parse_qs
 
 
 class TokenAuthMiddleware:
     def __init__(self, app):
         self.app = app
+        self._authenticate = None
 
     async def __call__(self, scope, receive, send):
-        # All Django-related imports are now inside the __call__ method
-        from channels.db import database_sync_to_async
-        from django.contrib.auth.models import AnonymousUser
-        from django.contrib.auth import get_user_model
-        from rest_framework_simplejwt.tokens import AccessToken
-        import logging
-
-        logger = logging.getLogger(__name__)
-
-        @database_sync_to_async
-        def get_user_from_token(token):
-            User = get_user_model()
-            try:
-                access_token = AccessToken(token)
-                user = User.objects.get(id=access_token["user_id"])
-                return user
-            except Exception as e:
-                logger.error(f"Error authenticating user from token: {e}")
-                return AnonymousUser()
-
-        query_string = scope["query_string"].decode()
-        query_params = dict(qp.split("=") for qp in query_string.split("&") if "=" in qp)
-        token = query_params.get("token")
-
-        if token:
-            scope["user"] = await get_user_from_token(token)
-        else:
-            scope["user"] = AnonymousUser()
+        if self._authenticate is None:
+            # Django-related imports are resolved once, on the first connection
+            from chat.auth import authenticate
 
+            self._authenticate = authenticate
+
+        query_params = parse_qs(scope["query_string"].decode())
+        token = query_params.get("token", [None])[0]
+
+        scope["user"] = await self._authenticate(token)
         return await self.app(scope, receive, send)
+
+
+class ReplicaRoutingMiddleware:
+    """
+    Lets GET/HEAD/OPTIONS requests read from replicas (see ``chat.routers``).
+
+    After a request that wrote, the user's reads stay on the primary for
+    ``CHAT_DB["STICKY_SECONDS"]`` so they always see their own writes. Async
+    capable, so it keeps async views off the thread pool.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+        from chat import routers
+
+        self.get_response = get_response
+        self.routers = routers
+        self._remember_async = sync_to_async(self._remember)
+        self._is_async = iscoroutinefunction(get_response)
+        if self._is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self._is_async:
+            return self.__acall__(request)
+        with self.routers.request_routing(replica=request.method in ("GET", "HEAD", "OPTIONS")) as state:
+            response = self.get_response(request)
+        if state.wrote:
+            self._remember(request)
+        return response
+
+    async def __acall__(self, request):
+        with self.routers.request_routing(replica=request.method in ("GET", "HEAD", "OPTIONS")) as state:
+            response = await self.get_response(request)
+        if state.wrote:
+            # request.user may still be a lazy session lookup
+            await self._remember_async(request)
+        return response
+
+    def _remember(self, request):
+        user = getattr(request, "user", None)
+        if user is not None and user.is_authenticated:
+            self.routers.remember_write(user.id)
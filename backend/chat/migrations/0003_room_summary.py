@@ -0,0 +1,42 @@
+# Generated by Django 4.2.7 on 2026-10-18 02:58
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def backfill_room_summaries(apps, schema_editor):
+    Room = apps.get_model("chat", "Room")
+    Message = apps.get_model("chat", "Message")
+    for room in Room.objects.only("id", "created_at").iterator(chunk_size=500):
+        latest = Message.objects.filter(room_id=room.id).order_by("-timestamp", "-id").first()
+        Room.objects.filter(pk=room.id).update(
+            message_count=Message.objects.filter(room_id=room.id).count(),
+            last_message_preview=latest.content[:100] if latest else "",
+            last_activity_at=latest.timestamp if latest else room.created_at,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0002_message_room_timestamp_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='last_activity_at',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='room',
+            name='last_message_preview',
+            field=models.CharField(blank=True, default='', max_length=100),
+        ),
+        migrations.AddField(
+            model_name='room',
+            name='message_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_room_summaries, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 4.2.7 on 2026-10-18 03:30
+
+from django.db import migrations, models
+
+
+def backfill_sequences(apps, schema_editor):
+    Room = apps.get_model("chat", "Room")
+    Message = apps.get_model("chat", "Message")
+    for room_id in Room.objects.values_list("id", flat=True).iterator(chunk_size=500):
+        batch, seq = [], 0
+        for message in Message.objects.filter(room_id=room_id).order_by("timestamp", "id").only("id").iterator(
+            chunk_size=2000
+        ):
+            seq += 1
+            message.seq = seq
+            batch.append(message)
+            if len(batch) == 2000:
+                Message.objects.bulk_update(batch, ["seq"])
+                batch = []
+        Message.objects.bulk_update(batch, ["seq"])
+        Room.objects.filter(pk=room_id).update(last_seq=seq)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_room_summary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='last_seq',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='seq',
+            field=models.BigIntegerField(editable=False, null=True),
+        ),
+        migrations.RunPython(backfill_sequences, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 4.2.7 on 2026-10-18 03:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_message_seq'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='message',
+            name='seq',
+            field=models.BigIntegerField(editable=False),
+        ),
+        migrations.AddConstraint(
+            model_name='message',
+            constraint=models.UniqueConstraint(fields=('room', 'seq'), name='chat_message_room_seq_uniq'),
+        ),
+    ]
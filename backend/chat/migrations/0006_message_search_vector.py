@@ -0,0 +1,88 @@
+# Generated by Django 4.2.7 on 2026-10-18 03:50
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.db import migrations
+
+BACKFILL_BATCH_SIZE = 5000
+
+
+def install_search_trigger(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    # New and edited rows get their vector from here on, so the backfill below
+    # only has to catch up with rows that already exist
+    schema_editor.execute(
+        "CREATE TRIGGER chat_message_search_vector_update "
+        "BEFORE INSERT OR UPDATE OF content ON chat_message "
+        "FOR EACH ROW EXECUTE PROCEDURE tsvector_update_trigger(search_vector, 'pg_catalog.english', content)"
+    )
+
+
+def remove_search_trigger(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    schema_editor.execute("DROP TRIGGER IF EXISTS chat_message_search_vector_update ON chat_message")
+
+
+def backfill_search_vectors(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    # The migration is not atomic, so every batch commits on its own and row
+    # locks are held for one id range at a time
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("SELECT COALESCE(MAX(id), 0) FROM chat_message")
+        (last_id,) = cursor.fetchone()
+        for start in range(0, last_id, BACKFILL_BATCH_SIZE):
+            cursor.execute(
+                "UPDATE chat_message SET search_vector = to_tsvector('pg_catalog.english', content) "
+                "WHERE id > %s AND id <= %s AND search_vector IS NULL",
+                [start, start + BACKFILL_BATCH_SIZE],
+            )
+
+
+def create_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    schema_editor.execute(
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS chat_message_search_gin ON chat_message USING gin (search_vector)"
+    )
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    schema_editor.execute("DROP INDEX CONCURRENTLY IF EXISTS chat_message_search_gin")
+
+
+class Migration(migrations.Migration):
+
+    # Batched backfill and CREATE INDEX CONCURRENTLY both need to run outside a transaction
+    atomic = False
+
+    dependencies = [
+        ('chat', '0005_message_seq_unique'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunPython(install_search_trigger, remove_search_trigger),
+        migrations.RunPython(backfill_search_vectors, migrations.RunPython.noop),
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AddIndex(
+                    model_name='message',
+                    index=django.contrib.postgres.indexes.GinIndex(
+                        fields=['search_vector'], name='chat_message_search_gin'
+                    ),
+                ),
+            ],
+            database_operations=[
+                migrations.RunPython(create_search_index, drop_search_index),
+            ],
+        ),
+    ]
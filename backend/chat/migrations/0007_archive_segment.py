@@ -0,0 +1,38 @@
+# Generated by Django 4.2.7 on 2026-10-18 03:38
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_message_search_vector'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='archived_through',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='ArchiveSegment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField()),
+                ('path', models.CharField(max_length=255, unique=True)),
+                ('codec', models.CharField(max_length=8)),
+                ('message_count', models.PositiveIntegerField()),
+                ('first_seq', models.BigIntegerField()),
+                ('last_seq', models.BigIntegerField()),
+                ('first_timestamp', models.DateTimeField()),
+                ('last_timestamp', models.DateTimeField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archive_segments', to='chat.room')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['room', 'last_timestamp'], name='chat_archive_room_last_ts_idx')],
+            },
+        ),
+    ]
@@ -1,33 +1,188 @@
+from collections import defaultdict
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVectorField
 from django.db import models
+from django.db.models import Case, F, OuterRef, Q, Subquery, Value, When
+from django.db.models.functions import Cast, Coalesce, Greatest, Left
 from django.contrib.auth.models import User
+from django.utils import timezone
+from . import sequence
+
+PREVIEW_LENGTH = 100
+
+# Text search configuration of Message.search_vector; the trigger installed by
+# migration 0006 uses the same one
+SEARCH_CONFIG = "english"
+
+
+class RoomManager(models.Manager):
+    def record_messages(self, messages):
+        """Fold newly saved messages into their rooms' denormalized summaries."""
+        by_room = defaultdict(list)
+        for message in messages:
+            by_room[message.room_id].append(message)
+        for room_id, room_messages in by_room.items():
+            last = max(room_messages, key=lambda m: (m.timestamp, m.pk or 0))
+            # Imported history can be older than what the room already shows
+            newer = Q(last_activity_at__lte=last.timestamp) | Q(message_count=0)
+            self.filter(pk=room_id).update(
+                message_count=F("message_count") + len(room_messages),
+                last_message_preview=Case(
+                    When(newer, then=Value(last.content[:PREVIEW_LENGTH])), default=F("last_message_preview")
+                ),
+                last_activity_at=Case(When(newer, then=Value(last.timestamp)), default=F("last_activity_at")),
+                last_seq=Greatest(F("last_seq"), max(m.seq for m in room_messages)),
+            )
+
+    def forget_message(self, message):
+        """Undo a deleted message's contribution to its room's summary."""
+        self.filter(pk=message.room_id, message_count__gt=0).update(message_count=F("message_count") - 1)
+        latest = Message.objects.filter(room_id=message.room_id).order_by("-timestamp", "-id").first()
+        if latest is None or latest.timestamp <= message.timestamp:
+            self.filter(pk=message.room_id).update(
+                last_message_preview=latest.content[:PREVIEW_LENGTH] if latest else "",
+            )
+
+    def forget_messages(self, room_ids, newest):
+        """
+        Re-point the previews of rooms that lost messages up to ``newest`` at their newest remaining one.
+
+        Rooms active after ``newest`` are left alone; the others get the preview
+        and time of their newest remaining message, or an empty preview and
+        their creation time when none is left, in one statement.
+        """
+        latest = Message.objects.filter(room_id=OuterRef("pk")).order_by("-timestamp", "-id")
+        self.filter(pk__in=room_ids, last_activity_at__lte=newest).update(
+            last_message_preview=Coalesce(Left(Subquery(latest.values("content")[:1]), PREVIEW_LENGTH), Value("")),
+            last_activity_at=Coalesce(Subquery(latest.values("timestamp")[:1]), F("created_at")),
+        )
 
 
 class Room(models.Model):
     name = models.CharField(max_length=255)
     created_at = models.DateTimeField(auto_now_add=True)
     created_by = models.ForeignKey(User, on_delete=models.CASCADE)
+    # Denormalized summary, maintained as messages are saved and deleted
+    message_count = models.PositiveIntegerField(default=0)
+    last_message_preview = models.CharField(max_length=PREVIEW_LENGTH, blank=True, default="")
+    last_activity_at = models.DateTimeField(default=timezone.now, db_index=True)
+    # Highest persisted Message.seq; seeds the Redis counter that allocates them
+    last_seq = models.BigIntegerField(default=0)
+    # Newest archived message's timestamp; history older than it is in ArchiveSegment files
+    archived_through = models.DateTimeField(null=True, blank=True)
+    # Set once deletion is requested; the room is hidden while its messages are purged in batches
+    deleted_at = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    objects = RoomManager()
 
     def __str__(self):
         return self.name
 
 
+class MessageQuerySet(models.QuerySet):
+    def search(self, text):
+        """
+        Messages matching a web-style query (``"exact phrase" -word or``), annotated with ``rank``.
+
+        Matching goes through the GIN index on ``search_vector``; ``rank`` is the
+        cover density rank, as a double so it survives a round trip in a cursor.
+        """
+        query = SearchQuery(text, config=SEARCH_CONFIG, search_type="websearch")
+        return self.filter(search_vector=query).annotate(
+            rank=Cast(SearchRank(F("search_vector"), query, cover_density=True), models.FloatField())
+        )
+
+
 class Message(models.Model):
     room = models.ForeignKey(Room, related_name="messages", on_delete=models.CASCADE)
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     content = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Not auto_now_add, so imported history keeps its original times
+    timestamp = models.DateTimeField(default=timezone.now, editable=False)
+    # Position in the room, increasing with every message; clients resume from it
+    seq = models.BigIntegerField(editable=False)
+    # to_tsvector of content, kept up to date by a database trigger
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    objects = MessageQuerySet.as_manager()
 
     class Meta:
         ordering = ["timestamp"]
+        indexes = [
+            models.Index(fields=["room", "timestamp", "id"], name="chat_message_room_ts_id_idx"),
+            GinIndex(fields=["search_vector"], name="chat_message_search_gin"),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=["room", "seq"], name="chat_message_room_seq_uniq"),
+        ]
 
     def __str__(self):
         return f"{self.user.username}: {self.content[:50]}"
 
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        if self.seq is None:
+            self.seq = sequence.allocate(self.room_id)
+        super().save(*args, **kwargs)
+        if adding:
+            Room.objects.record_messages([self])
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        Room.objects.forget_message(self)
+        return result
+
+
+class ArchiveSegment(models.Model):
+    """
+    One append-only file of archived messages of a room, all from the same month.
+
+    The messages, oldest first, are NDJSON history entries, compressed with
+    ``codec``; ``path`` is relative to ``CHAT_ARCHIVE["ROOT"]``.
+    """
+
+    room = models.ForeignKey(Room, related_name="archive_segments", on_delete=models.CASCADE)
+    month = models.DateField()
+    path = models.CharField(max_length=255, unique=True)
+    codec = models.CharField(max_length=8)
+    message_count = models.PositiveIntegerField()
+    first_seq = models.BigIntegerField()
+    last_seq = models.BigIntegerField()
+    first_timestamp = models.DateTimeField()
+    last_timestamp = models.DateTimeField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["room", "last_timestamp"], name="chat_archive_room_last_ts_idx"),
+        ]
+
+    def __str__(self):
+        return self.path
+
+
+class ReadCursor(models.Model):
+    """Checkpoint of how far a user has read a room, by ``Message.seq``; live cursors are in Redis."""
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    room = models.ForeignKey(Room, on_delete=models.CASCADE)
+    seq = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "room"], name="chat_readcursor_user_room_uniq"),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id} read room {self.room_id} to {self.seq}"
+
 
 class UserProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
+    # Copies of the Redis presence state, written in batches by presence.flush_last_seen
     is_online = models.BooleanField(default=False)
-    last_seen = models.DateTimeField(auto_now=True)
+    last_seen = models.DateTimeField(default=timezone.now)
 
     def __str__(self):
         return self.user.username
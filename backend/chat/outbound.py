@@ -0,0 +1,133 @@
+import asyncio
+import logging
+from collections import deque
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+POLICY_DROP_OLDEST = "drop_oldest"
+POLICY_DISCONNECT = "disconnect"
+
+
+def batch_frame(texts):
+    """Join already-encoded chat frames into one ``{"type": "batch"}`` frame without re-encoding them."""
+    return '{"type":"batch","messages":[' + ",".join(texts) + "]}"
+
+
+class Outbox:
+    """
+    Bounded queue of frames waiting to be written to one WebSocket.
+
+    Channel layer handlers only enqueue, so a slow client backs up its own
+    queue instead of the consumer's layer buffer. Chat frames that pile up
+    while a send is in flight go out together as one batch frame. Presence
+    updates are coalesced per room: only the newest queued count is sent. When
+    the queue is full, ``drop_oldest`` discards the oldest chat frame that is
+    not pinned and ``disconnect`` refuses the frame so the consumer can close
+    the socket. Pinned frames, such as the user introductions later frames
+    refer to, are never dropped.
+
+    ``batch`` joins several queued frames into one; with a ``window`` the
+    writer waits that many seconds after waking so bursts share a frame.
+    ``on_drop`` is called whenever a frame is discarded. If sending fails,
+    the writer stops queueing and awaits ``on_error`` so the consumer can
+    close the socket instead of leaving it open with nothing arriving.
+    """
+
+    def __init__(
+        self,
+        send,
+        max_size=256,
+        max_batch=50,
+        policy=POLICY_DROP_OLDEST,
+        batch=batch_frame,
+        window=0,
+        on_drop=None,
+        on_error=None,
+    ):
+        self._send = send
+        self.max_size = max_size
+        self.max_batch = max_batch
+        self.policy = policy
+        self._batch = batch
+        self.window = window
+        self._on_drop = on_drop
+        self._on_error = on_error
+        self._frames = deque()
+        self._presence = {}
+        self._ready = asyncio.Event()
+        self.overflowed = False
+
+    def __len__(self):
+        return len(self._frames) + len(self._presence)
+
+    def put_message(self, text, pinned=False):
+        """Queue a chat frame; returns ``False`` once, when the connection should be closed instead."""
+        if self.overflowed:
+            return True
+        if len(self._frames) >= self.max_size:
+            if self.policy == POLICY_DISCONNECT:
+                # Nothing more is sent to a client that is being disconnected
+                self.overflowed = True
+                self._frames.clear()
+                self._presence.clear()
+                metrics.outbound_disconnects.inc(self.policy)
+                return False
+            self._drop_oldest()
+        self._frames.append((text, pinned))
+        self._ready.set()
+        return True
+
+    def _drop_oldest(self):
+        for index, (_, pinned) in enumerate(self._frames):
+            if not pinned:
+                del self._frames[index]
+                break
+        else:
+            # Only pinned frames are waiting; let the queue grow by one rather than lose one
+            return
+        metrics.outbound_dropped.inc(self.policy)
+        if self._on_drop is not None:
+            self._on_drop()
+
+    def put_presence(self, text, room_id=None):
+        if self.overflowed:
+            return
+        if room_id in self._presence:
+            metrics.outbound_coalesced.inc()
+        self._presence[room_id] = text
+        self._ready.set()
+
+    async def flush(self):
+        """Write everything queued, batching chat frames that accumulated meanwhile."""
+        while self._presence or self._frames:
+            if self._presence:
+                texts = list(self._presence.values())
+                self._presence.clear()
+                for text in texts:
+                    await self._send(text)
+            if self._frames:
+                count = min(len(self._frames), self.max_batch)
+                if count == 1:
+                    await self._send(self._frames.popleft()[0])
+                else:
+                    await self._send(self._batch([self._frames.popleft()[0] for _ in range(count)]))
+                    metrics.outbound_batches.inc()
+
+    async def run(self):
+        try:
+            while True:
+                await self._ready.wait()
+                if self.window:
+                    await asyncio.sleep(self.window)
+                self._ready.clear()
+                await self.flush()
+        except Exception:
+            logger.exception("Outbound writer failed; closing the connection")
+            # Nothing more is queued for a socket that is being closed
+            self.overflowed = True
+            self._frames.clear()
+            self._presence.clear()
+            if self._on_error is not None:
+                await self._on_error()
@@ -0,0 +1,228 @@
+import base64
+import math
+from datetime import datetime
+
+from asgiref.sync import sync_to_async
+from django.db.models import Q
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+def encode_cursor(timestamp, pk):
+    raw = f"{timestamp.isoformat()}|{pk}".encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        timestamp, pk = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(timestamp), int(pk)
+    except (TypeError, ValueError, UnicodeDecodeError):
+        raise NotFound("Invalid cursor")
+
+
+class MessageCursorPagination(BasePagination):
+    """
+    Keyset pagination over a room's history ordered by ``(timestamp, id)``.
+
+    Without a cursor the newest page is returned. ``?before=<cursor>`` walks back
+    to older messages and ``?after=<cursor>`` forward to newer ones. Each page is
+    returned oldest first, and every query is a bounded range scan on the
+    ``(room, timestamp, id)`` index however long the room is.
+    """
+
+    page_size = 50
+    max_page_size = 200
+    page_size_query_param = "limit"
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params.get(self.page_size_query_param, self.page_size))
+        except ValueError:
+            raise ValidationError({self.page_size_query_param: "Must be an integer."})
+        return max(1, min(size, self.max_page_size))
+
+    def _window(self, request):
+        before = request.query_params.get("before")
+        after = request.query_params.get("after")
+        if before and after:
+            raise ValidationError({"detail": "Use either 'before' or 'after', not both."})
+        return before, after, self.get_page_size(request)
+
+    def _finish(self, rows, limit, before, after):
+        if after:
+            page = rows[:limit]
+            self.has_older = True
+            self.has_newer = len(rows) > limit
+        else:
+            page = rows[:limit][::-1]
+            self.has_older = len(rows) > limit
+            self.has_newer = bool(before)
+        self.page = page
+        return page
+
+    def paginate_queryset(self, queryset, request, view=None, archive=None):
+        before, after, limit = self._window(request)
+
+        # ``archive`` (a RoomArchive) holds the room's messages older than the live table
+        if after:
+            timestamp, pk = decode_cursor(after)
+            rows = archive.after((timestamp, pk), limit + 1) if archive is not None else []
+            if len(rows) <= limit:
+                queryset = queryset.filter(Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=pk))
+                rows += list(queryset.order_by("timestamp", "id")[: limit + 1 - len(rows)])
+        else:
+            boundary = None
+            if before:
+                boundary = decode_cursor(before)
+                queryset = queryset.filter(Q(timestamp__lt=boundary[0]) | Q(timestamp=boundary[0], id__lt=boundary[1]))
+            rows = list(queryset.order_by("-timestamp", "-id")[: limit + 1])
+            if len(rows) <= limit and archive is not None:
+                if rows:
+                    boundary = (rows[-1].timestamp, rows[-1].pk)
+                rows += archive.before(boundary, limit + 1 - len(rows))
+        return self._finish(rows, limit, before, after)
+
+    async def apaginate_queryset(self, queryset, request, archive=None):
+        """
+        :meth:`paginate_queryset` through the async ORM.
+
+        Archive segments are files, read on a worker thread only when a page
+        runs past the live table.
+        """
+        before, after, limit = self._window(request)
+        if after:
+            timestamp, pk = decode_cursor(after)
+            rows = await sync_to_async(archive.after)((timestamp, pk), limit + 1) if archive is not None else []
+            if len(rows) <= limit:
+                queryset = queryset.filter(Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=pk))
+                rows += [row async for row in queryset.order_by("timestamp", "id")[: limit + 1 - len(rows)]]
+        else:
+            boundary = None
+            if before:
+                boundary = decode_cursor(before)
+                queryset = queryset.filter(Q(timestamp__lt=boundary[0]) | Q(timestamp=boundary[0], id__lt=boundary[1]))
+            rows = [row async for row in queryset.order_by("-timestamp", "-id")[: limit + 1]]
+            if len(rows) <= limit and archive is not None:
+                if rows:
+                    boundary = (rows[-1].timestamp, rows[-1].pk)
+                rows += await sync_to_async(archive.before)(boundary, limit + 1 - len(rows))
+        return self._finish(rows, limit, before, after)
+
+    def is_newest_page(self, request):
+        return not request.query_params.get("before") and not request.query_params.get("after")
+
+    def get_buffered_data(self, entries, has_older):
+        """Body of a newest page served from the room's history buffer."""
+        before = None
+        if entries and has_older:
+            before = encode_cursor(datetime.fromisoformat(entries[0]["timestamp"]), entries[0]["id"])
+        return {"before": before, "after": None, "results": entries}
+
+    def get_buffered_response(self, entries, has_older):
+        return Response(self.get_buffered_data(entries, has_older))
+
+    def get_paginated_data(self, data):
+        return {
+            "before": encode_cursor(self.page[0].timestamp, self.page[0].pk) if self.page and self.has_older else None,
+            "after": encode_cursor(self.page[-1].timestamp, self.page[-1].pk) if self.page and self.has_newer else None,
+            "results": data,
+        }
+
+    def get_paginated_response(self, data):
+        return Response(self.get_paginated_data(data))
+
+
+def encode_rank_cursor(rank, pk):
+    raw = f"{rank!r}|{pk}".encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+
+def decode_rank_cursor(cursor):
+    try:
+        rank, pk = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return float(rank), int(pk)
+    except (TypeError, ValueError, UnicodeDecodeError):
+        raise NotFound("Invalid cursor")
+
+
+class SearchCursorPagination(MessageCursorPagination):
+    """
+    Keyset pagination over search results ordered by ``(rank, id)``, best first.
+
+    ``?cursor=`` continues after the last result of the previous page, so deep
+    pages cost no more than the first one to skip to.
+    """
+
+    page_size = 20
+    max_page_size = 100
+
+    def paginate_queryset(self, queryset, request, view=None):
+        limit = self.get_page_size(request)
+        cursor = request.query_params.get("cursor")
+        if cursor:
+            rank, pk = decode_rank_cursor(cursor)
+            queryset = queryset.filter(Q(rank__lt=rank) | Q(rank=rank, id__lt=pk))
+        rows = list(queryset.order_by("-rank", "-id")[: limit + 1])
+        self.has_more = len(rows) > limit
+        self.page = rows[:limit]
+        return self.page
+
+    def get_paginated_response(self, data):
+        last = self.page[-1] if self.page else None
+        return Response(
+            {
+                "next": encode_rank_cursor(last.rank, last.pk) if self.has_more else None,
+                "results": data,
+            }
+        )
+
+
+class RoomPagination(PageNumberPagination):
+    page_size = 50
+    page_size_query_param = "page_size"
+    max_page_size = 200
+
+    async def apaginate(self, queryset, request):
+        """
+        Async page of ``queryset`` with the body :meth:`get_paginated_response` would build.
+
+        The page is fetched first; a first or last page that comes back short
+        knows its own count, so only full pages pay for the COUNT query.
+        """
+        page_size = self.get_page_size(request)
+        page_number = request.query_params.get(self.page_query_param) or 1
+        count = None
+        if page_number in self.last_page_strings:
+            count = await queryset.acount()
+            page_number = max(1, math.ceil(count / page_size))
+        try:
+            number = int(page_number)
+        except ValueError:
+            number = 0
+        if number < 1:
+            raise NotFound(self.invalid_page_message)
+        offset = (number - 1) * page_size
+        rows = [row async for row in queryset[offset : offset + page_size]]
+        if not rows and number > 1:
+            raise NotFound(self.invalid_page_message)
+        if count is None:
+            count = offset + len(rows) if len(rows) < page_size else await queryset.acount()
+
+        url = request.build_absolute_uri()
+        next_link = replace_query_param(url, self.page_query_param, number + 1) if count > offset + len(rows) else None
+        if number == 1:
+            previous_link = None
+        elif number == 2:
+            previous_link = remove_query_param(url, self.page_query_param)
+        else:
+            previous_link = replace_query_param(url, self.page_query_param, number - 1)
+        return {"count": count, "next": next_link, "previous": previous_link, "results": rows}
+
+
+class OnlineUserPagination(PageNumberPagination):
+    page_size = 50
+    page_size_query_param = "page_size"
+    max_page_size = 200
@@ -0,0 +1,225 @@
+import asyncio
+import atexit
+import logging
+import time
+import weakref
+from contextlib import suppress
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import IntegrityError, transaction
+
+from . import history, metrics, sequence
+from .models import Message, Room
+
+logger = logging.getLogger(__name__)
+
+MODE_SYNC = "sync"
+MODE_WRITE_BEHIND = "write_behind"
+
+ACK_ENQUEUE = "enqueue"
+ACK_FLUSH = "flush"
+
+
+class MessageWriter:
+    """
+    Buffers chat messages in a bounded queue and writes them with ``bulk_create``.
+
+    A batch is flushed once ``batch_size`` messages are waiting or ``flush_interval``
+    seconds after the first message of the batch arrived, whichever comes first.
+    With ``ack="flush"`` callers of :meth:`submit` wait until their row is written;
+    with ``ack="enqueue"`` they return as soon as the message is queued. A batch
+    whose write fails is retried ``retries`` times, doubling ``retry_delay`` each
+    time, before its messages are given up on.
+    """
+
+    def __init__(
+        self, batch_size=200, flush_interval=0.05, max_queue_size=10000, ack=ACK_ENQUEUE, retries=3, retry_delay=0.1
+    ):
+        if ack not in (ACK_ENQUEUE, ACK_FLUSH):
+            raise ValueError(f"Unknown write-behind ack policy: {ack!r}")
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.ack = ack
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.queue = asyncio.Queue(maxsize=max_queue_size)
+        self._batch = []
+        self._inflight = None
+        self._task = None
+        atexit.register(self._drain_sync)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def submit(self, room_id, user, content):
+        self.start()
+        # Numbered before queueing so the broadcast can carry the sequence right away
+        seq = await sequence.aallocate(room_id)
+        message = Message(room_id=room_id, user_id=user.id, content=content, seq=seq)
+        future = asyncio.get_running_loop().create_future() if self.ack == ACK_FLUSH else None
+        await self.queue.put((message, user.username, future))
+        if future is not None:
+            return await future
+        return message
+
+    async def close(self):
+        """Stop the flush loop and write everything still buffered."""
+        if self._task is not None:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        if self._inflight is not None:
+            with suppress(Exception):
+                await self._inflight
+            self._inflight = None
+        batch, self._batch = self._batch, []
+        batch.extend(self._drain_queue())
+        while batch:
+            await self._write(batch[: self.batch_size])
+            batch = batch[self.batch_size :]
+        atexit.unregister(self._drain_sync)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self._batch.append(await self.queue.get())
+            deadline = loop.time() + self.flush_interval
+            while len(self._batch) < self.batch_size:
+                try:
+                    self._batch.append(self.queue.get_nowait())
+                    continue
+                except asyncio.QueueEmpty:
+                    pass
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    self._batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            batch, self._batch = self._batch, []
+            # Shield the write so cancelling the loop never abandons a batch half-way.
+            self._inflight = asyncio.ensure_future(self._write(batch))
+            await asyncio.shield(self._inflight)
+            self._inflight = None
+
+    async def _write(self, batch):
+        started = time.perf_counter()
+        attempt = 0
+        while True:
+            try:
+                saved, failed = await database_sync_to_async(self._bulk_create)(batch)
+                break
+            except Exception as exc:
+                if attempt >= self.retries:
+                    logger.exception("Write-behind flush of %d messages failed, dropping them", len(batch))
+                    metrics.writer_dropped.inc(amount=len(batch))
+                    for _, _, future in batch:
+                        if future is not None and not future.done():
+                            future.set_exception(exc)
+                    return
+                delay = self.retry_delay * 2**attempt
+                attempt += 1
+                logger.warning(
+                    "Write-behind flush of %d messages failed (%s), retry %d in %.2fs", len(batch), exc, attempt, delay
+                )
+                await asyncio.sleep(delay)
+        elapsed = time.perf_counter() - started
+        metrics.writer_flush_seconds.observe(elapsed)
+        metrics.writer_batch_size.observe(len(batch))
+        if failed:
+            metrics.writer_failed.inc(amount=len(failed))
+        await history.apush_messages(saved, {message.user_id: username for message, username, _ in batch})
+        logger.debug("Flushed %d messages in %.2f ms", len(batch), elapsed * 1000)
+        for message, _, future in batch:
+            if future is None or future.done():
+                continue
+            if id(message) in failed:
+                future.set_exception(failed[id(message)])
+            else:
+                future.set_result(message)
+
+    def _bulk_create(self, batch):
+        messages = [message for message, _, _ in batch]
+        try:
+            # One transaction, so a batch that fails half-way can be retried whole
+            with transaction.atomic():
+                saved = Message.objects.bulk_create(messages)
+                Room.objects.record_messages(saved)
+        except IntegrityError:
+            logger.warning("Batch of %d messages rejected, retrying row by row", len(messages))
+        else:
+            return saved, {}
+        saved, failed = [], {}
+        for message in messages:
+            try:
+                message.save(force_insert=True)
+                saved.append(message)
+            except IntegrityError as exc:
+                logger.error("Dropping message for room %s from user %s: %s", message.room_id, message.user_id, exc)
+                failed[id(message)] = exc
+        return saved, failed
+
+    def _drain_queue(self):
+        items = []
+        while True:
+            try:
+                items.append(self.queue.get_nowait())
+            except asyncio.QueueEmpty:
+                return items
+
+    def _drain_sync(self):
+        # Last resort at interpreter exit, when the event loop is no longer running.
+        batch, self._batch = self._batch + self._drain_queue(), []
+        if batch:
+            logger.info("Flushing %d buffered messages at exit", len(batch))
+            saved, _ = self._bulk_create(batch)
+            history.push_messages(saved, {message.user_id: username for message, username, _ in batch})
+
+
+_writers = weakref.WeakKeyDictionary()
+
+
+def queue_depth():
+    """Messages submitted to this process's writers and not yet written."""
+    return sum(writer.queue.qsize() + len(writer._batch) for writer in list(_writers.values()))
+
+
+def get_writer():
+    """Return the write-behind writer bound to the running event loop."""
+    loop = asyncio.get_running_loop()
+    writer = _writers.get(loop)
+    if writer is None:
+        config = settings.CHAT_MESSAGE_WRITER
+        writer = MessageWriter(
+            batch_size=config["BATCH_SIZE"],
+            flush_interval=config["FLUSH_INTERVAL"],
+            max_queue_size=config["MAX_QUEUE_SIZE"],
+            ack=config["ACK"],
+            retries=config["RETRIES"],
+            retry_delay=config["RETRY_DELAY"],
+        )
+        _writers[loop] = writer
+    return writer
+
+
+async def save_message(room_id, user, content):
+    """Persist a message from ``user`` according to ``CHAT_MESSAGE_WRITER["MODE"]``."""
+    if settings.CHAT_MESSAGE_WRITER["MODE"] == MODE_WRITE_BEHIND:
+        return await get_writer().submit(room_id, user, content)
+    seq = await sequence.aallocate(room_id)
+    message = await database_sync_to_async(Message.objects.create)(
+        room_id=room_id, user_id=user.id, content=content, seq=seq
+    )
+    await history.apush(message.room_id, [history.to_entry(message, user.username)])
+    return message
+
+
+async def shutdown():
+    """Flush the writer of the running event loop, if one was started."""
+    writer = _writers.pop(asyncio.get_running_loop(), None)
+    if writer is not None:
+        await writer.close()
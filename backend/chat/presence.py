@@ -0,0 +1,381 @@
+import asyncio
+import logging
+import time
+import weakref
+from collections import defaultdict
+from contextlib import suppress
+from datetime import datetime, timezone
+
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from redis.commands.core import Script
+
+from . import encoding, metrics
+from .models import UserProfile
+from .redis_client import LuaScript, get_redis
+
+logger = logging.getLogger(__name__)
+
+ROOMS_KEY = "presence:rooms"
+
+# Aggregated over every room: users online, scored by when they came online,
+# their connection refcounts, and last-seen times not yet written to UserProfile
+ONLINE_KEY = "presence:online"
+ONLINE_REFS_KEY = "presence:online_refs"
+LAST_SEEN_KEY = "presence:last_seen"
+
+# KEYS: connections zset, connection->user hash, user refcount hash, active rooms set,
+#       then ONLINE_KEY, ONLINE_REFS_KEY, LAST_SEEN_KEY
+# ARGV: connection id, user id, expiry timestamp, room id, now
+JOIN = LuaScript("""
+if redis.call('ZADD', KEYS[1], ARGV[3], ARGV[1]) == 1 then
+    redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+    redis.call('HINCRBY', KEYS[3], ARGV[2], 1)
+    if redis.call('HINCRBY', KEYS[6], ARGV[2], 1) == 1 then
+        redis.call('ZADD', KEYS[5], ARGV[5], ARGV[2])
+        redis.call('HSET', KEYS[7], ARGV[2], ARGV[5])
+    end
+end
+redis.call('SADD', KEYS[4], ARGV[4])
+return redis.call('HLEN', KEYS[3])
+""")
+
+# KEYS: as JOIN; ARGV: room id, now, then the connection ids to drop
+LEAVE = LuaScript("""
+local dropped = 0
+for i = 3, #ARGV do
+    local user = redis.call('HGET', KEYS[2], ARGV[i])
+    if user then
+        redis.call('ZREM', KEYS[1], ARGV[i])
+        redis.call('HDEL', KEYS[2], ARGV[i])
+        if redis.call('HINCRBY', KEYS[3], user, -1) <= 0 then
+            redis.call('HDEL', KEYS[3], user)
+        end
+        if redis.call('HINCRBY', KEYS[6], user, -1) <= 0 then
+            redis.call('HDEL', KEYS[6], user)
+            redis.call('ZREM', KEYS[5], user)
+            redis.call('HSET', KEYS[7], user, ARGV[2])
+        end
+        dropped = dropped + 1
+    end
+end
+if redis.call('ZCARD', KEYS[1]) == 0 then
+    redis.call('SREM', KEYS[4], ARGV[1])
+end
+return {dropped, redis.call('HLEN', KEYS[3])}
+""")
+
+# KEYS: LAST_SEEN_KEY; takes every pending last-seen time at once
+TAKE_LAST_SEEN = Script(
+    None,
+    b"""
+local seen = redis.call('HGETALL', KEYS[1])
+redis.call('DEL', KEYS[1])
+return seen
+""",
+)
+
+
+def room_keys(room_id):
+    return [
+        f"presence:{room_id}:conns",
+        f"presence:{room_id}:conn_users",
+        f"presence:{room_id}:users",
+        ROOMS_KEY,
+        ONLINE_KEY,
+        ONLINE_REFS_KEY,
+        LAST_SEEN_KEY,
+    ]
+
+
+def is_online(user_id):
+    return cache.client.get_client().zscore(ONLINE_KEY, user_id) is not None
+
+
+def online_among(user_ids):
+    """The subset of ``user_ids`` online anywhere, in one round trip."""
+    user_ids = list(user_ids)
+    if not user_ids:
+        return set()
+    pipe = cache.client.get_client().pipeline(transaction=False)
+    for user_id in user_ids:
+        pipe.zscore(ONLINE_KEY, user_id)
+    return {user_id for user_id, score in zip(user_ids, pipe.execute()) if score is not None}
+
+
+class OnlineUsers:
+    """
+    Users online in any room, most recently connected first, as ``(user_id, online_since)``.
+
+    A lazy sequence over ``ONLINE_KEY`` for Django's paginator: its length is a
+    ZCARD and a page is one ZREVRANGE, so listing costs O(page) however many
+    users are online.
+    """
+
+    def __init__(self):
+        self.client = cache.client.get_client()
+
+    def count(self):
+        return self.client.zcard(ONLINE_KEY)
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            raise TypeError("OnlineUsers only supports slicing")
+        start = index.start or 0
+        stop = self.count() if index.stop is None else index.stop
+        if stop <= start:
+            return []
+        rows = self.client.zrevrange(ONLINE_KEY, start, stop - 1, withscores=True)
+        return [(int(user_id), since) for user_id, since in rows]
+
+
+def flush_last_seen(batch_size=1000):
+    """
+    Write pending last-seen times to UserProfile; returns how many were written.
+
+    Times are collected in Redis as users come online and go offline, so
+    presence churn costs one batched upsert per flush rather than a row update
+    per connection. ``is_online`` is refreshed along the way for the admin.
+    """
+    client = cache.client.get_client()
+    raw = TAKE_LAST_SEEN([LAST_SEEN_KEY], client=client)
+    seen = {int(raw[i]): float(raw[i + 1]) for i in range(0, len(raw), 2)}
+    if not seen:
+        return 0
+    existing = set(User.objects.filter(pk__in=list(seen)).values_list("id", flat=True))
+    online = online_among(existing)
+    profiles = [
+        UserProfile(
+            user_id=user_id,
+            is_online=user_id in online,
+            last_seen=datetime.fromtimestamp(timestamp, tz=timezone.utc),
+        )
+        for user_id, timestamp in seen.items()
+        if user_id in existing
+    ]
+    UserProfile.objects.bulk_create(
+        profiles,
+        batch_size=batch_size,
+        update_conflicts=True,
+        unique_fields=["user"],
+        update_fields=["is_online", "last_seen"],
+    )
+    return len(profiles)
+
+
+class Presence:
+    """
+    Per-process view of who is connected to which room.
+
+    Every socket is a connection entry in Redis with an expiry that this process
+    refreshes with a heartbeat, and users are counted through per-user refcounts,
+    so a user with two tabs stays online until both close. The same scripts
+    keep a global set of online users across rooms, and last-seen times are
+    written to the database every ``flush_interval``. A sweeper drops
+    connections whose process died without cleaning up. Count updates are
+    debounced per room: at most one broadcast per ``broadcast_interval`` leaves
+    this process however much churn the room sees.
+    """
+
+    def __init__(
+        self, ttl=90, heartbeat_interval=30, sweep_interval=60, broadcast_interval=1.0, flush_interval=30, flush_batch=1000
+    ):
+        self.ttl = ttl
+        self.heartbeat_interval = heartbeat_interval
+        self.sweep_interval = sweep_interval
+        self.broadcast_interval = broadcast_interval
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        self.local = defaultdict(dict)
+        self._last_broadcast = {}
+        self._pending = {}
+        self._tasks = []
+
+    def start(self):
+        if not self._tasks:
+            loop = asyncio.get_running_loop()
+            self._tasks = [
+                loop.create_task(self._heartbeat_loop()),
+                loop.create_task(self._sweep_loop()),
+                loop.create_task(self._flush_loop()),
+            ]
+
+    async def join(self, room_id, connection, user_id):
+        """Register a connection and return the room's online user count."""
+        self.start()
+        self.local[room_id][connection] = user_id
+        count = await self._join(room_id, connection, user_id, time.time() + self.ttl)
+        self.schedule_broadcast(room_id)
+        return count
+
+    async def leave(self, room_id, connection):
+        self.local[room_id].pop(connection, None)
+        if not self.local[room_id]:
+            del self.local[room_id]
+        _, count = await self._leave(room_id, [connection])
+        self.schedule_broadcast(room_id)
+        return count
+
+    def schedule_broadcast(self, room_id):
+        if room_id in self._pending:
+            return
+        elapsed = time.monotonic() - self._last_broadcast.get(room_id, float("-inf"))
+        delay = max(0.0, self.broadcast_interval - elapsed)
+        self._pending[room_id] = asyncio.get_running_loop().call_later(
+            delay, lambda: asyncio.ensure_future(self._broadcast(room_id))
+        )
+
+    async def _broadcast(self, room_id):
+        self._last_broadcast[room_id] = time.monotonic()
+        self._pending.pop(room_id, None)
+        try:
+            count = await self.count(room_id)
+            text = encoding.dumps({"type": "online_users_count", "count": count})
+            started = time.perf_counter()
+            await get_channel_layer().group_send(
+                f"chat_{room_id}", {"type": "online_users_count", "text": text, "count": count, "room": room_id}
+            )
+            metrics.group_send_seconds.observe(time.perf_counter() - started, "online_users_count")
+        except Exception:
+            logger.exception("Presence broadcast for room %s failed", room_id)
+        if room_id not in self.local:
+            # Nobody here follows the room any more; forget its debounce state
+            self._last_broadcast.pop(room_id, None)
+
+    async def sweep(self):
+        """Drop expired connections in every room; returns the rooms that changed."""
+        changed = await self._sweep(time.time())
+        for room_id in changed:
+            self.schedule_broadcast(room_id)
+        return changed
+
+    async def close(self):
+        """Stop background work and remove this process's connections from Redis."""
+        for task in self._tasks:
+            task.cancel()
+            with suppress(asyncio.CancelledError):
+                await task
+        self._tasks = []
+        for handle in self._pending.values():
+            handle.cancel()
+        self._pending.clear()
+        for room_id, connections in list(self.local.items()):
+            await self._leave(room_id, list(connections))
+        self.local.clear()
+        await self.flush()
+
+    async def flush(self):
+        return await database_sync_to_async(flush_last_seen)(self.flush_batch)
+
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                await self.heartbeat()
+            except Exception:
+                logger.exception("Presence heartbeat failed")
+
+    async def heartbeat(self):
+        """Extend this process's connections, re-registering any another process swept meanwhile."""
+        rejoined = await self._heartbeat({room: dict(conns) for room, conns in self.local.items()})
+        for room_id in rejoined:
+            self.schedule_broadcast(room_id)
+        return rejoined
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                await self.sweep()
+            except Exception:
+                logger.exception("Presence sweep failed")
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Last-seen flush failed")
+
+    async def count(self, room_id):
+        return await get_redis().hlen(room_keys(room_id)[2])
+
+    async def _join(self, room_id, connection, user_id, expires_at):
+        # Registration and the count come back in a single round trip
+        return await JOIN(room_keys(room_id), [connection, user_id, expires_at, room_id, time.time()])
+
+    async def _leave(self, room_id, connections):
+        return await LEAVE(room_keys(room_id), [room_id, time.time(), *connections])
+
+    async def _heartbeat(self, connections_by_room):
+        expires_at = time.time() + self.ttl
+        rooms = list(connections_by_room.items())
+        async with get_redis().pipeline(transaction=False) as pipe:
+            for room_id, connections in rooms:
+                key = room_keys(room_id)[0]
+                pipe.zadd(key, {connection: expires_at for connection in connections}, xx=True)
+                pipe.zmscore(key, list(connections))
+            results = await pipe.execute()
+
+        # A stalled loop can miss heartbeats long enough for a sweeper to drop live
+        # connections; JOIN puts them back along with the refcounts and online state
+        rejoined = []
+        for (room_id, connections), scores in zip(rooms, results[1::2]):
+            missing = [connection for connection, score in zip(connections, scores) if score is None]
+            for connection in missing:
+                if connection in self.local.get(room_id, ()):
+                    await self._join(room_id, connection, connections[connection], expires_at)
+            if missing:
+                logger.info("Re-registered %d swept connections in room %s", len(missing), room_id)
+                rejoined.append(room_id)
+        return rejoined
+
+    async def _sweep(self, now):
+        client = get_redis()
+        changed = []
+        for room_id in await client.smembers(ROOMS_KEY):
+            room_id = room_id.decode()
+            keys = room_keys(room_id)
+            expired = await client.zrangebyscore(keys[0], "-inf", now)
+            if not expired:
+                continue
+            dropped, _ = await self._leave(room_id, expired)
+            if dropped:
+                logger.info("Swept %d stale connections from room %s", dropped, room_id)
+                # Consumers know their rooms by int id
+                changed.append(int(room_id) if room_id.isdigit() else room_id)
+        return changed
+
+
+_trackers = weakref.WeakKeyDictionary()
+
+
+def get_presence():
+    """Return the presence tracker bound to the running event loop."""
+    loop = asyncio.get_running_loop()
+    tracker = _trackers.get(loop)
+    if tracker is None:
+        config = settings.CHAT_PRESENCE
+        tracker = Presence(
+            ttl=config["TTL"],
+            heartbeat_interval=config["HEARTBEAT_INTERVAL"],
+            sweep_interval=config["SWEEP_INTERVAL"],
+            broadcast_interval=config["BROADCAST_INTERVAL"],
+            flush_interval=config["FLUSH_INTERVAL"],
+            flush_batch=config["FLUSH_BATCH"],
+        )
+        _trackers[loop] = tracker
+    return tracker
+
+
+async def shutdown():
+    tracker = _trackers.pop(asyncio.get_running_loop(), None)
+    if tracker is not None:
+        await tracker.close()
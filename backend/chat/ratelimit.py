@@ -0,0 +1,121 @@
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+from redis.commands.core import Script
+from redis.exceptions import RedisError
+from rest_framework.throttling import BaseThrottle
+
+from . import metrics
+from .redis_client import LuaScript
+
+logger = logging.getLogger(__name__)
+
+# KEYS: bucket hash; ARGV: capacity, refill rate in tokens per second, cost.
+# Time comes from the Redis server so every process refills buckets alike.
+# Returns {allowed, seconds until enough tokens as a string}.
+TOKEN_BUCKET = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+local retry_after = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+else
+    retry_after = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity / rate * 1000))
+return {allowed, tostring(retry_after)}
+"""
+
+_async_script = LuaScript(TOKEN_BUCKET)
+# Run with an explicit client; bytes source spares it needing one to hash the script
+_sync_script = Script(None, TOKEN_BUCKET.encode())
+
+
+class TokenBucket:
+    """
+    Token bucket shared by every process through Redis.
+
+    Each key holds up to ``burst`` tokens, refilled at ``rate`` tokens per
+    second; an action spends one. Checks are a single atomic script call. If
+    Redis is unavailable the action is allowed rather than blocking chat.
+    """
+
+    def __init__(self, name, burst, rate):
+        self.name = name
+        self.burst = burst
+        self.rate = rate
+
+    def key(self, *parts):
+        return ":".join(["ratelimit", self.name, *(str(part) for part in parts)])
+
+    def _result(self, result):
+        allowed, retry_after = int(result[0]), float(result[1])
+        if not allowed:
+            metrics.rate_limited.inc(self.name)
+        return bool(allowed), retry_after
+
+    def consume(self, *parts):
+        """Spend a token for ``parts``; returns ``(allowed, retry_after_seconds)``."""
+        try:
+            result = _sync_script([self.key(*parts)], [self.burst, self.rate, 1], client=cache.client.get_client())
+        except RedisError as exc:
+            logger.warning("Rate limiter %s unavailable: %s", self.name, exc)
+            return True, 0.0
+        return self._result(result)
+
+    async def aconsume(self, *parts):
+        """:meth:`consume` on the event loop's asyncio Redis client."""
+        try:
+            result = await _async_script([self.key(*parts)], [self.burst, self.rate, 1])
+        except RedisError as exc:
+            logger.warning("Rate limiter %s unavailable: %s", self.name, exc)
+            return True, 0.0
+        return self._result(result)
+
+
+def get_bucket(name):
+    config = settings.CHAT_RATE_LIMIT[name]
+    return TokenBucket(name.lower(), config["BURST"], config["RATE"])
+
+
+class ChatWriteThrottle(BaseThrottle):
+    """
+    Throttles ``create`` on the chat viewsets with the shared token buckets.
+
+    New messages draw from the same per-user, per-room bucket as WebSocket
+    sends; new rooms from a per-user bucket.
+    """
+
+    def allow_request(self, request, view):
+        self.retry_after = None
+        if getattr(view, "action", None) != "create" or not request.user.is_authenticated:
+            return True
+        if view.basename == "message":
+            allowed, retry_after = get_bucket("MESSAGES").consume(request.user.pk, self.room(request.data))
+        else:
+            allowed, retry_after = get_bucket("ROOMS").consume(request.user.pk)
+        self.retry_after = retry_after
+        return allowed
+
+    @staticmethod
+    def room(data):
+        """The room of a new message as an int, so every spelling of an id shares a bucket; "-" if there is none."""
+        room = data.get("room") if isinstance(data, dict) else None
+        try:
+            return int(room)
+        except (TypeError, ValueError):
+            return "-"
+
+    def wait(self):
+        return self.retry_after
@@ -0,0 +1,53 @@
+import asyncio
+import weakref
+
+import redis.asyncio as aioredis
+from django.conf import settings
+
+_clients = weakref.WeakKeyDictionary()
+_scripts = weakref.WeakKeyDictionary()
+
+
+def get_redis():
+    """
+    Return the asyncio Redis client of the running event loop.
+
+    All clients of a loop share one connection pool, so consumer-side Redis
+    calls run on the event loop instead of queueing for the sync thread pool
+    that ``database_sync_to_async`` reserves for the ORM. Once every pooled
+    connection is busy, commands wait up to ``POOL_TIMEOUT`` seconds for one
+    instead of failing straight away.
+    """
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        config = settings.CHAT_REDIS
+        pool = aioredis.BlockingConnectionPool.from_url(
+            config["URL"],
+            max_connections=config["MAX_CONNECTIONS"],
+            timeout=config["POOL_TIMEOUT"],
+            **config["POOL_KWARGS"],
+        )
+        client = _clients[loop] = aioredis.Redis(connection_pool=pool)
+    return client
+
+
+class LuaScript:
+    """A Lua script run with EVALSHA (falling back to EVAL) on the current loop's client."""
+
+    def __init__(self, source):
+        self.source = source
+
+    async def __call__(self, keys=(), args=()):
+        client = get_redis()
+        scripts = _scripts.setdefault(client, {})
+        script = scripts.get(self.source)
+        if script is None:
+            script = scripts[self.source] = client.register_script(self.source)
+        return await script(keys=list(keys), args=list(args))
+
+
+async def shutdown():
+    client = _clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
@@ -0,0 +1,115 @@
+import logging
+import threading
+import time
+from collections import Counter
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from . import archive, history
+from .models import ArchiveSegment, Message, Room
+
+logger = logging.getLogger(__name__)
+
+MODE_BACKGROUND = "background"
+MODE_SYNC = "sync"
+
+
+def delete_messages(queryset, batch_size, pause=0.0, update_rooms=True, progress=None):
+    """
+    Delete the messages matched by ``queryset`` in primary-key batches; returns how many went.
+
+    Every batch is one ``DELETE ... WHERE id IN (...)`` in its own short
+    transaction, walking the primary key forward, followed by ``pause`` seconds
+    of sleep. Nothing is remembered between batches, so an interrupted run is
+    resumed by starting it again. With ``update_rooms`` the rooms' message counts,
+    previews and history buffers follow along. ``progress`` is called with the running
+    total after every batch.
+    """
+    deleted = 0
+    last_pk = 0
+    while True:
+        with transaction.atomic():
+            rows = list(
+                queryset.filter(pk__gt=last_pk).order_by("pk").values_list("pk", "room_id", "timestamp")[:batch_size]
+            )
+            if not rows:
+                break
+            # Nothing cascades from messages and they have no delete signals, so the
+            # collector, which would load every row first, is skipped; the summary
+            # upkeep Message.delete does is redone per batch below
+            Message.objects.filter(pk__in=[pk for pk, _, _ in rows])._raw_delete(Message.objects.db)
+            per_room = Counter(room_id for _, room_id, _ in rows)
+            if update_rooms:
+                for room_id, count in per_room.items():
+                    Room.objects.filter(pk=room_id).update(message_count=Greatest(F("message_count") - count, 0))
+                Room.objects.forget_messages(list(per_room), max(timestamp for _, _, timestamp in rows))
+        if update_rooms:
+            for room_id in per_room:
+                history.invalidate(room_id)
+        deleted += len(rows)
+        last_pk = rows[-1][0]
+        if progress is not None:
+            progress(deleted)
+        if len(rows) < batch_size:
+            break
+        if pause:
+            time.sleep(pause)
+    return deleted
+
+
+def enforce_retention(days, batch_size, pause=0.0, progress=None):
+    """
+    Delete messages older than ``days``, live and archived; returns ``(messages, segments)`` removed.
+
+    Archived history is dropped a whole segment at a time, once its newest
+    message is past the window.
+    """
+    cutoff = timezone.now() - timedelta(days=days)
+    deleted = delete_messages(Message.objects.filter(timestamp__lt=cutoff), batch_size, pause, progress=progress)
+    segments = 0
+    for segment in ArchiveSegment.objects.filter(last_timestamp__lt=cutoff).iterator():
+        with transaction.atomic():
+            segment.delete()
+            Room.objects.filter(pk=segment.room_id).update(
+                message_count=Greatest(F("message_count") - segment.message_count, 0)
+            )
+        history.invalidate(segment.room_id)
+        (archive.root() / segment.path).unlink(missing_ok=True)
+        deleted += segment.message_count
+        segments += 1
+    return deleted, segments
+
+
+def purge_room(room_id, batch_size=None, pause=None):
+    """Delete a room marked for deletion: its messages in batches, then its archive and the room itself."""
+    config = settings.CHAT_RETENTION
+    batch_size = batch_size or config["BATCH_SIZE"]
+    pause = config["PAUSE"] if pause is None else pause
+    started = time.perf_counter()
+    deleted = delete_messages(Message.objects.filter(room_id=room_id), batch_size, pause, update_rooms=False)
+    archive.remove_room(room_id)
+    # Whatever is left (messages that raced in, segment rows) is small enough to cascade
+    Room.objects.filter(pk=room_id).delete()
+    history.invalidate(room_id)
+    logger.info("Purged room %s: %d messages in %.1fs", room_id, deleted, time.perf_counter() - started)
+    return deleted
+
+
+def purge_in_background(room_id):
+    """Purge a room on a worker thread; ``manage.py purge_rooms`` finishes it if the process dies first."""
+
+    def run():
+        try:
+            purge_room(room_id)
+        except Exception:
+            logger.exception("Purging room %s failed", room_id)
+        finally:
+            # Database connections are per thread; this one is not reused
+            connection.close()
+
+    threading.Thread(target=run, name=f"purge-room-{room_id}", daemon=True).start()
@@ -0,0 +1,95 @@
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+
+from .redis_client import get_redis
+
+# Routing state of the HTTP request being handled; None outside requests
+_state = ContextVar("chat_db_routing", default=None)
+
+
+class RequestRouting:
+    """Whether the current request may still read from a replica, and whether it has written."""
+
+    __slots__ = ("replica", "wrote")
+
+    def __init__(self, replica):
+        self.replica = replica
+        self.wrote = False
+
+
+@contextmanager
+def request_routing(replica):
+    """Route the reads of the enclosed request to replicas while ``replica`` holds."""
+    state = RequestRouting(replica and bool(settings.CHAT_DB["REPLICAS"]))
+    token = _state.set(state)
+    try:
+        yield state
+    finally:
+        _state.reset(token)
+
+
+def reading_from_replica():
+    """Whether the current request's reads go to a replica."""
+    state = _state.get()
+    return state is not None and state.replica
+
+
+def sticky_key(user_id):
+    return f"db:sticky:{user_id}"
+
+
+def remember_write(user_id):
+    """Keep the user's reads on the primary for a while, until replicas have caught up with their write."""
+    cache.client.get_client().set(sticky_key(user_id), 1, ex=settings.CHAT_DB["STICKY_SECONDS"])
+
+
+def stick_if_recent_writer(user_id):
+    """Move the current request's reads to the primary if the user wrote moments ago."""
+    state = _state.get()
+    if state is not None and state.replica and user_id is not None:
+        if cache.client.get_client().exists(sticky_key(user_id)):
+            state.replica = False
+
+
+async def astick_if_recent_writer(user_id):
+    """:func:`stick_if_recent_writer` on the event loop's asyncio Redis client."""
+    state = _state.get()
+    if state is not None and state.replica and user_id is not None:
+        if await get_redis().exists(sticky_key(user_id)):
+            state.replica = False
+
+
+class ReplicaRouter:
+    """
+    Sends the reads of safe-method HTTP requests to a random replica, everything else to the primary.
+
+    Reads from WebSocket consumers, management commands and background threads
+    never see a request's routing state and stay on the primary, as does the
+    rest of a request once it has written anything.
+    """
+
+    def db_for_read(self, model, **hints):
+        state = _state.get()
+        if state is not None and state.replica:
+            return random.choice(settings.CHAT_DB["REPLICAS"])
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        state = _state.get()
+        if state is not None:
+            state.replica = False
+            state.wrote = True
+        # Always explicit: instances read from a replica would otherwise be saved back to it
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db not in settings.CHAT_DB["REPLICAS"]
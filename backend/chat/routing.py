@@ -2,5 +2,6 @@ from django.urls import path
 from . import consumers
 
 websocket_urlpatterns = [
+    path("ws/chat/", consumers.MultiplexChatConsumer.as_asgi()),
     path("ws/chat/<str:room_id>/", consumers.ChatConsumer.as_asgi()),
 ]
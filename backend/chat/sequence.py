@@ -0,0 +1,58 @@
+from channels.db import database_sync_to_async
+from django.core.cache import cache
+from redis.commands.core import Script
+
+from .redis_client import LuaScript
+
+# KEYS: room counter; ARGV: count, then the seed when the caller has one.
+# Returns the last number of the allocated range, or nil if the counter is
+# missing and no seed was given.
+ALLOCATE = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    if #ARGV < 2 then
+        return false
+    end
+    redis.call('SET', KEYS[1], ARGV[2])
+end
+return redis.call('INCRBY', KEYS[1], ARGV[1])
+"""
+
+_async_script = LuaScript(ALLOCATE)
+_sync_script = Script(None, ALLOCATE.encode())
+
+
+def counter_key(room_id):
+    # One counter per room however the id was spelled ("1", "01", 1)
+    return f"seq:{int(room_id)}"
+
+
+def load_seed(room_id):
+    """Highest sequence number persisted for a room, from ``Room.last_seq``."""
+    from .models import Room
+
+    return Room.objects.filter(pk=room_id).values_list("last_seq", flat=True).first() or 0
+
+
+def allocate(room_id, count=1):
+    """
+    Reserve ``count`` consecutive sequence numbers of a room; returns the last one.
+
+    Numbers come from a Redis counter so allocation never takes a row lock. A
+    missing counter (first use, or Redis lost it) is seeded from the database.
+    """
+    room_id = int(room_id)
+    client = cache.client.get_client()
+    last = _sync_script([counter_key(room_id)], [count], client=client)
+    if last is None:
+        last = _sync_script([counter_key(room_id)], [count, load_seed(room_id)], client=client)
+    return int(last)
+
+
+async def aallocate(room_id, count=1):
+    """:func:`allocate` on the event loop's asyncio Redis client."""
+    room_id = int(room_id)
+    last = await _async_script([counter_key(room_id)], [count])
+    if last is None:
+        seed = await database_sync_to_async(load_seed)(room_id)
+        last = await _async_script([counter_key(room_id)], [count, seed])
+    return int(last)
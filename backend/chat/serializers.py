@@ -2,6 +2,7 @@ from rest_framework import serializers
 from django.contrib.auth.models import User
 from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
 from rest_framework.exceptions import AuthenticationFailed
+from . import presence
 from .models import Room, Message, UserProfile
 
 
@@ -30,6 +31,13 @@ class UserSerializer(serializers.ModelSerializer):
 
 
 class CustomTokenObtainPairSerializer(TokenObtainPairSerializer):
+    @classmethod
+    def get_token(cls, user):
+        token = super().get_token(user)
+        # Lets WebSocket handshakes authenticate from claims alone
+        token["username"] = user.username
+        return token
+
     def validate(self, attrs):
         try:
             data = super().validate(attrs)
@@ -38,12 +46,29 @@ class CustomTokenObtainPairSerializer(TokenObtainPairSerializer):
         return data
 
 
+class UserProfileListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        profiles = list(data.all() if hasattr(data, "all") else data)
+        # One presence lookup for the whole page instead of one per profile
+        self.context.setdefault("online", presence.online_among(profile.user_id for profile in profiles))
+        return super().to_representation(profiles)
+
+
 class UserProfileSerializer(serializers.ModelSerializer):
     user = UserSerializer(read_only=True)
+    # Live from Redis presence; the column is only a periodically flushed copy
+    is_online = serializers.SerializerMethodField()
 
     class Meta:
         model = UserProfile
         fields = ("user", "is_online", "last_seen")
+        list_serializer_class = UserProfileListSerializer
+
+    def get_is_online(self, profile):
+        online = self.context.get("online")
+        if online is None:
+            return presence.is_online(profile.user_id)
+        return profile.user_id in online
 
 
 class MessageSerializer(serializers.ModelSerializer):
@@ -51,13 +76,43 @@ class MessageSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Message
-        fields = ("id", "room", "user", "content", "timestamp")
+        fields = ("id", "room", "user", "content", "timestamp", "seq")
+        read_only_fields = ("seq",)
+
+
+class UserSummarySerializer(serializers.ModelSerializer):
+    class Meta:
+        model = User
+        fields = ("id", "username")
+
+
+class MessageHistorySerializer(serializers.ModelSerializer):
+    """Read-only history row; expects ``user`` to be loaded with ``select_related``."""
+
+    user = UserSummarySerializer(read_only=True)
+    room = serializers.IntegerField(source="room_id", read_only=True)
+
+    class Meta:
+        model = Message
+        fields = ("id", "room", "user", "content", "timestamp", "seq")
+        read_only_fields = fields
 
 
 class RoomSerializer(serializers.ModelSerializer):
     created_by = UserSerializer(read_only=True)
-    messages = MessageSerializer(many=True, read_only=True)
 
     class Meta:
         model = Room
-        fields = ("id", "name", "created_at", "created_by", "messages")
+        fields = ("id", "name", "created_at", "created_by", "message_count", "last_message_preview", "last_activity_at")
+        read_only_fields = ("message_count", "last_message_preview", "last_activity_at")
+
+
+class RoomSummarySerializer(serializers.ModelSerializer):
+    """Room list entry built only from the room row and its creator; never touches messages."""
+
+    created_by = UserSummarySerializer(read_only=True)
+
+    class Meta:
+        model = Room
+        fields = ("id", "name", "created_at", "created_by", "message_count", "last_message_preview", "last_activity_at")
+        read_only_fields = fields
@@ -1,7 +1,28 @@
-from django.test import TestCase
+import asyncio
+import json
+import tempfile
+import threading
+from datetime import timedelta
+from unittest import mock, skipUnless
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.test import TestCase, TransactionTestCase, override_settings
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import OperationalError, connection
+from django.utils import timezone
 from rest_framework.test import APIClient
-from .models import Room, Message, UserProfile
+from rest_framework_simplejwt.tokens import AccessToken
+from .layers import LocalFanoutChannelLayer
+from .models import ArchiveSegment, ReadCursor, Room, Message, UserProfile
+from . import archive, auth, encoding, history, metrics, persistence, presence, redis_client, retention, routers, sequence, transfer, unread
+from .middleware import TokenAuthMiddleware
+from .outbound import Outbox
+from .routing import websocket_urlpatterns
+from .serializers import RoomSummarySerializer
 
 
 class ModelTests(TestCase):
@@ -17,6 +38,41 @@ class ModelTests(TestCase):
         self.assertIn("testuser", str(msg))
         self.assertIn("Hello", str(msg))
 
+    def test_room_summary_follows_messages(self):
+        first = Message.objects.create(room=self.room, user=self.user, content="First")
+        last = Message.objects.create(room=self.room, user=self.user, content="Second")
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.message_count, 2)
+        self.assertEqual(self.room.last_message_preview, "Second")
+        self.assertEqual(self.room.last_activity_at, last.timestamp)
+
+        last.delete()
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.message_count, 1)
+        self.assertEqual(self.room.last_message_preview, first.content)
+
+    def test_messages_are_numbered_per_room(self):
+        other_room = Room.objects.create(name="Other Room", created_by=self.user)
+        first = Message.objects.create(room=self.room, user=self.user, content="First")
+        elsewhere = Message.objects.create(room=other_room, user=self.user, content="Elsewhere")
+        second = Message.objects.create(room=self.room, user=self.user, content="Second")
+        self.assertEqual(second.seq, first.seq + 1)
+        self.room.refresh_from_db()
+        other_room.refresh_from_db()
+        self.assertEqual(self.room.last_seq, second.seq)
+        self.assertEqual(other_room.last_seq, elsewhere.seq)
+
+    def test_sequence_is_reseeded_from_database(self):
+        first = Message.objects.create(room=self.room, user=self.user, content="First")
+        cache.delete_pattern("seq:*")
+        second = Message.objects.create(room=self.room, user=self.user, content="Second")
+        self.assertEqual(second.seq, first.seq + 1)
+
+    def test_sequence_counter_ignores_id_spelling(self):
+        first = sequence.allocate(str(self.room.id))
+        self.assertEqual(sequence.allocate(f"0{self.room.id}"), first + 1)
+        self.assertEqual(sequence.allocate(self.room.id), first + 2)
+
     def test_userprofile_str(self):
         profile = UserProfile.objects.create(user=self.user)
         self.assertEqual(str(profile), "testuser")
@@ -24,6 +80,7 @@ class ModelTests(TestCase):
 
 class APITests(TestCase):
     def setUp(self):
+        cache.clear()
         self.user = User.objects.create_user(username="apiuser", password="apipass")
         self.client = APIClient()
         # Obtain JWT token
@@ -41,13 +98,71 @@ class APITests(TestCase):
     def test_list_rooms(self):
         response = self.client.get("/api/rooms/")
         self.assertEqual(response.status_code, 200)
-        self.assertGreaterEqual(len(response.data), 1)
+        self.assertGreaterEqual(len(response.json()["results"]), 1)
+
+    def test_list_rooms_returns_summaries(self):
+        Message.objects.create(room=self.room, user=self.user, content="First")
+        Message.objects.create(room=self.room, user=self.user, content="Latest")
+        response = self.client.get("/api/rooms/")
+        room = next(r for r in response.json()["results"] if r["id"] == self.room.id)
+        self.assertNotIn("messages", room)
+        self.assertEqual(room["message_count"], 2)
+        self.assertEqual(room["last_message_preview"], "Latest")
+        self.assertEqual(room["created_by"], {"id": self.user.id, "username": "apiuser"})
+
+    def test_list_rooms_query_count_is_constant(self):
+        for i in range(5):
+            room = Room.objects.create(name=f"Busy {i}", created_by=self.user)
+            Message.objects.create(room=room, user=self.user, content="Hi")
+        # Users come from token claims and a short first page is its own count,
+        # leaving one joined room query
+        with self.assertNumQueries(1):
+            response = self.client.get("/api/rooms/")
+        self.assertEqual(response.json()["count"], 6)
+
+    def test_list_rooms_pages_like_drf(self):
+        for i in range(4):
+            Room.objects.create(name=f"Paged {i}", created_by=self.user)
+        first = self.client.get("/api/rooms/", {"page_size": 2}).json()
+        self.assertEqual(first["count"], 5)
+        self.assertIsNone(first["previous"])
+        second = self.client.get(first["next"]).json()
+        self.assertEqual(second["previous"], "http://testserver/api/rooms/?page_size=2")
+        last = self.client.get("/api/rooms/", {"page_size": 2, "page": "last"}).json()
+        self.assertIsNone(last["next"])
+        self.assertEqual(last["results"], [RoomSummarySerializer(self.room).data])
+        self.assertEqual(self.client.get("/api/rooms/", {"page": 9}).status_code, 404)
+
+    def test_me(self):
+        response = self.client.get("/api/users/me/")
+        self.assertEqual(response.json(), {"id": self.user.id, "username": "apiuser", "email": ""})
 
     def test_create_message(self):
         response = self.client.post("/api/messages/", {"room": self.room.id, "content": "Test message"})
         self.assertEqual(response.status_code, 201)
         self.assertEqual(Message.objects.filter(content="Test message").count(), 1)
 
+    @override_settings(CHAT_RATE_LIMIT={"MESSAGES": {"BURST": 2, "RATE": 0.01}, "ROOMS": {"BURST": 1, "RATE": 0.01}})
+    def test_create_is_throttled_per_user_and_room(self):
+        for _ in range(2):
+            response = self.client.post("/api/messages/", {"room": self.room.id, "content": "Burst"})
+            self.assertEqual(response.status_code, 201)
+        response = self.client.post("/api/messages/", {"room": self.room.id, "content": "Burst"})
+        self.assertEqual(response.status_code, 429)
+        self.assertIn("Retry-After", response)
+        self.assertEqual(Message.objects.filter(content="Burst").count(), 2)
+
+        # Another spelling of the same room id draws from the same bucket
+        response = self.client.post("/api/messages/", {"room": f"0{self.room.id}", "content": "Burst"})
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(self.client.post("/api/messages/", [1, 2], format="json").status_code, 400)
+
+        other_room = Room.objects.create(name="Other Room", created_by=self.user)
+        response = self.client.post("/api/messages/", {"room": other_room.id, "content": "Burst"})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.client.post("/api/rooms/", {"name": "First"}).status_code, 201)
+        self.assertEqual(self.client.post("/api/rooms/", {"name": "Second"}).status_code, 429)
+
     def test_list_messages(self):
         Message.objects.create(room=self.room, user=self.user, content="Msg1")
         response = self.client.get("/api/messages/")
@@ -92,18 +207,1045 @@ class APITests(TestCase):
         self.assertIn("access", login.data)
 
     def test_userprofile_online_status(self):
-        UserProfile.objects.create(user=self.user, is_online=True)
+        # The flag on the row is stale; who is online comes from Redis presence
+        UserProfile.objects.create(user=User.objects.create_user(username="away", password="awaypass"), is_online=True)
+        cache.client.get_client().zadd(presence.ONLINE_KEY, {self.user.id: timezone.now().timestamp()})
         response = self.client.get("/api/profiles/online_users/")
         self.assertEqual(response.status_code, 200)
-        self.assertGreaterEqual(len(response.data), 1)
+        self.assertEqual(response.data["count"], 1)
+        self.assertEqual(response.data["results"][0]["user"]["username"], "apiuser")
+        self.assertTrue(response.data["results"][0]["is_online"])
 
     def test_room_messages_endpoint(self):
         Message.objects.create(room=self.room, user=self.user, content="Msg1")
         response = self.client.get(f"/api/rooms/{self.room.id}/messages/")
         self.assertEqual(response.status_code, 200)
-        self.assertGreaterEqual(len(response.data), 1)
+        self.assertGreaterEqual(len(response.json()["results"]), 1)
+        self.assertEqual(response.json()["results"][0]["user"], {"id": self.user.id, "username": "apiuser"})
+
+    def test_room_messages_cursor_pagination(self):
+        for i in range(5):
+            Message.objects.create(room=self.room, user=self.user, content=f"Msg{i}")
+        url = f"/api/rooms/{self.room.id}/messages/"
+
+        newest = self.client.get(url, {"limit": 2})
+        self.assertEqual([m["content"] for m in newest.json()["results"]], ["Msg3", "Msg4"])
+        self.assertIsNone(newest.json()["after"])
+
+        older = self.client.get(url, {"limit": 2, "before": newest.json()["before"]})
+        self.assertEqual([m["content"] for m in older.json()["results"]], ["Msg1", "Msg2"])
+
+        oldest = self.client.get(url, {"limit": 2, "before": older.json()["before"]})
+        self.assertEqual([m["content"] for m in oldest.json()["results"]], ["Msg0"])
+        self.assertIsNone(oldest.json()["before"])
+
+        newer = self.client.get(url, {"limit": 2, "after": oldest.json()["after"]})
+        self.assertEqual([m["content"] for m in newer.json()["results"]], ["Msg1", "Msg2"])
+
+    def test_room_messages_query_count_is_constant(self):
+        others = [User.objects.create_user(username=f"member{i}", password="pass") for i in range(5)]
+        for other in others:
+            Message.objects.create(room=self.room, user=other, content="Hi")
+        # Room lookup and one history query, regardless of how many authors
+        with self.assertNumQueries(2):
+            response = self.client.get(f"/api/rooms/{self.room.id}/messages/")
+        self.assertEqual(len(response.json()["results"]), 5)
+
+    def test_room_messages_newest_page_from_buffer(self):
+        url = f"/api/rooms/{self.room.id}/messages/"
+        Message.objects.create(room=self.room, user=self.user, content="Old")
+        self.client.get(url)  # miss primes the buffer
+        self.client.post("/api/messages/", {"room": self.room.id, "content": "Fresh"})
+
+        # Room lookup only; the page itself comes from Redis
+        with self.assertNumQueries(1):
+            response = self.client.get(url)
+        self.assertEqual([m["content"] for m in response.json()["results"]], ["Old", "Fresh"])
+        self.assertEqual(history.stats()["hits"], 1)
+        self.assertEqual(history.stats()["misses"], 1)
+
+    def test_replica_pages_do_not_prime_buffer(self):
+        Message.objects.create(room=self.room, user=self.user, content="Lagging")
+        with mock.patch.object(routers, "reading_from_replica", return_value=True):
+            response = self.client.get(f"/api/rooms/{self.room.id}/messages/")
+        self.assertEqual(len(response.json()["results"]), 1)
+        self.assertIsNone(history.HistoryBuffer(self.room.id).recent(10))
+
+    def test_message_delete_invalidates_buffer(self):
+        url = f"/api/rooms/{self.room.id}/messages/"
+        msg = Message.objects.create(room=self.room, user=self.user, content="Doomed")
+        self.client.get(url)
+        self.client.delete(f"/api/messages/{msg.id}/")
+        response = self.client.get(url)
+        self.assertEqual(response.json()["results"], [])
+
+    def test_room_messages_conditional_get(self):
+        url = f"/api/rooms/{self.room.id}/messages/"
+        Message.objects.create(room=self.room, user=self.user, content="Seen")
+        response = self.client.get(url)
+        self.assertEqual(response["Cache-Control"], "private, no-cache")
+        self.assertIn("Authorization", response["Vary"])
+        self.assertIn("Last-Modified", response)
+        etag = response["ETag"]
+
+        # Answered from the room's version in Redis and a check that the room is still there
+        with self.assertNumQueries(1):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+
+        self.client.post("/api/messages/", {"room": self.room.id, "content": "Unseen"})
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_rooms_conditional_get(self):
+        listing = self.client.get("/api/rooms/")
+        detail = self.client.get(f"/api/rooms/{self.room.id}/")
+        self.assertEqual(self.client.get("/api/rooms/", HTTP_IF_NONE_MATCH=listing["ETag"]).status_code, 304)
+        self.assertEqual(
+            self.client.get(f"/api/rooms/{self.room.id}/", HTTP_IF_NONE_MATCH=detail["ETag"]).status_code, 304
+        )
+
+        # Saving a room changes its version and the list's
+        self.client.patch(f"/api/rooms/{self.room.id}/", {"name": "Renamed"})
+        response = self.client.get(f"/api/rooms/{self.room.id}/", HTTP_IF_NONE_MATCH=detail["ETag"])
+        self.assertEqual(response.json()["name"], "Renamed")
+        self.assertEqual(self.client.get("/api/rooms/", HTTP_IF_NONE_MATCH=listing["ETag"]).status_code, 200)
+
+    def test_deleted_room_is_not_revalidated(self):
+        detail = self.client.get(f"/api/rooms/{self.room.id}/")["ETag"]
+        history_etag = self.client.get(f"/api/rooms/{self.room.id}/messages/")["ETag"]
+        # Marked deleted without its version moving, as when Redis was down during the delete
+        Room.objects.filter(pk=self.room.id).update(deleted_at=timezone.now())
+        response = self.client.get(f"/api/rooms/{self.room.id}/", HTTP_IF_NONE_MATCH=detail)
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get(f"/api/rooms/{self.room.id}/messages/", HTTP_IF_NONE_MATCH=history_etag)
+        self.assertEqual(response.status_code, 404)
+
+    def test_room_messages_invalid_cursor(self):
+        response = self.client.get(f"/api/rooms/{self.room.id}/messages/", {"before": "garbage"})
+        self.assertEqual(response.status_code, 404)
+
+    def test_search_requires_query(self):
+        response = self.client.get("/api/messages/search/", {"q": "  "})
+        self.assertEqual(response.status_code, 400)
+
+    @skipUnless(connection.vendor == "postgresql", "full-text search needs PostgreSQL")
+    def test_search_ranks_and_pages_matches(self):
+        other_room = Room.objects.create(name="Other Room", created_by=self.user)
+        for content in ("deploy failed", "deploy deploy deploy", "lunch?", "the deploy is done"):
+            Message.objects.create(room=self.room, user=self.user, content=content)
+        Message.objects.create(room=other_room, user=self.user, content="deploying elsewhere")
+
+        response = self.client.get("/api/messages/search/", {"q": "deploy", "limit": 2})
+        self.assertEqual(response.data["results"][0]["content"], "deploy deploy deploy")
+        contents = [m["content"] for m in response.data["results"]]
+        response = self.client.get("/api/messages/search/", {"q": "deploy", "limit": 2, "cursor": response.data["next"]})
+        contents += [m["content"] for m in response.data["results"]]
+        self.assertIsNone(response.data["next"])
+        self.assertEqual(len(contents), 4)
+        self.assertEqual(len(set(contents)), 4)
+        self.assertNotIn("lunch?", contents)
+
+        response = self.client.get("/api/messages/search/", {"q": "deploy", "room": other_room.id})
+        self.assertEqual([m["content"] for m in response.data["results"]], ["deploying elsewhere"])
+
+        # Rooms waiting for their purge are hidden from search
+        Room.objects.filter(pk=other_room.pk).update(deleted_at=timezone.now())
+        response = self.client.get("/api/messages/search/", {"q": "deploy", "room": other_room.id})
+        self.assertEqual(response.data["results"], [])
 
     def test_invalid_token(self):
         self.client.credentials(HTTP_AUTHORIZATION="Bearer invalidtoken")
         response = self.client.get("/api/rooms/")
         self.assertEqual(response.status_code, 401)
+
+
+class ArchiveTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        root = tempfile.TemporaryDirectory()
+        self.addCleanup(root.cleanup)
+        archive.read_entries.cache_clear()
+        self.enterContext(override_settings(CHAT_ARCHIVE={**settings.CHAT_ARCHIVE, "ROOT": root.name}))
+        self.user = User.objects.create_user(username="archivist", password="archivepass")
+        self.room = Room.objects.create(name="Old Room", created_by=self.user)
+        self.client = APIClient()
+        # History is served by an async view, which force_authenticate does not reach
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {AccessToken.for_user(self.user)}")
+
+    def test_old_messages_move_to_segments_and_stay_readable(self):
+        old = timezone.now() - timedelta(days=200)
+        for i in range(5):
+            message = Message.objects.create(room=self.room, user=self.user, content=f"old {i}")
+            # Two months' worth, so the run writes two segments
+            Message.objects.filter(pk=message.pk).update(timestamp=old + timedelta(days=20 * i))
+        for i in range(2):
+            Message.objects.create(room=self.room, user=self.user, content=f"new {i}")
+
+        self.assertEqual(archive.archive_messages(older_than_days=90, batch_size=3), {self.room.id: 5})
+        self.assertEqual(Message.objects.filter(room=self.room).count(), 2)
+        segments = ArchiveSegment.objects.filter(room=self.room)
+        self.assertGreater(segments.count(), 1)
+        self.assertEqual(sum(segment.message_count for segment in segments), 5)
+
+        url = f"/api/rooms/{self.room.id}/messages/"
+        response = self.client.get(url, {"limit": 3})
+        contents = [m["content"] for m in response.json()["results"]]
+        self.assertEqual(contents, ["old 4", "new 0", "new 1"])
+        while response.json()["before"]:
+            response = self.client.get(url, {"limit": 3, "before": response.json()["before"]})
+            contents = [m["content"] for m in response.json()["results"]] + contents
+        self.assertEqual(contents, [f"old {i}" for i in range(5)] + ["new 0", "new 1"])
+
+        response = self.client.get(url, {"limit": 5, "after": response.json()["after"]})
+        self.assertEqual([m["content"] for m in response.json()["results"]], ["old 1", "old 2", "old 3", "old 4", "new 0"])
+        self.assertEqual(response.json()["results"][0]["seq"], 2)
+
+
+class TransferTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="exporter", password="exportpass")
+        self.room = Room.objects.create(name="Export Room", created_by=self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def export(self, room):
+        response = self.client.get(f"/api/rooms/{room.id}/export/")
+        self.assertEqual(response["Content-Type"], transfer.CONTENT_TYPE)
+        # The test client is a WSGI one, so the body must come from a sync iterator
+        self.assertFalse(response.is_async)
+        return b"".join(response).decode().splitlines()
+
+    def test_export_then_import_round_trips_history(self):
+        other = User.objects.create_user(username="talker", password="talkpass")
+        for i in range(5):
+            Message.objects.create(room=self.room, user=self.user if i % 2 else other, content=f"line {i}")
+        lines = self.export(self.room)
+        self.assertEqual([json.loads(line)["content"] for line in lines], [f"line {i}" for i in range(5)])
+
+        target = Room.objects.create(name="Copy", created_by=self.user)
+        stats = transfer.import_lines(target, [line.replace('"talker"', '"newcomer"') for line in lines], 2)
+        self.assertEqual(stats.rows, 5)
+        self.assertEqual(stats.users_created, 1)
+
+        copied = list(Message.objects.filter(room=target).order_by("seq").values_list("content", "seq", "user__username"))
+        self.assertEqual([c[1] for c in copied], list(range(1, 6)))
+        self.assertEqual(copied[0], ("line 0", 1, "newcomer"))
+        originals = Message.objects.filter(room=self.room).order_by("seq").values_list("timestamp", flat=True)
+        imported = Message.objects.filter(room=target).order_by("seq").values_list("timestamp", flat=True)
+        self.assertEqual(list(imported), list(originals))
+
+        target.refresh_from_db()
+        self.assertEqual(target.message_count, 5)
+        self.assertEqual(target.last_seq, 5)
+        self.assertEqual(target.last_message_preview, "line 4")
+
+    def test_import_refuses_rooms_with_history(self):
+        Message.objects.create(room=self.room, user=self.user, content="already here")
+        entry = {"user": {"username": "exporter"}, "content": "old", "timestamp": "2020-01-01T00:00:00+00:00"}
+        with self.assertRaises(ValueError):
+            transfer.import_lines(self.room, [encoding.dumps(entry)])
+        self.assertEqual(Message.objects.filter(room=self.room).count(), 1)
+
+    def test_import_skips_malformed_lines(self):
+        entry = {"user": {"username": "exporter"}, "content": "kept", "timestamp": "2020-01-01T00:00:00+00:00"}
+        lines = [
+            encoding.dumps(entry),
+            "",
+            "{not json",
+            encoding.dumps({**entry, "timestamp": "yesterday"}),
+            encoding.dumps({"content": "no author"}),
+            encoding.dumps([1, 2]),
+            encoding.dumps(entry),
+        ]
+        with self.assertLogs("chat.transfer", "WARNING") as logs:
+            stats = transfer.import_lines(self.room, lines)
+        self.assertEqual((stats.rows, stats.skipped), (2, 4))
+        self.assertIn("Skipping line 3", logs.output[0])
+        self.assertEqual(Message.objects.filter(room=self.room, content="kept").count(), 2)
+
+    def test_only_the_owner_exports(self):
+        outsider = User.objects.create_user(username="outsider", password="outpass")
+        self.client.force_authenticate(outsider)
+        response = self.client.get(f"/api/rooms/{self.room.id}/export/")
+        self.assertEqual(response.status_code, 403)
+
+
+class RetentionTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="keeper", password="keeppass")
+        self.room = Room.objects.create(name="Retained", created_by=self.user)
+
+    def test_old_messages_are_deleted_in_batches(self):
+        for i in range(5):
+            message = Message.objects.create(room=self.room, user=self.user, content=f"old {i}")
+            Message.objects.filter(pk=message.pk).update(timestamp=timezone.now() - timedelta(days=60))
+        Message.objects.create(room=self.room, user=self.user, content="new")
+
+        progress = []
+        deleted, segments = retention.enforce_retention(30, batch_size=2, progress=progress.append)
+        self.assertEqual((deleted, segments), (5, 0))
+        self.assertEqual(progress, [2, 4, 5])
+        self.assertEqual(list(Message.objects.filter(room=self.room).values_list("content", flat=True)), ["new"])
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.message_count, 1)
+        self.assertEqual(self.room.last_message_preview, "new")
+
+    def test_summary_of_an_emptied_room_is_cleared(self):
+        message = Message.objects.create(room=self.room, user=self.user, content="secret")
+        long_ago = timezone.now() - timedelta(days=60)
+        Message.objects.filter(pk=message.pk).update(timestamp=long_ago)
+        Room.objects.filter(pk=self.room.pk).update(last_activity_at=long_ago)
+        busy = Room.objects.create(name="Busy", created_by=self.user)
+        Message.objects.create(room=busy, user=self.user, content="recent")
+
+        retention.enforce_retention(30, batch_size=10)
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.last_message_preview, "")
+        self.assertEqual(self.room.last_activity_at, self.room.created_at)
+        busy.refresh_from_db()
+        self.assertEqual(busy.last_message_preview, "recent")
+
+    def test_room_is_hidden_then_purged_in_background(self):
+        Message.objects.create(room=self.room, user=self.user, content="doomed")
+        client = APIClient()
+        client.force_authenticate(self.user)
+        with mock.patch.object(retention, "purge_in_background") as purge:
+            with self.captureOnCommitCallbacks(execute=True) as callbacks:
+                response = client.delete(f"/api/rooms/{self.room.id}/")
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(len(callbacks), 1)
+        purge.assert_called_once_with(self.room.id)
+        self.assertEqual(client.get(f"/api/rooms/{self.room.id}/").status_code, 404)
+        self.assertTrue(Message.objects.filter(room=self.room).exists())
+
+        self.assertEqual(retention.purge_room(self.room.id, batch_size=1, pause=0), 1)
+        self.assertFalse(Room.objects.filter(pk=self.room.id).exists())
+
+
+class UnreadTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="reader", password="readpass")
+        self.rooms = [Room.objects.create(name=f"Unread {i}", created_by=self.user) for i in range(2)]
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def post(self, room, count):
+        for i in range(count):
+            Message.objects.create(room=room, user=self.user, content=f"message {i}")
+
+    def test_counts_follow_cursor_and_new_messages(self):
+        self.post(self.rooms[0], 3)
+        self.post(self.rooms[1], 2)
+        response = self.client.post(f"/api/rooms/{self.rooms[0].id}/read/", {"seq": 2}, format="json")
+        self.assertEqual(response.data, {"room": self.rooms[0].id, "seq": 2})
+        self.client.post(f"/api/rooms/{self.rooms[1].id}/read/", {"seq": 2}, format="json")
+        # Cursors never move back, nor past the newest message
+        self.assertEqual(unread.advance(self.user.id, self.rooms[0].id, 1), 2)
+        self.assertEqual(unread.advance(self.user.id, self.rooms[1].id, 50), 2)
+
+        self.post(self.rooms[1], 4)
+        with self.assertNumQueries(1):
+            counts = self.client.get("/api/rooms/unread/").data
+        self.assertEqual(counts, {str(self.rooms[0].id): 1, str(self.rooms[1].id): 4})
+        self.assertEqual(
+            self.client.post(f"/api/rooms/{self.rooms[0].id}/read/", {"seq": "x"}, format="json").status_code, 400
+        )
+
+    def test_cursors_survive_losing_redis(self):
+        self.post(self.rooms[0], 5)
+        unread.advance(self.user.id, self.rooms[0].id, 3)
+        self.assertEqual(unread.checkpoint(), 1)
+        self.assertEqual(unread.checkpoint(), 0)
+        self.assertEqual(ReadCursor.objects.get(user=self.user, room=self.rooms[0]).seq, 3)
+
+        cache.clear()
+        self.assertEqual(unread.unread_counts(self.user.id), {self.rooms[0].id: 2})
+        self.assertEqual(unread.advance(self.user.id, self.rooms[0].id, 2), 3)
+
+    def test_rooms_are_counted_from_the_first_read(self):
+        self.post(self.rooms[0], 2)
+        self.post(self.rooms[1], 3)
+        unread.advance(self.user.id, self.rooms[0].id, 1)
+        # Never read, so not followed yet
+        self.assertEqual(unread.unread_counts(self.user.id), {self.rooms[0].id: 1})
+        self.assertEqual(unread.advance(self.user.id, self.rooms[1].id, 0), 0)
+        self.assertEqual(unread.unread_counts(self.user.id), {self.rooms[0].id: 1, self.rooms[1].id: 3})
+
+    def test_rest_reads_start_checkpointing(self):
+        self.post(self.rooms[0], 2)
+        checkpointer = unread.Checkpointer(interval=0.01)
+        ran = threading.Event()
+        with mock.patch.object(unread, "checkpointer", checkpointer), mock.patch.object(
+            unread, "checkpoint", side_effect=lambda batch_size: ran.set() or 0
+        ):
+            self.client.post(f"/api/rooms/{self.rooms[0].id}/read/", {"seq": 1}, format="json")
+            self.assertTrue(ran.wait(1))
+            checkpointer.close()
+
+    def test_malformed_entries_are_skipped(self):
+        self.post(self.rooms[0], 2)
+        unread.advance(self.user.id, self.rooms[0].id, 1)
+        client = cache.client.get_client()
+        client.hset(unread.cursor_key(self.user.id), "abc", 1)
+        client.sadd(unread.DIRTY_KEY, f"{self.user.id}:abc")
+        self.assertEqual(unread.unread_counts(self.user.id), {self.rooms[0].id: 1})
+        self.assertEqual(unread.checkpoint(), 2)
+        self.assertEqual(ReadCursor.objects.get(user=self.user, room=self.rooms[0]).seq, 1)
+
+
+@override_settings(CHAT_DB={"REPLICAS": ["replica_0", "replica_1"], "STICKY_SECONDS": 5})
+class ReplicaRouterTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.router = routers.ReplicaRouter()
+
+    def test_safe_requests_read_from_replicas_until_they_write(self):
+        self.assertEqual(self.router.db_for_read(Message), "default")
+        with routers.request_routing(replica=True) as state:
+            self.assertIn(self.router.db_for_read(Message), ["replica_0", "replica_1"])
+            self.assertEqual(self.router.db_for_write(Message), "default")
+            self.assertEqual(self.router.db_for_read(Message), "default")
+        self.assertTrue(state.wrote)
+        with routers.request_routing(replica=False):
+            self.assertEqual(self.router.db_for_read(Message), "default")
+        self.assertFalse(self.router.allow_migrate("replica_0", "chat"))
+
+    def test_user_reads_own_writes_from_primary(self):
+        routers.remember_write(1)
+        with routers.request_routing(replica=True):
+            routers.stick_if_recent_writer(1)
+            self.assertEqual(self.router.db_for_read(Message), "default")
+        with routers.request_routing(replica=True):
+            routers.stick_if_recent_writer(2)
+            self.assertIn(self.router.db_for_read(Message), ["replica_0", "replica_1"])
+
+
+class MessageWriterTests(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="writer", password="writerpass")
+        self.room = Room.objects.create(name="Writer Room", created_by=self.user)
+
+    async def test_flushes_when_batch_is_full(self):
+        metrics.writer_batch_size.clear()
+        writer = persistence.MessageWriter(batch_size=3, flush_interval=60, ack=persistence.ACK_FLUSH)
+        saved = await asyncio.gather(*(writer.submit(self.room.id, self.user, f"Msg{i}") for i in range(3)))
+        await writer.close()
+        self.assertTrue(all(message.pk for message in saved))
+        self.assertEqual(await database_sync_to_async(Message.objects.filter(room=self.room).count)(), 3)
+        exported = metrics.render()
+        self.assertIn("chat_writer_batch_size_count 1\n", exported)
+        self.assertIn("chat_writer_batch_size_sum 3.0\n", exported)
+        self.assertIn("chat_writer_queue_depth 0\n", exported)
+        room = await database_sync_to_async(Room.objects.get)(pk=self.room.pk)
+        self.assertEqual(room.message_count, 3)
+
+    async def test_close_flushes_pending_messages(self):
+        writer = persistence.MessageWriter(batch_size=100, flush_interval=60, ack=persistence.ACK_ENQUEUE)
+        await writer.submit(self.room.id, self.user, "Pending")
+        self.assertEqual(await database_sync_to_async(Message.objects.count)(), 0)
+        await writer.close()
+        self.assertEqual(await database_sync_to_async(Message.objects.filter(content="Pending").count)(), 1)
+
+    async def test_flush_ack_reports_rejected_rows(self):
+        metrics.writer_failed.clear()
+        writer = persistence.MessageWriter(batch_size=2, flush_interval=60, ack=persistence.ACK_FLUSH)
+        results = await asyncio.gather(
+            writer.submit(self.room.id, self.user, "Good"),
+            writer.submit(self.room.id + 1000, self.user, "Bad"),
+            return_exceptions=True,
+        )
+        await writer.close()
+        self.assertIsInstance(results[0], Message)
+        self.assertIsInstance(results[1], Exception)
+        self.assertIn("chat_writer_failed_total 1\n", metrics.render())
+
+    async def test_failed_batch_is_retried(self):
+        metrics.writer_dropped.clear()
+        writer = persistence.MessageWriter(batch_size=2, flush_interval=60, ack=persistence.ACK_FLUSH, retry_delay=0)
+        bulk_create = writer._bulk_create
+        attempts = []
+
+        def flaky(batch):
+            attempts.append(len(batch))
+            if len(attempts) == 1:
+                raise OperationalError("server closed the connection unexpectedly")
+            return bulk_create(batch)
+
+        writer._bulk_create = flaky
+        saved = await asyncio.gather(*(writer.submit(self.room.id, self.user, f"Retry{i}") for i in range(2)))
+        await writer.close()
+        self.assertEqual(attempts, [2, 2])
+        self.assertTrue(all(message.pk for message in saved))
+        self.assertEqual(await database_sync_to_async(Message.objects.filter(content__startswith="Retry").count)(), 2)
+        self.assertNotIn("\nchat_writer_dropped_total ", metrics.render())
+
+    @override_settings(CHAT_MESSAGE_WRITER={**settings.CHAT_MESSAGE_WRITER, "MODE": persistence.MODE_SYNC})
+    async def test_sync_mode_writes_immediately(self):
+        await persistence.save_message(self.room.id, self.user, "Now")
+        self.assertEqual(await database_sync_to_async(Message.objects.filter(content="Now").count)(), 1)
+
+
+class MetricsTests(TestCase):
+    def test_histogram_renders_cumulative_buckets(self):
+        histogram = metrics.Histogram("test_seconds", "Test histogram.", ("room",), buckets=(0.1, 1.0))
+        self.addCleanup(metrics._registry.remove, histogram)
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe(value, "7")
+
+        text = metrics.render()
+        self.assertIn('test_seconds_bucket{room="7",le="0.1"} 2', text)
+        self.assertIn('test_seconds_bucket{room="7",le="1.0"} 3', text)
+        self.assertIn('test_seconds_bucket{room="7",le="+Inf"} 4', text)
+        self.assertIn('test_seconds_count{room="7"} 4', text)
+
+    def test_gauge_drops_series_at_zero(self):
+        gauge = metrics.Gauge("test_connections", "Test gauge.", ("room",))
+        self.addCleanup(metrics._registry.remove, gauge)
+        gauge.inc("7")
+        gauge.inc("7")
+        gauge.dec("7")
+        self.assertIn('test_connections{room="7"} 1', metrics.render())
+        gauge.dec("7")
+        self.assertNotIn('test_connections{room="7"}', metrics.render())
+
+    def test_endpoint_reports_view_latency(self):
+        user = User.objects.create_user(username="scraped", password="scrapedpass")
+        client = APIClient()
+        # The room list is an async view, which force_authenticate does not reach
+        client.credentials(HTTP_AUTHORIZATION=f"Bearer {AccessToken.for_user(user)}")
+        client.get("/api/rooms/")
+
+        response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], metrics.CONTENT_TYPE)
+        self.assertIn(
+            'chat_http_request_seconds_count{view="RoomViewSet",action="list",method="GET",status="200"}',
+            response.content.decode(),
+        )
+        self.assertIn("chat_db_executor_queue_depth 0", response.content.decode())
+
+
+@override_settings(CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}})
+class ChatConsumerTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="sock", password="sockpass")
+        self.room = Room.objects.create(name="Socket Room", created_by=self.user)
+
+    async def connect(self, user, query=""):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f"/ws/chat/{self.room.id}/{query}")
+        communicator.scope["user"] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def drain(self, communicator):
+        """Discard frames (presence updates) until the socket goes quiet."""
+        while not await communicator.receive_nothing(timeout=0.2):
+            await communicator.receive_from()
+
+    async def test_broadcast_is_encoded_once(self):
+        sender = await self.connect(self.user)
+        listener = await self.connect(self.user)
+        await self.drain(sender)
+        await self.drain(listener)
+
+        layer = get_channel_layer()
+        sent = []
+        original_group_send = layer.group_send
+
+        async def spy(group, message):
+            sent.append(message)
+            await original_group_send(group, message)
+
+        layer.group_send = spy
+        await sender.send_json_to({"message": "Hello room"})
+        frames = [await sender.receive_from(), await listener.receive_from()]
+
+        self.assertEqual(frames[0], frames[1])
+        self.assertEqual(len(sent), 1)
+        self.assertEqual(sent[0]["text"], frames[0])
+        self.assertEqual(
+            json.loads(frames[0]), {"message": "Hello room", "user_id": self.user.id, "username": "sock", "seq": 1}
+        )
+        await sender.disconnect()
+        await listener.disconnect()
+        await presence.shutdown()
+
+    async def test_rejects_non_numeric_room(self):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), "/ws/chat/abc/")
+        communicator.scope["user"] = self.user
+        connected, _ = await communicator.connect()
+        self.assertFalse(connected)
+
+    async def test_read_ack_advances_cursor(self):
+        for content in ("one", "two"):
+            await database_sync_to_async(Message.objects.create)(room=self.room, user=self.user, content=content)
+        communicator = await self.connect(self.user)
+        await communicator.send_json_to({"action": "read", "seq": 1})
+        await self.drain(communicator)
+        counts = await database_sync_to_async(unread.unread_counts)(self.user.id)
+        self.assertEqual(counts, {self.room.id: 1})
+        await communicator.disconnect()
+        await unread.shutdown()
+        self.assertTrue(await database_sync_to_async(ReadCursor.objects.filter(room=self.room, seq=1).exists)())
+        await presence.shutdown()
+
+    async def test_reconnect_replays_only_the_gap(self):
+        for content in ("one", "two", "three"):
+            await database_sync_to_async(Message.objects.create)(room=self.room, user=self.user, content=content)
+
+        communicator = await self.connect(self.user, "?since=1")
+        self.assertEqual(json.loads(await communicator.receive_from())["type"], "online_users_count")
+        replay = json.loads(await communicator.receive_from())
+        self.assertEqual(replay["type"], "batch")
+        self.assertEqual([(m["seq"], m["message"]) for m in replay["messages"]], [(2, "two"), (3, "three")])
+
+        await self.drain(communicator)
+        await communicator.send_json_to({"message": "four"})
+        self.assertEqual(json.loads(await communicator.receive_from())["seq"], 4)
+        await communicator.disconnect()
+        await presence.shutdown()
+
+    @override_settings(CHAT_REPLAY={"MAX_MESSAGES": 1})
+    async def test_reconnect_after_long_gap_is_told_to_resync(self):
+        for content in ("one", "two", "three"):
+            await database_sync_to_async(Message.objects.create)(room=self.room, user=self.user, content=content)
+
+        communicator = await self.connect(self.user, "?since=1")
+        await communicator.receive_from()
+        self.assertEqual(json.loads(await communicator.receive_from()), {"type": "resync"})
+        await communicator.disconnect()
+        await presence.shutdown()
+
+    @override_settings(CHAT_RATE_LIMIT={"MESSAGES": {"BURST": 1, "RATE": 0.01}})
+    async def test_rate_limited_send_gets_error_frame(self):
+        sender = await self.connect(self.user)
+        await self.drain(sender)
+        await sender.send_json_to({"message": "first"})
+        self.assertEqual(json.loads(await sender.receive_from())["message"], "first")
+
+        await sender.send_json_to({"message": "second"})
+        frame = json.loads(await sender.receive_from())
+        self.assertEqual(frame["type"], "error")
+        self.assertEqual(frame["code"], "rate_limited")
+        self.assertGreater(frame["retry_after"], 0)
+        self.assertFalse(await database_sync_to_async(Message.objects.filter(content="second").exists)())
+        await sender.disconnect()
+        await presence.shutdown()
+
+    async def test_frame_without_message_gets_error_frame(self):
+        sender = await self.connect(self.user)
+        await self.drain(sender)
+        for frame in ({"text": "wrong key"}, {"message": 5}, {"message": "  "}):
+            await sender.send_json_to(frame)
+            self.assertEqual(
+                json.loads(await sender.receive_from()),
+                {"type": "error", "code": "invalid_message", "retry_after": None},
+            )
+        self.assertEqual(await database_sync_to_async(Message.objects.count)(), 0)
+        await sender.disconnect()
+        await presence.shutdown()
+
+    @override_settings(CHAT_OUTBOUND={**settings.CHAT_OUTBOUND, "BATCH_WINDOW": 0.5})
+    async def test_msgpack_subprotocol_batches_and_interns_usernames(self):
+        communicator = WebsocketCommunicator(
+            URLRouter(websocket_urlpatterns), f"/ws/chat/{self.room.id}/", subprotocols=[encoding.SUBPROTOCOL_MSGPACK]
+        )
+        communicator.scope["user"] = self.user
+        connected, subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        self.assertEqual(subprotocol, encoding.SUBPROTOCOL_MSGPACK)
+        self.assertEqual(encoding.unpack(await communicator.receive_from()), [encoding.EVENT_PRESENCE, 1])
+
+        await communicator.send_to(bytes_data=encoding.pack({"message": "first"}))
+        await communicator.send_to(bytes_data=encoding.pack({"message": "second"}))
+        self.assertEqual(
+            encoding.unpack(await communicator.receive_from()),
+            [
+                [encoding.EVENT_USER, self.user.id, "sock"],
+                [encoding.EVENT_MESSAGE, self.user.id, "first", 1],
+                [encoding.EVENT_MESSAGE, self.user.id, "second", 2],
+            ],
+        )
+        await communicator.send_to(bytes_data=encoding.pack({"message": "third"}))
+        self.assertEqual(
+            encoding.unpack(await communicator.receive_from()), [encoding.EVENT_MESSAGE, self.user.id, "third", 3]
+        )
+        await communicator.disconnect()
+        await presence.shutdown()
+
+    async def test_user_with_two_tabs_stays_online(self):
+        first = await self.connect(self.user)
+        second = await self.connect(self.user)
+        tracker = presence.get_presence()
+        self.assertEqual(await tracker.count(self.room.id), 1)
+
+        await first.disconnect()
+        self.assertEqual(await tracker.count(self.room.id), 1)
+        await second.disconnect()
+        self.assertEqual(await tracker.count(self.room.id), 0)
+        await presence.shutdown()
+
+
+@override_settings(CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}})
+class MultiplexChatConsumerTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="mux", password="muxpass")
+        self.rooms = [Room.objects.create(name=f"Mux Room {i}", created_by=self.user) for i in range(2)]
+
+    async def connect(self, user):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), "/ws/chat/")
+        communicator.scope["user"] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def drain(self, communicator):
+        while not await communicator.receive_nothing(timeout=0.2):
+            await communicator.receive_from()
+
+    async def test_one_socket_follows_several_rooms(self):
+        communicator = await self.connect(self.user)
+        first, second = (room.id for room in self.rooms)
+        # However the id is spelled, it is the same room
+        await communicator.send_json_to({"action": "subscribe", "room": str(first)})
+        await communicator.send_json_to({"action": "subscribe", "room": f"0{second}"})
+        counts = [json.loads(await communicator.receive_from()) for _ in range(2)]
+        self.assertEqual(
+            sorted(frame["room"] for frame in counts if frame["type"] == "online_users_count"), [first, second]
+        )
+        await self.drain(communicator)
+
+        await communicator.send_json_to({"room": second, "message": "hi two"})
+        self.assertEqual(
+            json.loads(await communicator.receive_from()),
+            {"room": second, "message": "hi two", "user_id": self.user.id, "username": "mux", "seq": 1},
+        )
+
+        await communicator.send_json_to({"room": second})
+        self.assertEqual(
+            json.loads(await communicator.receive_from()),
+            {"room": second, "type": "error", "code": "invalid_message", "retry_after": None},
+        )
+
+        await communicator.send_json_to({"action": "unsubscribe", "room": second})
+        await communicator.send_json_to({"room": second, "message": "gone"})
+        self.assertEqual(
+            json.loads(await communicator.receive_from()),
+            {"room": second, "type": "error", "code": "not_subscribed", "retry_after": None},
+        )
+        tracker = presence.get_presence()
+        self.assertEqual(await tracker.count(first), 1)
+        self.assertEqual(await tracker.count(second), 0)
+
+        await communicator.disconnect()
+        self.assertEqual(await tracker.count(first), 0)
+        await presence.shutdown()
+
+    async def test_subscribe_replays_since(self):
+        for content in ("one", "two"):
+            await database_sync_to_async(Message.objects.create)(room=self.rooms[0], user=self.user, content=content)
+
+        communicator = await self.connect(self.user)
+        await communicator.send_json_to({"action": "subscribe", "room": self.rooms[0].id, "since": 1})
+        self.assertEqual(json.loads(await communicator.receive_from())["type"], "online_users_count")
+        replay = json.loads(await communicator.receive_from())
+        self.assertEqual(replay["type"], "batch")
+        self.assertEqual(
+            replay["messages"],
+            [{"room": self.rooms[0].id, "message": "two", "user_id": self.user.id, "username": "mux", "seq": 2}],
+        )
+        await communicator.disconnect()
+        await presence.shutdown()
+
+    @override_settings(CHAT_MULTIPLEX={"MAX_ROOMS": 1})
+    async def test_subscriptions_are_capped(self):
+        communicator = await self.connect(self.user)
+        await communicator.send_json_to({"action": "subscribe", "room": self.rooms[0].id})
+        await communicator.receive_from()
+        await communicator.send_json_to({"action": "subscribe", "room": self.rooms[1].id})
+        self.assertEqual(json.loads(await communicator.receive_from())["code"], "too_many_rooms")
+        await communicator.disconnect()
+        await presence.shutdown()
+
+    async def test_invalid_rooms_are_refused(self):
+        communicator = await self.connect(self.user)
+        await communicator.send_json_to({"action": "subscribe", "room": "abc"})
+        self.assertEqual(json.loads(await communicator.receive_from())["code"], "invalid_room")
+        await communicator.send_json_to({"action": "subscribe", "room": 10**6})
+        self.assertEqual(
+            json.loads(await communicator.receive_from()),
+            {"room": 10**6, "type": "error", "code": "invalid_room", "retry_after": None},
+        )
+        await communicator.send_json_to({"room": ["nested"], "message": "hi"})
+        self.assertEqual(json.loads(await communicator.receive_from())["code"], "invalid_room")
+        await communicator.disconnect()
+
+    async def test_anonymous_socket_is_rejected(self):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), "/ws/chat/")
+        communicator.scope["user"] = auth.AnonymousUser()
+        connected, _ = await communicator.connect()
+        self.assertFalse(connected)
+
+
+class OutboxTests(TestCase):
+    def setUp(self):
+        self.sent = []
+
+    async def send(self, text):
+        self.sent.append(text)
+
+    async def test_failed_send_stops_the_writer_and_reports(self):
+        failures = []
+
+        async def broken_send(text):
+            raise RuntimeError("socket gone")
+
+        async def on_error():
+            failures.append(True)
+
+        outbox = Outbox(broken_send, on_error=on_error)
+        outbox.put_message('{"message":"lost"}')
+        await asyncio.wait_for(outbox.run(), 1)
+        self.assertEqual(failures, [True])
+        self.assertTrue(outbox.put_message('{"message":"after"}'))
+        self.assertEqual(len(outbox), 0)
+
+    async def test_backlog_goes_out_as_one_batch_frame(self):
+        outbox = Outbox(self.send, max_batch=3)
+        for i in range(4):
+            outbox.put_message(json.dumps({"message": str(i)}))
+        outbox.put_presence('{"type":"online_users_count","count":1}')
+        outbox.put_presence('{"type":"online_users_count","count":2}')
+        outbox.put_presence('{"room":"7","type":"online_users_count","count":5}', "7")
+        await outbox.flush()
+
+        frames = [json.loads(text) for text in self.sent]
+        self.assertEqual(frames[0], {"type": "online_users_count", "count": 2})
+        self.assertEqual(frames[1], {"room": "7", "type": "online_users_count", "count": 5})
+        self.assertEqual(frames[2], {"type": "batch", "messages": [{"message": "0"}, {"message": "1"}, {"message": "2"}]})
+        self.assertEqual(frames[3], {"message": "3"})
+
+    async def test_overflow_drops_oldest(self):
+        outbox = Outbox(self.send, max_size=2, policy="drop_oldest")
+        for i in range(3):
+            self.assertTrue(outbox.put_message(str(i)))
+        await outbox.flush()
+        self.assertEqual(self.sent, ['{"type":"batch","messages":[1,2]}'])
+
+    async def test_overflow_keeps_pinned_frames(self):
+        outbox = Outbox(self.send, max_size=2, policy="drop_oldest")
+        outbox.put_message("0", pinned=True)
+        for i in range(1, 4):
+            outbox.put_message(str(i))
+        await outbox.flush()
+        self.assertEqual(self.sent, ['{"type":"batch","messages":[0,3]}'])
+
+    async def test_overflow_disconnects_once(self):
+        outbox = Outbox(self.send, max_size=1, policy="disconnect")
+        self.assertTrue(outbox.put_message("1"))
+        self.assertFalse(outbox.put_message("2"))
+        self.assertTrue(outbox.put_message("3"))
+        await outbox.flush()
+        self.assertEqual(self.sent, [])
+
+
+@override_settings(CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}})
+class PresenceTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+
+    async def test_sweeper_drops_expired_connections(self):
+        tracker = presence.Presence(ttl=-1)
+        await tracker.join("7", "crashed-worker-channel", 1)
+        await tracker.join("7", "crashed-worker-channel-2", 2)
+        self.assertEqual(await tracker.count("7"), 2)
+
+        self.assertEqual(await tracker.sweep(), [7])
+        self.assertEqual(await tracker.count("7"), 0)
+        await tracker.close()
+
+    async def test_heartbeat_restores_swept_connections(self):
+        tracker = presence.Presence(broadcast_interval=0)
+        await tracker.join("7", "stalled-channel", 1)
+        # Another process's sweeper dropped it while this loop was stalled
+        await tracker._leave("7", ["stalled-channel"])
+        self.assertEqual(await tracker.count("7"), 0)
+
+        self.assertEqual(await tracker.heartbeat(), ["7"])
+        self.assertEqual(await tracker.count("7"), 1)
+        self.assertIsNotNone(await redis_client.get_redis().zscore(presence.ONLINE_KEY, 1))
+
+        await tracker.leave("7", "stalled-channel")
+        await asyncio.sleep(0.05)
+        self.assertEqual(tracker._last_broadcast, {})
+        await tracker.close()
+
+    async def test_online_users_are_aggregated_across_rooms(self):
+        user = await database_sync_to_async(User.objects.create_user)(username="roamer", password="roampass")
+        tracker = presence.Presence()
+        await tracker.join("7", "tab-1", user.id)
+        await tracker.join("8", "tab-2", user.id)
+        is_online = database_sync_to_async(presence.is_online)
+        self.assertTrue(await is_online(user.id))
+
+        await tracker.leave("7", "tab-1")
+        self.assertTrue(await is_online(user.id))
+        await tracker.leave("8", "tab-2")
+        self.assertFalse(await is_online(user.id))
+
+        # Coming online and going offline are one row write, at flush time
+        self.assertEqual(await tracker.flush(), 1)
+        self.assertEqual(await tracker.flush(), 0)
+        profile = await database_sync_to_async(UserProfile.objects.get)(user=user)
+        self.assertFalse(profile.is_online)
+        self.assertLess(timezone.now() - profile.last_seen, timedelta(seconds=5))
+        await tracker.close()
+
+    async def test_count_broadcasts_are_debounced(self):
+        layer = get_channel_layer()
+        sent = []
+
+        async def spy(group, message):
+            sent.append(json.loads(message["text"])["count"])
+
+        layer.group_send = spy
+        tracker = presence.Presence(broadcast_interval=0.2)
+        for user_id in range(10):
+            await tracker.join("8", f"channel-{user_id}", user_id)
+        await asyncio.sleep(0.4)
+
+        self.assertLessEqual(len(sent), 2)
+        self.assertEqual(sent[-1], 10)
+        await tracker.close()
+
+
+class TokenAuthMiddlewareTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="wsuser", password="wspass")
+        # Start every test from a cold record cache
+        auth.user_records.clear()
+
+    async def resolve(self, query_string):
+        scopes = []
+
+        async def app(scope, receive, send):
+            scopes.append(scope)
+
+        await TokenAuthMiddleware(app)({"type": "websocket", "query_string": query_string.encode()}, None, None)
+        return scopes[0]["user"]
+
+    def claims_token(self):
+        client = APIClient()
+        response = client.post("/api/token/", {"username": "wsuser", "password": "wspass"}, format="json")
+        return response.data["access"]
+
+    async def test_claims_token_authenticates_without_database(self):
+        token = await database_sync_to_async(self.claims_token)()
+        with mock.patch("chat.auth.load_user_record", side_effect=AssertionError("database hit")):
+            user = await self.resolve(f"token={token}")
+        self.assertTrue(user.is_authenticated)
+        self.assertEqual((user.id, user.username), (self.user.id, "wsuser"))
+
+    async def test_token_without_username_claim_is_cached(self):
+        token = str(AccessToken.for_user(self.user))
+        with mock.patch("chat.auth.load_user_record", wraps=auth.load_user_record) as load:
+            first = await self.resolve(f"token={token}")
+            second = await self.resolve(f"token={token}")
+        self.assertEqual(load.call_count, 1)
+        self.assertEqual(first.username, "wsuser")
+        self.assertEqual(second.username, "wsuser")
+
+    async def test_user_update_refreshes_cached_record(self):
+        token = await database_sync_to_async(self.claims_token)()
+        self.user.username = "renamed"
+        await database_sync_to_async(self.user.save)()
+        self.assertEqual((await self.resolve(f"token={token}")).username, "renamed")
+
+        self.user.is_active = False
+        await database_sync_to_async(self.user.save)()
+        self.assertFalse((await self.resolve(f"token={token}")).is_authenticated)
+
+    async def test_deactivation_reaches_other_processes(self):
+        token = await database_sync_to_async(self.claims_token)()
+        self.user.is_active = False
+        await database_sync_to_async(self.user.save)()
+        # Another process never saw the save and would trust the token's claims
+        auth.user_records.clear()
+        self.assertFalse((await self.resolve(f"token={token}")).is_authenticated)
+
+        self.user.is_active = True
+        await database_sync_to_async(self.user.save)()
+        auth.user_records.clear()
+        self.assertTrue((await self.resolve(f"token={token}")).is_authenticated)
+
+        await database_sync_to_async(self.user.delete)()
+        auth.user_records.clear()
+        self.assertFalse((await self.resolve(f"token={token}")).is_authenticated)
+
+    async def test_invalid_or_missing_token_is_anonymous(self):
+        self.assertFalse((await self.resolve("token=invalidtoken")).is_authenticated)
+        self.assertFalse((await self.resolve("")).is_authenticated)
+
+    async def test_query_string_values_may_contain_equals(self):
+        seen = []
+
+        async def fake_authenticate(token):
+            seen.append(token)
+            return auth.AnonymousUser()
+
+        middleware = TokenAuthMiddleware(mock.AsyncMock())
+        middleware._authenticate = fake_authenticate
+        await middleware({"type": "websocket", "query_string": b"since=3&token=abc.def==&x"}, None, None)
+        self.assertEqual(seen, ["abc.def=="])
+
+
+class RedisClientTests(TransactionTestCase):
+    async def test_client_and_pool_are_shared_per_loop(self):
+        client = redis_client.get_redis()
+        self.assertIs(redis_client.get_redis(), client)
+        script = redis_client.LuaScript("return redis.call('INCRBY', KEYS[1], ARGV[1])")
+        await client.delete("test:lua")
+        self.assertEqual(await script(["test:lua"], [2]), 2)
+        self.assertEqual(await script(["test:lua"], [3]), 5)
+        await redis_client.shutdown()
+
+    @override_settings(CHAT_REDIS={**settings.CHAT_REDIS, "MAX_CONNECTIONS": 1})
+    async def test_commands_wait_for_a_free_connection(self):
+        client = redis_client.get_redis()
+        await client.delete("test:pool")
+        results = await asyncio.gather(*(client.incr("test:pool") for _ in range(5)))
+        self.assertEqual(sorted(results), [1, 2, 3, 4, 5])
+        await redis_client.shutdown()
+
+
+class LocalFanoutChannelLayerTests(TestCase):
+    async def test_group_message_is_decoded_once_for_local_members(self):
+        metrics.layer_deliveries.clear()
+        channel_layer = LocalFanoutChannelLayer(hosts=["redis://localhost:6379"], prefix="chat")
+        layer = channel_layer._get_layer()
+        first, second = "chat.specific.a", "chat.specific.b"
+        for channel in (first, second):
+            layer.channels[channel] = asyncio.Queue()
+        layer.groups[layer._get_group_channel_name("room_1")] = {first, second}
+        payload = channel_layer.serialize({"type": "chat_message", "text": "{}"})
+
+        with mock.patch.object(channel_layer, "deserialize", wraps=channel_layer.deserialize) as deserialize:
+            layer._shards[0]._receive_message(
+                {"channel": layer._get_group_channel_name("room_1").encode(), "data": payload}
+            )
+
+        deserialize.assert_called_once()
+        message = layer.channels[first].get_nowait()
+        self.assertEqual(message, {"type": "chat_message", "text": "{}"})
+        self.assertIs(layer.channels[second].get_nowait(), message)
+        self.assertIn('chat_layer_deliveries_total{kind="group"} 2\n', metrics.render())
@@ -0,0 +1,174 @@
+import logging
+import time
+from datetime import datetime
+from itertools import islice
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.core.handlers.asgi import ASGIRequest
+from django.db import transaction
+
+from . import archive, encoding, history, sequence
+from .models import Message, Room
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "application/x-ndjson"
+
+
+def export_lines(room, chunk_size=2000):
+    """
+    A room's whole history as NDJSON history entries, oldest first.
+
+    Archived segments come first, one at a time, then live messages read
+    through a server-side cursor ``chunk_size`` rows at a time, so memory stays
+    flat however long the room is.
+    """
+    for segment in room.archive_segments.order_by("first_timestamp", "id").iterator():
+        for entry in archive.load_entries(segment.path, segment.codec):
+            yield encoding.dumps(entry) + "\n"
+    messages = (
+        Message.objects.filter(room=room)
+        .select_related("user")
+        .only("id", "room_id", "content", "timestamp", "seq", "user__id", "user__username")
+        .order_by("timestamp", "id")
+    )
+    for message in messages.iterator(chunk_size=chunk_size):
+        yield encoding.dumps(history.to_entry(message, message.user.username)) + "\n"
+
+
+def chunks(lines, lines_per_chunk=1000):
+    """Serve a line iterator to a WSGI response, ``lines_per_chunk`` lines per chunk."""
+    while True:
+        chunk = "".join(islice(lines, lines_per_chunk))
+        if not chunk:
+            return
+        yield chunk.encode()
+
+
+async def stream(lines, lines_per_chunk=1000):
+    """
+    Serve a synchronous line iterator to an ASGI response a chunk at a time.
+
+    Django buffers synchronous iterators whole under ASGI; this pulls
+    ``lines_per_chunk`` lines per hop onto the request's database thread, where
+    the cursor behind ``lines`` lives.
+    """
+    next_chunk = sync_to_async(lambda: "".join(islice(lines, lines_per_chunk)))
+    while True:
+        chunk = await next_chunk()
+        if not chunk:
+            return
+        yield chunk.encode()
+
+
+def streaming_content(request, lines):
+    """:func:`stream` for requests served over ASGI, :func:`chunks` for WSGI ones."""
+    if isinstance(request, ASGIRequest):
+        return stream(lines)
+    return chunks(lines)
+
+
+class TransferStats:
+    def __init__(self):
+        self.rows = 0
+        self.users_created = 0
+        self.skipped = 0
+        self.started = time.perf_counter()
+
+    @property
+    def seconds(self):
+        return time.perf_counter() - self.started
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.seconds if self.seconds else 0.0
+
+
+def _resolve_users(usernames, user_ids, stats):
+    """Fill ``user_ids`` (username -> id) for ``usernames``, creating accounts that do not exist here."""
+    missing = [name for name in usernames if name not in user_ids]
+    if not missing:
+        return
+    user_ids.update(User.objects.filter(username__in=missing).values_list("username", "id"))
+    new_users = [User(username=name) for name in missing if name not in user_ids]
+    for user in new_users:
+        # Imported authors exist only to own their messages until someone resets the password
+        user.set_unusable_password()
+    if new_users:
+        User.objects.bulk_create(new_users)
+        user_ids.update(User.objects.filter(username__in=[u.username for u in new_users]).values_list("username", "id"))
+        stats.users_created += len(new_users)
+
+
+def _parse_entry(line):
+    """``(username, content, timestamp)`` of one exported history entry; ValueError if it is not one."""
+    try:
+        entry = encoding.loads(line)
+        username, content = entry["user"]["username"], entry["content"]
+        timestamp = datetime.fromisoformat(entry["timestamp"])
+    except (KeyError, TypeError, ValueError) as exc:
+        raise ValueError(f"not a history entry ({exc!r})") from None
+    if not isinstance(username, str) or not username or not isinstance(content, str):
+        raise ValueError("not a history entry (bad user or content)")
+    return username, content, timestamp
+
+
+def _import_batch(room, entries, user_ids, stats):
+    _resolve_users({username for username, _, _ in entries}, user_ids, stats)
+    # The room is empty, so the imported messages are its first, numbered in the order they were exported
+    last_seq = sequence.allocate(room.id, count=len(entries))
+    first_seq = last_seq - len(entries) + 1
+    messages = [
+        Message(
+            room_id=room.id,
+            user_id=user_ids[username],
+            content=content,
+            timestamp=timestamp,
+            seq=first_seq + offset,
+        )
+        for offset, (username, content, timestamp) in enumerate(entries)
+    ]
+    with transaction.atomic():
+        Message.objects.bulk_create(messages)
+        Room.objects.record_messages(messages)
+    stats.rows += len(messages)
+
+
+def import_lines(room, lines, batch_size=2000, progress=None):
+    """
+    Load NDJSON history entries, as written by :func:`export_lines`, into an empty ``room``.
+
+    Messages keep their original timestamps, so the room must hold no messages
+    or archive yet: older rows numbered after newer ones would break history
+    paging and the archive cut-off. Raises ValueError otherwise.
+
+    Entries are written ``batch_size`` at a time with ``bulk_create``, each batch
+    in its own transaction. Authors are matched by username. Blank lines are
+    ignored; lines that are not history entries are logged with their line
+    number and counted in :attr:`TransferStats.skipped`. ``progress`` is called
+    with the running :class:`TransferStats` after every batch.
+    """
+    if room.messages.exists() or room.archive_segments.exists():
+        raise ValueError(f"Room {room.id} already has messages; import into an empty room")
+    stats = TransferStats()
+    user_ids = {}
+    batch = []
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            batch.append(_parse_entry(line))
+        except ValueError as exc:
+            logger.warning("Skipping line %d: %s", number, exc)
+            stats.skipped += 1
+            continue
+        if len(batch) == batch_size:
+            _import_batch(room, batch, user_ids, stats)
+            batch = []
+            if progress is not None:
+                progress(stats)
+    if batch:
+        _import_batch(room, batch, user_ids, stats)
+    history.invalidate(room.id)
+    return stats
@@ -0,0 +1,230 @@
+import logging
+import threading
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import close_old_connections
+from django.utils import timezone
+from redis.commands.core import Script
+
+from . import sequence
+from .models import ReadCursor, Room
+from .redis_client import LuaScript
+
+logger = logging.getLogger(__name__)
+
+# Cursors changed since they were last copied to ReadCursor, as "user:room"
+DIRTY_KEY = "reads:dirty"
+
+# Field of a cursor hash marking it as loaded from the database
+LOADED = "loaded"
+
+# KEYS: user's cursor hash, dirty set, room seq counter
+# ARGV: room id, seq read, hash ttl, dirty member
+# Cursors only move forward and never past the room's newest message; the
+# first read of a room stores its cursor even at 0. Returns the cursor, or nil
+# when the hash has to be loaded from the database first.
+ADVANCE = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return false
+end
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+local seq = tonumber(ARGV[2])
+local head = tonumber(redis.call('GET', KEYS[3]))
+if head and seq > head then
+    seq = head
+end
+local current = tonumber(redis.call('HGET', KEYS[1], ARGV[1]))
+if current and seq <= current then
+    return current
+end
+redis.call('HSET', KEYS[1], ARGV[1], seq)
+redis.call('SADD', KEYS[2], ARGV[4])
+return seq
+"""
+
+# KEYS: user's cursor hash; ARGV: hash ttl, then room id and seq pairs.
+# Cursors already in Redis are newer than the checkpoint and are kept.
+LOAD = """
+for i = 2, #ARGV, 2 do
+    redis.call('HSETNX', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+redis.call('HSET', KEYS[1], '""" + LOADED + """', 1)
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+"""
+
+_async_advance = LuaScript(ADVANCE)
+_async_load = LuaScript(LOAD)
+_sync_advance = Script(None, ADVANCE.encode())
+_sync_load = Script(None, LOAD.encode())
+
+
+def cursor_key(user_id):
+    return f"reads:{user_id}"
+
+
+def _checkpointed(user_id):
+    """``LOAD`` arguments restoring a user's cursors from ReadCursor."""
+    args = [settings.CHAT_UNREAD["TTL"]]
+    for room_id, seq in ReadCursor.objects.filter(user_id=user_id).values_list("room_id", "seq"):
+        args.extend((room_id, seq))
+    return args
+
+
+def _advance_args(user_id, room_id, seq):
+    room_id = int(room_id)
+    keys = [cursor_key(user_id), DIRTY_KEY, sequence.counter_key(room_id)]
+    return keys, [room_id, seq, settings.CHAT_UNREAD["TTL"], f"{user_id}:{room_id}"]
+
+
+def advance(user_id, room_id, seq):
+    """Mark a room read by a user up to ``seq``; returns the user's cursor for the room."""
+    checkpointer.start()
+    client = cache.client.get_client()
+    keys, args = _advance_args(user_id, room_id, seq)
+    cursor = _sync_advance(keys, args, client=client)
+    if cursor is None:
+        _sync_load([cursor_key(user_id)], _checkpointed(user_id), client=client)
+        cursor = _sync_advance(keys, args, client=client)
+    return int(cursor)
+
+
+async def aadvance(user_id, room_id, seq):
+    """:func:`advance` on the event loop's asyncio Redis client."""
+    checkpointer.start()
+    keys, args = _advance_args(user_id, room_id, seq)
+    cursor = await _async_advance(keys, args)
+    if cursor is None:
+        await _async_load([cursor_key(user_id)], await database_sync_to_async(_checkpointed)(user_id))
+        cursor = await _async_advance(keys, args)
+    return int(cursor)
+
+
+def unread_counts(user_id):
+    """
+    Unread message counts of every room the user has read, as ``{room_id: count}``.
+
+    A count is the room's newest seq minus the user's cursor, so it costs two
+    Redis round trips and one query for all rooms together however busy they
+    are. Rooms whose counter is not in Redis fall back to ``Room.last_seq``.
+
+    Rooms the user never marked read are left out: there is no membership to
+    tell which rooms they follow, so clients start following a room by
+    marking it read, at seq 0 to count its whole history.
+    """
+    client = cache.client.get_client()
+    key = cursor_key(user_id)
+    raw = client.hgetall(key)
+    if not raw:
+        _sync_load([key], _checkpointed(user_id), client=client)
+        raw = client.hgetall(key)
+    # Skips the LOADED marker and any field that is not a room id
+    cursors = {int(room_id): int(seq) for room_id, seq in raw.items() if room_id.isdigit()}
+    if not cursors:
+        return {}
+    heads = dict(zip(cursors, client.mget([sequence.counter_key(room_id) for room_id in cursors])))
+    rooms = Room.objects.filter(pk__in=list(cursors), deleted_at__isnull=True).values_list("id", "last_seq")
+    return {
+        room_id: max(0, (int(heads[room_id]) if heads[room_id] is not None else last_seq) - cursors[room_id])
+        for room_id, last_seq in rooms
+    }
+
+
+def _parse_member(member):
+    """``(user_id, room_id)`` of a dirty set member, or None if it is malformed."""
+    user_id, _, room_id = member.decode().partition(":")
+    if not (user_id.isdigit() and room_id.isdigit()):
+        return None
+    return int(user_id), int(room_id)
+
+
+def checkpoint(batch_size=None):
+    """Copy up to ``batch_size`` cursors changed since the last checkpoint to ReadCursor; returns how many."""
+    batch_size = batch_size or settings.CHAT_UNREAD["CHECKPOINT_BATCH"]
+    client = cache.client.get_client()
+    members = client.spop(DIRTY_KEY, batch_size)
+    if not members:
+        return 0
+    pairs = [pair for pair in map(_parse_member, members) if pair is not None]
+    if len(pairs) < len(members):
+        logger.warning("Skipped %d malformed read cursor entries", len(members) - len(pairs))
+    pipe = client.pipeline(transaction=False)
+    for user_id, room_id in pairs:
+        pipe.hget(cursor_key(user_id), room_id)
+    seqs = pipe.execute()
+
+    # Rooms and users deleted since the read would fail the whole insert
+    room_ids = set(Room.objects.filter(pk__in={room_id for _, room_id in pairs}).values_list("id", flat=True))
+    user_ids = set(User.objects.filter(pk__in={user_id for user_id, _ in pairs}).values_list("id", flat=True))
+    now = timezone.now()
+    cursors = [
+        ReadCursor(user_id=user_id, room_id=room_id, seq=int(seq), updated_at=now)
+        for (user_id, room_id), seq in zip(pairs, seqs)
+        if seq is not None and room_id in room_ids and user_id in user_ids
+    ]
+    ReadCursor.objects.bulk_create(
+        cursors, update_conflicts=True, unique_fields=["user", "room"], update_fields=["seq", "updated_at"]
+    )
+    return len(members)
+
+
+class Checkpointer:
+    """
+    Copies changed read cursors to the database every ``interval`` seconds from a background thread.
+
+    There is one per process, started by the first read on either the REST or
+    the WebSocket path, so cursors reach ReadCursor whoever advanced them.
+    ``manage.py checkpoint_read_cursors`` does the same from outside.
+    """
+
+    def __init__(self, interval=30, batch_size=1000):
+        self.interval = interval
+        self.batch_size = batch_size
+        self._thread = None
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._stopped.clear()
+                self._thread = threading.Thread(target=self._run, name="read-cursor-checkpointer", daemon=True)
+                self._thread.start()
+
+    def flush(self):
+        while checkpoint(self.batch_size) == self.batch_size:
+            pass
+
+    def close(self):
+        """Stop the thread and copy whatever changed since its last run."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._stopped.set()
+            thread.join()
+        self.flush()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Read cursor checkpoint failed")
+            finally:
+                # No request cycle ends on this thread to recycle its connection
+                close_old_connections()
+
+
+checkpointer = Checkpointer(
+    interval=settings.CHAT_UNREAD["CHECKPOINT_INTERVAL"],
+    batch_size=settings.CHAT_UNREAD["CHECKPOINT_BATCH"],
+)
+
+
+async def shutdown():
+    """Stop checkpointing and copy the last changed cursors."""
+    await database_sync_to_async(checkpointer.close)()
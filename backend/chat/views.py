@@ -1,9 +1,26 @@
+from datetime import datetime, timezone as dt_timezone
+
 from rest_framework import viewsets, permissions, status
 from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.db import transaction
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils import timezone
+from . import archive, conditional, history, metrics, presence, retention, routers, transfer, unread
+from .ratelimit import ChatWriteThrottle
 from .models import Room, Message, UserProfile
-from .serializers import RoomSerializer, MessageSerializer, UserSerializer, UserProfileSerializer
+from .pagination import MessageCursorPagination, OnlineUserPagination, RoomPagination, SearchCursorPagination
+from .serializers import (
+    RoomSerializer,
+    RoomSummarySerializer,
+    MessageSerializer,
+    MessageHistorySerializer,
+    UserSerializer,
+    UserProfileSerializer,
+)
 
 
 class UserViewSet(viewsets.ModelViewSet):
@@ -24,48 +41,175 @@ class UserViewSet(viewsets.ModelViewSet):
 
 
 class UserProfileViewSet(viewsets.ModelViewSet):
-    queryset = UserProfile.objects.all()
+    queryset = UserProfile.objects.select_related("user")
     serializer_class = UserProfileSerializer
     permission_classes = [permissions.IsAuthenticated]
 
-    @action(detail=False, methods=["GET"])
+    @action(detail=False, methods=["GET"], pagination_class=OnlineUserPagination)
     def online_users(self, request):
-        online_users = UserProfile.objects.filter(is_online=True)
-        serializer = self.get_serializer(online_users, many=True)
-        return Response(serializer.data)
-
-
-class RoomViewSet(viewsets.ModelViewSet):
-    queryset = Room.objects.all()
+        """Users online in any room, most recently connected first, a page at a time from Redis presence."""
+        page = dict(self.paginate_queryset(presence.OnlineUsers()))
+        profiles = {profile.user_id: profile for profile in self.get_queryset().filter(user_id__in=list(page))}
+        for user in User.objects.filter(pk__in=[user_id for user_id in page if user_id not in profiles]):
+            # Users who have never been flushed to UserProfile yet
+            profiles[user.id] = UserProfile(
+                user=user, last_seen=datetime.fromtimestamp(page[user.id], tz=dt_timezone.utc)
+            )
+        context = self.get_serializer_context()
+        context["online"] = set(page)
+        serializer = self.get_serializer(
+            [profiles[user_id] for user_id in page if user_id in profiles], many=True, context=context
+        )
+        return self.get_paginated_response(serializer.data)
+
+
+class RoomViewSet(metrics.TimedViewMixin, viewsets.ModelViewSet):
+    queryset = (
+        Room.objects.filter(deleted_at__isnull=True).select_related("created_by").order_by("-last_activity_at", "-id")
+    )
     serializer_class = RoomSerializer
     permission_classes = [permissions.IsAuthenticated]
+    throttle_classes = [ChatWriteThrottle]
+    pagination_class = RoomPagination
+
+    def get_serializer_class(self):
+        if self.action == "list":
+            return RoomSummarySerializer
+        return super().get_serializer_class()
 
     def perform_create(self, serializer):
         serializer.save(created_by=self.request.user)
 
+    def serve_conditionally(self, request, room_id, view, *args, **kwargs):
+        """Serve ``view``, or a 304 without running it when the client holds the current version."""
+        validators = conditional.validators(room_id)
+        response = conditional.not_modified(request, validators, room_id) or view(request, *args, **kwargs)
+        return conditional.finish(response, validators)
+
+    def list(self, request, *args, **kwargs):
+        return self.serve_conditionally(request, None, super().list, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.serve_conditionally(request, kwargs["pk"], super().retrieve, *args, **kwargs)
+
     def destroy(self, request, *args, **kwargs):
         room = self.get_object()
         if room.created_by != request.user:
             return Response(
                 {"detail": "You do not have permission to delete this room."}, status=status.HTTP_403_FORBIDDEN
             )
-        return super().destroy(request, *args, **kwargs)
+        if settings.CHAT_RETENTION["ROOM_DELETION"] == retention.MODE_BACKGROUND:
+            # Hide the room now; its messages are deleted in batches off the request
+            Room.objects.filter(pk=room.pk).update(deleted_at=timezone.now())
+            history.invalidate(room.id)
+            transaction.on_commit(lambda: retention.purge_in_background(room.id))
+            return Response(status=status.HTTP_202_ACCEPTED)
+        response = super().destroy(request, *args, **kwargs)
+        history.invalidate(room.id)
+        archive.remove_room(room.id)
+        return response
 
     @action(detail=True, methods=["GET"])
     def messages(self, request, pk=None):
+        return self.serve_conditionally(request, pk, self._messages)
+
+    def _messages(self, request):
         room = self.get_object()
-        messages = Message.objects.filter(room=room)
-        serializer = MessageSerializer(messages, many=True)
-        return Response(serializer.data)
+        paginator = MessageCursorPagination()
+
+        # The newest page is what nearly every client asks for; try Redis first
+        buffer = history.HistoryBuffer(room.id) if paginator.is_newest_page(request) else None
+        if buffer is not None:
+            cached = buffer.recent(paginator.get_page_size(request))
+            if cached is not None:
+                return paginator.get_buffered_response(*cached)
+
+        messages = (
+            Message.objects.filter(room=room)
+            .select_related("user")
+            .only("id", "room_id", "content", "timestamp", "seq", "user__id", "user__username")
+        )
+        page = paginator.paginate_queryset(messages, request, view=self, archive=archive.RoomArchive(room))
+        serializer = MessageHistorySerializer(page, many=True)
+        # A lagging replica can miss messages already pushed to Redis; only the primary primes
+        if buffer is not None and not routers.reading_from_replica():
+            buffer.prime(serializer.data, complete=not paginator.has_older)
+        return paginator.get_paginated_response(serializer.data)
+
+    @action(detail=True, methods=["GET"])
+    def export(self, request, pk=None):
+        """The room's whole history, archive included, streamed as NDJSON."""
+        room = self.get_object()
+        if room.created_by != request.user and not request.user.is_staff:
+            return Response(
+                {"detail": "You do not have permission to export this room."}, status=status.HTTP_403_FORBIDDEN
+            )
+        lines = transfer.export_lines(room)
+        # An async iterator under WSGI, or a sync one under ASGI, would be buffered whole
+        response = StreamingHttpResponse(
+            transfer.streaming_content(request._request, lines), content_type=transfer.CONTENT_TYPE
+        )
+        response["Content-Disposition"] = f'attachment; filename="room-{room.id}.ndjson"'
+        return response
+
+    @action(detail=True, methods=["POST"])
+    def read(self, request, pk=None):
+        """Mark the room read up to ``seq``; cursors only move forward."""
+        room = self.get_object()
+        seq = request.data.get("seq")
+        if not isinstance(seq, int) or isinstance(seq, bool) or seq < 0:
+            raise ValidationError({"seq": "Must be a non-negative integer."})
+        return Response({"room": room.id, "seq": unread.advance(request.user.id, room.id, seq)})
+
+    @action(detail=False, methods=["GET"])
+    def unread(self, request):
+        """Unread message counts of every room the user has marked read (at seq 0 to follow it), keyed by room id."""
+        return Response({str(room_id): count for room_id, count in unread.unread_counts(request.user.id).items()})
 
+    @action(detail=False, methods=["GET"], permission_classes=[permissions.IsAdminUser])
+    def history_stats(self, request):
+        return Response(history.stats())
 
-class MessageViewSet(viewsets.ModelViewSet):
-    queryset = Message.objects.all()
+
+class MessageViewSet(metrics.TimedViewMixin, viewsets.ModelViewSet):
+    queryset = Message.objects.filter(room__deleted_at__isnull=True)
     serializer_class = MessageSerializer
     permission_classes = [permissions.IsAuthenticated]
+    throttle_classes = [ChatWriteThrottle]
+
+    @action(detail=False, methods=["GET"])
+    def search(self, request):
+        """Full-text search over every room, or one with ``?room=``; best matches first."""
+        text = request.query_params.get("q", "").strip()
+        if not text:
+            raise ValidationError({"q": "This query parameter is required."})
+        # Rooms waiting to be purged stay hidden from search too
+        messages = (
+            Message.objects.filter(room__deleted_at__isnull=True)
+            .search(text)
+            .select_related("user")
+            .only("id", "room_id", "content", "timestamp", "seq", "user__id", "user__username")
+        )
+        room = request.query_params.get("room")
+        if room is not None:
+            if not room.isdigit():
+                raise ValidationError({"room": "Must be an integer."})
+            messages = messages.filter(room_id=int(room))
+        paginator = SearchCursorPagination()
+        page = paginator.paginate_queryset(messages, request, view=self)
+        serializer = MessageHistorySerializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
 
     def perform_create(self, serializer):
-        serializer.save(user=self.request.user)
+        message = serializer.save(user=self.request.user)
+        history.push(message.room_id, [history.to_entry(message, self.request.user.username)])
+
+    def perform_update(self, serializer):
+        previous_room_id = serializer.instance.room_id
+        message = serializer.save()
+        history.invalidate(previous_room_id)
+        if message.room_id != previous_room_id:
+            history.invalidate(message.room_id)
 
     def destroy(self, request, *args, **kwargs):
         message = self.get_object()
@@ -73,4 +217,11 @@ class MessageViewSet(viewsets.ModelViewSet):
             return Response(
                 {"detail": "You do not have permission to delete this message."}, status=status.HTTP_403_FORBIDDEN
             )
-        return super().destroy(request, *args, **kwargs)
+        response = super().destroy(request, *args, **kwargs)
+        history.invalidate(message.room_id)
+        return response
+
+
+def metrics_view(request):
+    """Prometheus scrape endpoint; served on the backend port only, nginx does not proxy it."""
+    return HttpResponse(metrics.render(), content_type=metrics.CONTENT_TYPE)
@@ -8,11 +8,13 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "chat_project.settings")
 django.setup()
 
 # Import after django.setup()
+from chat.lifespan import lifespan
 from chat.routing import websocket_urlpatterns
 
 application = ProtocolTypeRouter(
     {
         "http": get_asgi_application(),
         "websocket": TokenAuthMiddleware(URLRouter(websocket_urlpatterns)),
+        "lifespan": lifespan,
     }
 )
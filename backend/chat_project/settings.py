@@ -36,6 +36,7 @@ MIDDLEWARE = [
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
+    "chat.middleware.ReplicaRoutingMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
 ]
@@ -62,27 +63,156 @@ WSGI_APPLICATION = "chat_project.wsgi.application"
 ASGI_APPLICATION = "chat_project.asgi.application"
 
 # Database
-DATABASES = {
-    "default": {
-        "ENGINE": "django.db.backends.postgresql",
-        "NAME": os.environ.get("POSTGRES_DB", "chat_db"),
-        "USER": os.environ.get("POSTGRES_USER", "postgres"),
-        "PASSWORD": os.environ.get("POSTGRES_PASSWORD", "postgres"),
-        "HOST": os.environ.get("POSTGRES_HOST", "db"),
-        "PORT": os.environ.get("POSTGRES_PORT", "5432"),
+# Under Daphne every HTTP request runs its synchronous code on a thread of its
+# own single-use executor, so a persistent connection is never reused by a
+# later request and is only closed when garbage collected. Connections are
+# therefore closed at the end of each request (CONN_MAX_AGE 0); reuse across
+# requests comes from an external pooler such as pgbouncer in transaction mode
+# between the backend and Postgres. POSTGRES_CONN_MAX_AGE is for WSGI servers
+# and long-running commands, where threads do live across requests.
+_DATABASE = {
+    "ENGINE": "django.db.backends.postgresql",
+    "NAME": os.environ.get("POSTGRES_DB", "chat_db"),
+    "USER": os.environ.get("POSTGRES_USER", "postgres"),
+    "PASSWORD": os.environ.get("POSTGRES_PASSWORD", "postgres"),
+    "HOST": os.environ.get("POSTGRES_HOST", "db"),
+    "PORT": os.environ.get("POSTGRES_PORT", "5432"),
+    "CONN_MAX_AGE": int(os.environ.get("POSTGRES_CONN_MAX_AGE", 0)),
+    "CONN_HEALTH_CHECKS": True,
+}
+DATABASES = {"default": _DATABASE}
+
+# Read replicas: each "host[:port]" in POSTGRES_REPLICA_HOSTS becomes a
+# "replica_<n>" alias. GET requests read from a random replica unless the user
+# wrote within STICKY_SECONDS; writes, WebSocket consumers and commands use
+# "default". Tests read replicas through "default".
+for _index, _replica in enumerate(filter(None, os.environ.get("POSTGRES_REPLICA_HOSTS", "").split(","))):
+    _host, _, _port = _replica.strip().partition(":")
+    DATABASES[f"replica_{_index}"] = {
+        **_DATABASE,
+        "HOST": _host,
+        "PORT": _port or _DATABASE["PORT"],
+        "TEST": {"MIRROR": "default"},
     }
+DATABASE_ROUTERS = ["chat.routers.ReplicaRouter"]
+CHAT_DB = {
+    "REPLICAS": [alias for alias in DATABASES if alias != "default"],
+    "STICKY_SECONDS": int(os.environ.get("CHAT_DB_STICKY_SECONDS", 5)),
 }
 
 # Channel layers
+# "chat.layers.LocalFanoutChannelLayer" is the Redis pub/sub layer decoding each
+# room message once per process before fanning it out to that process's sockets.
 CHANNEL_LAYERS = {
     "default": {
-        "BACKEND": "channels_redis.core.RedisChannelLayer",
+        "BACKEND": os.environ.get("CHANNEL_LAYER_BACKEND", "channels_redis.core.RedisChannelLayer"),
         "CONFIG": {
             "hosts": [(os.environ.get("REDIS_HOST", "redis"), 6379)],
         },
     },
 }
 
+# Chat message persistence
+# MODE "sync" writes every message as it arrives; "write_behind" buffers messages
+# and flushes them with bulk_create. ACK "enqueue" acknowledges a message once it
+# is queued, "flush" only once it has been written to the database. A failed
+# batch is retried RETRIES times with exponential backoff from RETRY_DELAY.
+CHAT_MESSAGE_WRITER = {
+    "MODE": os.environ.get("CHAT_MESSAGE_WRITER_MODE", "sync"),
+    "ACK": os.environ.get("CHAT_MESSAGE_WRITER_ACK", "enqueue"),
+    "BATCH_SIZE": int(os.environ.get("CHAT_MESSAGE_WRITER_BATCH_SIZE", 200)),
+    "FLUSH_INTERVAL": float(os.environ.get("CHAT_MESSAGE_WRITER_FLUSH_INTERVAL", 0.05)),
+    "MAX_QUEUE_SIZE": int(os.environ.get("CHAT_MESSAGE_WRITER_MAX_QUEUE_SIZE", 10000)),
+    "RETRIES": int(os.environ.get("CHAT_MESSAGE_WRITER_RETRIES", 3)),
+    "RETRY_DELAY": float(os.environ.get("CHAT_MESSAGE_WRITER_RETRY_DELAY", 0.1)),
+}
+
+# Per-room Redis buffer of the newest history entries served to ChatRoom.tsx
+CHAT_HISTORY_BUFFER = {
+    "SIZE": int(os.environ.get("CHAT_HISTORY_BUFFER_SIZE", 100)),
+    "TTL": int(os.environ.get("CHAT_HISTORY_BUFFER_TTL", 24 * 60 * 60)),
+}
+
+# Reconnects with ?since=<seq> replay at most MAX_MESSAGES missed messages;
+# longer gaps get a "resync" frame telling the client to refetch history
+CHAT_REPLAY = {
+    "MAX_MESSAGES": int(os.environ.get("CHAT_REPLAY_MAX_MESSAGES", 200)),
+}
+
+# Messages older than AFTER_DAYS are moved by "manage.py archive_messages" into
+# compressed NDJSON segments under ROOT, one set per room and month, BATCH_SIZE
+# messages at a time. Every backend process must see the same ROOT.
+CHAT_ARCHIVE = {
+    "ROOT": os.environ.get("CHAT_ARCHIVE_ROOT", os.path.join(BASE_DIR, "archive")),
+    "AFTER_DAYS": int(os.environ.get("CHAT_ARCHIVE_AFTER_DAYS", 90)),
+    "BATCH_SIZE": int(os.environ.get("CHAT_ARCHIVE_BATCH_SIZE", 5000)),
+}
+
+# Large deletes go BATCH_SIZE rows at a time, sleeping PAUSE seconds between
+# batches. "manage.py enforce_retention" deletes messages, live and archived,
+# older than DAYS (0 keeps everything). ROOM_DELETION "background" hides a
+# deleted room at once and purges it on a worker thread; "sync" deletes it
+# within the request.
+CHAT_RETENTION = {
+    "DAYS": int(os.environ.get("CHAT_RETENTION_DAYS", 0)),
+    "BATCH_SIZE": int(os.environ.get("CHAT_RETENTION_BATCH_SIZE", 1000)),
+    "PAUSE": float(os.environ.get("CHAT_RETENTION_PAUSE", 0.05)),
+    "ROOM_DELETION": os.environ.get("CHAT_ROOM_DELETION_MODE", "background"),
+}
+
+# Read cursors live in per-user Redis hashes kept for TTL seconds after the last
+# read; every CHECKPOINT_INTERVAL seconds a background thread in each process
+# copies changed ones, CHECKPOINT_BATCH at a time, to the ReadCursor table
+CHAT_UNREAD = {
+    "TTL": int(os.environ.get("CHAT_UNREAD_TTL", 7 * 24 * 60 * 60)),
+    "CHECKPOINT_INTERVAL": int(os.environ.get("CHAT_UNREAD_CHECKPOINT_INTERVAL", 30)),
+    "CHECKPOINT_BATCH": int(os.environ.get("CHAT_UNREAD_CHECKPOINT_BATCH", 1000)),
+}
+
+# Room presence: connection entries expire after TTL seconds unless refreshed by
+# the owning process's heartbeat; count updates go out at most once per interval.
+# Users' last-seen times are written to UserProfile every FLUSH_INTERVAL seconds,
+# FLUSH_BATCH rows per statement.
+CHAT_PRESENCE = {
+    "TTL": int(os.environ.get("CHAT_PRESENCE_TTL", 90)),
+    "HEARTBEAT_INTERVAL": int(os.environ.get("CHAT_PRESENCE_HEARTBEAT_INTERVAL", 30)),
+    "SWEEP_INTERVAL": int(os.environ.get("CHAT_PRESENCE_SWEEP_INTERVAL", 60)),
+    "BROADCAST_INTERVAL": float(os.environ.get("CHAT_PRESENCE_BROADCAST_INTERVAL", 1.0)),
+    "FLUSH_INTERVAL": int(os.environ.get("CHAT_PRESENCE_FLUSH_INTERVAL", 30)),
+    "FLUSH_BATCH": int(os.environ.get("CHAT_PRESENCE_FLUSH_BATCH", 1000)),
+}
+
+# Per-connection outbound queue: up to MAX_QUEUE chat frames wait for a slow
+# client, going out MAX_BATCH at a time as one batch frame. On overflow POLICY
+# "drop_oldest" discards the oldest frame, "disconnect" closes with CLOSE_CODE.
+# MessagePack connections also wait BATCH_WINDOW seconds to batch bursts.
+CHAT_OUTBOUND = {
+    "MAX_QUEUE": int(os.environ.get("CHAT_OUTBOUND_MAX_QUEUE", 256)),
+    "MAX_BATCH": int(os.environ.get("CHAT_OUTBOUND_MAX_BATCH", 50)),
+    "POLICY": os.environ.get("CHAT_OUTBOUND_POLICY", "drop_oldest"),
+    "CLOSE_CODE": int(os.environ.get("CHAT_OUTBOUND_CLOSE_CODE", 4008)),
+    "BATCH_WINDOW": float(os.environ.get("CHAT_OUTBOUND_BATCH_WINDOW", 0.02)),
+}
+
+# Rooms one socket may follow on the multiplexed ws/chat/ endpoint
+CHAT_MULTIPLEX = {
+    "MAX_ROOMS": int(os.environ.get("CHAT_MULTIPLEX_MAX_ROOMS", 100)),
+}
+
+# Token buckets shared through Redis: BURST actions at once, refilled at RATE
+# per second. MESSAGES is per user and room, for WebSocket sends and
+# POST /api/messages/; ROOMS is per user, for POST /api/rooms/.
+CHAT_RATE_LIMIT = {
+    "MESSAGES": {
+        "BURST": int(os.environ.get("CHAT_RATE_LIMIT_MESSAGE_BURST", 10)),
+        "RATE": float(os.environ.get("CHAT_RATE_LIMIT_MESSAGE_RATE", 2.0)),
+    },
+    "ROOMS": {
+        "BURST": int(os.environ.get("CHAT_RATE_LIMIT_ROOM_BURST", 5)),
+        "RATE": float(os.environ.get("CHAT_RATE_LIMIT_ROOM_RATE", 0.1)),
+    },
+}
+
 # Password validation
 AUTH_PASSWORD_VALIDATORS = [
     {
@@ -122,13 +252,24 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 # REST Framework settings
 REST_FRAMEWORK = {
-    "DEFAULT_AUTHENTICATION_CLASSES": ("rest_framework_simplejwt.authentication.JWTAuthentication",),
+    "DEFAULT_AUTHENTICATION_CLASSES": ("chat.auth.ReplicaAwareJWTAuthentication",),
     "DEFAULT_PERMISSION_CLASSES": [
         "rest_framework.permissions.IsAuthenticated",
     ],
     'EXCEPTION_HANDLER': 'chat_project.utils.custom_exception_handler',
 }
 
+# WebSocket authentication
+# MODE "claims" authenticates handshakes from the access token's claims plus a
+# bounded in-process cache of user records; "db" loads the user on every handshake.
+# In "claims" mode deactivated and deleted users are also shared through Redis
+# for one access token lifetime, so every process refuses their tokens.
+CHAT_WS_AUTH = {
+    "MODE": os.environ.get("CHAT_WS_AUTH_MODE", "claims"),
+    "CACHE_SIZE": int(os.environ.get("CHAT_WS_AUTH_CACHE_SIZE", 10000)),
+    "CACHE_TTL": int(os.environ.get("CHAT_WS_AUTH_CACHE_TTL", 300)),
+}
+
 # JWT settings
 SIMPLE_JWT = {
     "ACCESS_TOKEN_LIFETIME": timedelta(minutes=60),
@@ -206,3 +347,13 @@ CACHES = {
         },
     }
 }
+
+# asyncio Redis client used by WebSocket consumers (presence, history buffer);
+# shares the cache database so both sides see the same keys. Commands beyond
+# MAX_CONNECTIONS in flight wait up to POOL_TIMEOUT seconds for a connection.
+CHAT_REDIS = {
+    "URL": CACHES["default"]["LOCATION"],
+    "MAX_CONNECTIONS": int(os.environ.get("CHAT_REDIS_MAX_CONNECTIONS", 100)),
+    "POOL_TIMEOUT": float(os.environ.get("CHAT_REDIS_POOL_TIMEOUT", 5)),
+    "POOL_KWARGS": {},
+}
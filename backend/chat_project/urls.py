@@ -4,7 +4,8 @@ from django.conf import settings
 from django.conf.urls.static import static
 from rest_framework.routers import DefaultRouter
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
-from chat.views import UserViewSet, RoomViewSet, MessageViewSet, UserProfileViewSet
+from chat import async_views
+from chat.views import UserViewSet, RoomViewSet, MessageViewSet, UserProfileViewSet, metrics_view
 
 router = DefaultRouter()
 router.register(r"users", UserViewSet)
@@ -14,7 +15,12 @@ router.register(r"profiles", UserProfileViewSet)
 
 urlpatterns = [
     path("admin/", admin.site.urls),
+    # Async GET handlers ahead of the viewsets' routes; other methods are passed on to them
+    path("api/rooms/", async_views.rooms),
+    path("api/rooms/<int:pk>/messages/", async_views.room_history),
+    path("api/users/me/", async_views.users_me),
     path("api/", include(router.urls)),
     path("api/token/", TokenObtainPairView.as_view(), name="token_obtain_pair"),
     path("api/token/refresh/", TokenRefreshView.as_view(), name="token_refresh"),
+    path("metrics", metrics_view, name="metrics"),
 ] + static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
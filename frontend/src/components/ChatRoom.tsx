@@ -5,6 +5,7 @@ import { useAuth } from '../contexts/AuthContext';
 
 interface Message {
   id: number;
+  seq?: number;
   content: string;
   timestamp: string;
   user: {
@@ -72,51 +73,81 @@ const ChatRoom: React.FC = () => {
   const { user, logout } = useAuth();
   const [messageAnimIds, setMessageAnimIds] = useState<number[]>([]);
   const [countAnim, setCountAnim] = useState(false);
+  // Highest per-room sequence seen; reconnects ask the server to replay only what came after it
+  const lastSeqRef = useRef(0);
 
   useEffect(() => {
     fetchRoom();
     fetchMessages();
 
-    const token = localStorage.getItem('token');
-    const ws = new WebSocket(`ws://localhost:8000/ws/chat/${roomId}/?token=${token}`);
+    let closed = false;
+    let reconnectTimer: ReturnType<typeof setTimeout> | undefined;
+    let ws: WebSocket;
 
-    ws.onopen = () => {
-    };
+    const connect = () => {
+      const token = localStorage.getItem('token');
+      const since = lastSeqRef.current ? `&since=${lastSeqRef.current}` : '';
+      ws = new WebSocket(`ws://localhost:8000/ws/chat/${roomId}/?token=${token}${since}`);
+
+      ws.onopen = () => {
+      };
 
-    ws.onmessage = (event) => {
-      const data = JSON.parse(event.data);
-      if (data.type === 'online_users_count') {
-        setOnlineUsersCount(data.count);
-      } else {
-        const shouldScroll = isUserAtBottom();
-        setMessages((prevMessages) => [
-          ...prevMessages,
-          {
-            id: Date.now(),
-            content: data.message,
-            timestamp: new Date().toISOString(),
-            user: {
-              id: data.user_id,
-              username: data.username,
-            },
-          },
-        ]);
-        if (shouldScroll) {
-          setTimeout(() => scrollToBottom(), 0);
+      ws.onmessage = (event) => {
+        const data = JSON.parse(event.data);
+        if (data.type === 'online_users_count') {
+          setOnlineUsersCount(data.count);
+        } else if (data.type === 'error') {
+          console.warn('Message rejected by server:', data.code, data);
+        } else if (data.type === 'resync') {
+          // Missed too much while away to replay; reload the history instead
+          fetchMessages();
+        } else {
+          // A client that fell behind, or just reconnected, receives several messages in one batch frame
+          const batch = data.type === 'batch' ? data.messages : [data];
+          const received = batch.filter((item: any) => item.seq === undefined || item.seq > lastSeqRef.current);
+          if (received.length === 0) {
+            return;
+          }
+          lastSeqRef.current = Math.max(lastSeqRef.current, ...received.map((item: any) => item.seq || 0));
+          const shouldScroll = isUserAtBottom();
+          const now = Date.now();
+          setMessages((prevMessages) => [
+            ...prevMessages,
+            ...received.map((item: any, index: number) => ({
+              id: now + index,
+              seq: item.seq,
+              content: item.message,
+              timestamp: new Date().toISOString(),
+              user: {
+                id: item.user_id,
+                username: item.username,
+              },
+            })),
+          ]);
+          if (shouldScroll) {
+            setTimeout(() => scrollToBottom(), 0);
+          }
         }
-      }
-    };
+      };
 
-    ws.onclose = (event) => {
-    };
+      ws.onclose = () => {
+        if (!closed) {
+          reconnectTimer = setTimeout(connect, 1000);
+        }
+      };
+
+      ws.onerror = (error) => {
+        console.error('WebSocket error for room:', roomId, error);
+      };
 
-    ws.onerror = (error) => {
-      console.error('WebSocket error for room:', roomId, error);
+      setWebsocket(ws);
     };
 
-    setWebsocket(ws);
+    connect();
 
     return () => {
+      closed = true;
+      clearTimeout(reconnectTimer);
       if (ws.readyState === WebSocket.OPEN || ws.readyState === WebSocket.CONNECTING) {
         ws.close();
       }
@@ -132,6 +163,16 @@ const ChatRoom: React.FC = () => {
     }
   }, [messages]);
 
+  // Tell the server how far this room has been read, at most once a second, for the unread badges
+  useEffect(() => {
+    const timer = setTimeout(() => {
+      if (lastSeqRef.current && websocket?.readyState === WebSocket.OPEN) {
+        websocket.send(JSON.stringify({ action: 'read', seq: lastSeqRef.current }));
+      }
+    }, 1000);
+    return () => clearTimeout(timer);
+  }, [messages, websocket]);
+
   useEffect(() => {
     if (onlineUsersCount !== null) {
       setCountAnim(true);
@@ -160,7 +201,8 @@ const ChatRoom: React.FC = () => {
           Authorization: `Bearer ${localStorage.getItem('token')}`,
         },
       });
-      setMessages(response.data);
+      setMessages(response.data.results);
+      lastSeqRef.current = Math.max(lastSeqRef.current, ...response.data.results.map((m: Message) => m.seq || 0));
       setTimeout(() => scrollToBottom(), 0);
     } catch (error) {
       console.error('Error fetching messages:', error);
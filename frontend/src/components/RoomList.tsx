@@ -14,6 +14,7 @@ interface Room {
 
 const RoomList: React.FC = () => {
   const [rooms, setRooms] = useState<Room[]>([]);
+  const [unread, setUnread] = useState<Record<string, number>>({});
   const [newRoomName, setNewRoomName] = useState('');
   const [showCreateRoomModal, setShowCreateRoomModal] = useState(false);
   const [searchTerm, setSearchTerm] = useState('');
@@ -32,10 +33,24 @@ const RoomList: React.FC = () => {
           Authorization: `Bearer ${localStorage.getItem('token')}`
         }
       });
-      setRooms(response.data);
+      setRooms(response.data.results);
     } catch (error) {
       console.error('Error fetching rooms:', error);
     }
+    fetchUnread();
+  };
+
+  const fetchUnread = async () => {
+    try {
+      const response = await axios.get('http://localhost:8000/api/rooms/unread/', {
+        headers: {
+          Authorization: `Bearer ${localStorage.getItem('token')}`
+        }
+      });
+      setUnread(response.data);
+    } catch (error) {
+      console.error('Error fetching unread counts:', error);
+    }
   };
 
   const createRoom = async (e: React.FormEvent) => {
@@ -146,6 +161,11 @@ const RoomList: React.FC = () => {
                         <p className="text-sm font-medium text-indigo-600 truncate">
                           {room.name}
                         </p>
+                        {unread[room.id] > 0 && (
+                          <span className="ml-2 px-2 inline-flex text-xs leading-5 font-semibold rounded-full bg-indigo-600 text-white">
+                            {unread[room.id]}
+                          </span>
+                        )}
                       </div>
                     </Link>
                     <div className="ml-2 flex-shrink-0 flex items-center space-x-2 pr-4 sm:pr-6">